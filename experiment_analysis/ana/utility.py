@@ -18,16 +18,35 @@ log.setLevel("WARNING")
 import os
 import re
 import glob
+import json
+import shutil
+import hashlib
+import fcntl
 import h5py
+import pickle
 import sys
+import threading
+import time
 import numpy as np
 import xarray as xr
 import pandas as pd
 import warnings
 import numpy as np
-from numba import jit
+from collections import OrderedDict
+from contextlib import nullcontext
+import numba
+from numba import jit, prange
 from tqdm import tqdm
 from humanize import naturalsize
+from pandas.api.types import is_numeric_dtype
+from scipy import fft as sp_fft
+
+try:
+    # registers the blosc / lz4 filters with h5py, needed to read files
+    # repacked with those codecs.
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
 
 # silence numba deprications, numpy overflows
 warnings.filterwarnings("ignore")
@@ -77,20 +96,45 @@ area_groups = {
 
 _meta_df = None
 
+# the metadata index is a parquet file that we keep next to the session files.
+# the file table (path, size, mtime) lives in the parquet key-value metadata,
+# bump the version whenever the columns of the metadata frame change.
+_meta_index_name = "unit_metadata_index.parquet"
+_meta_index_version = 2
+# if the data directory is not writable (e.g. a shared, read-only location),
+# each user keeps their own index here, one per data directory.
+meta_index_cache_dir = os.path.expanduser("~/.cache/its/")
+
 
 def all_unit_metadata(
     dir="/data.nst/share/data/allen_visual_coding_neuropixels/",
     reload=False,
+    use_index=True,
+    index_file=None,
+    workers=None,
+    compact=True,
 ):
     """
     Returns a pandas dataframe holding the overall index,
     an overview of sessions and units.
 
-    Uses `load_session` on every found hdf5 file.
+    Uses `load_session` on every found hdf5 file. To avoid opening every file
+    in every new python process, the result is kept in an on-disk index
+    (parquet) that is revalidated against each file's size and modification time.
+    Only new or changed files are read again.
 
     # Parameters:
     dir (str): directory holding the hdf5 files
     reload (bool): if True, reload the metadata from disk, otherwise use the module cache
+    use_index (bool): if True (default), read and update the on-disk metadata index.
+    index_file (str or None): where to keep the index,
+        default: `unit_metadata_index.parquet` in `dir`, or in
+        `meta_index_cache_dir` (`~/.cache/its/`) if `dir` is not writable.
+    workers (int or None): number of processes to read session files that are
+        not (or no longer) in the index. default: None, read sequentially.
+    compact (bool): if True (default), use categorical dtypes for the string
+        columns, and smaller numeric types, see `compact_dtypes`.
+        set to False to get plain strings, int64 and float64.
 
     # Columns:
     unit_id : int
@@ -98,9 +142,16 @@ def all_unit_metadata(
     session : int
         session number, e.g. 787025148
     num_spikes : int
-        note that this is the max number of spikes any unit had in that block,
-        because spiking data is nan-padded (and we cannot load the actual number
-        for a single unit from meta-data alone).
+        number of spikes of the unit in the block. exact for files that have
+        per-unit stats (see `backfill_spike_stats`) or the ragged layout.
+        for older nan-padded files, this is the max number of spikes any unit
+        had in that block.
+    t_first, t_last : float
+        first and last spike time, in seconds. nan if the unit has no spikes.
+        only for files with per-unit stats, as the following:
+    isi_mean, isi_cv : float
+        mean and coefficient of variation of the inter-spike intervals.
+        nan for units with less than two spikes.
     stimulus : str/Object
         stimulus name, e.g. "natural_movie_one_more_repeats"
     block : str/O
@@ -119,40 +170,95 @@ def all_unit_metadata(
     # Notes:
     - to get the `spiketimes` column, call `load_spikes(meta_df)`, best after filtering,
         to avoid loading data you don't need.
+    - if `dir` is not writable, the index goes to `meta_index_cache_dir`,
+        named after a hash of `dir`. An index that already exists in `dir`
+        (e.g. created by whoever can write there) is used as a starting point.
     """
 
     # lets be smart about this and not load this from disk every times
     global _meta_df
     if not reload and _meta_df is not None:
         log.debug("Using cached metadata")
-        return _meta_df.copy()
+        return compact_dtypes(_meta_df) if compact else _meta_df.copy()
 
     dir = os.path.abspath(os.path.expanduser(dir))
-    files = glob.glob(dir + "/**/*.h5", recursive=True)
+    files = sorted(glob.glob(dir + "/**/*.h5", recursive=True))
     log.debug(f"Found {len(files)} hdf5 files in {dir}")
     assert len(files) > 0, f"Found no hdf5 files in {dir}"
 
-    meta_df = []
+    if index_file is None:
+        index_file = _default_meta_index_file(dir)
+
+    if use_index:
+        cached_df, cached_files = _read_meta_index(index_file)
+        shared_index_file = os.path.join(dir, _meta_index_name)
+        if cached_df is None and index_file != shared_index_file:
+            cached_df, cached_files = _read_meta_index(shared_index_file)
+    else:
+        cached_df, cached_files = None, dict()
+
+    # compare what we have on disk with what the index knows about
+    file_stats = dict()
+    for fp in files:
+        stat = os.stat(fp)
+        file_stats[fp] = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+    to_read = [
+        fp
+        for fp in files
+        if fp not in cached_files
+        or cached_files[fp]["size"] != file_stats[fp]["size"]
+        or cached_files[fp]["mtime_ns"] != file_stats[fp]["mtime_ns"]
+    ]
+    log.debug(f"{len(files) - len(to_read)} files in metadata index are up to date")
+
+    session_dfs = dict()
+    if cached_df is not None and len(cached_df) > 0:
+        session_dfs.update(
+            {fp: df for fp, df in cached_df.groupby("filepath", sort=False)}
+        )
 
-    for fp in tqdm(files, desc="Fetching metadata from sessions"):
-        try:
-            session_df = load_session(fp, meta_only=True)
-        except ValueError as e:
+    for fp, session_df in _crawl_session_metadata(to_read, workers=workers):
+        session_dfs.pop(fp, None)
+        file_stats[fp]["num_rows"] = 0
+        if session_df is None:
             log.info(f"Skipping {fp}. This might be a hdf5 file with no session data.")
             continue
-        meta_df.append(session_df)
+        session_dfs[fp] = session_df
+        file_stats[fp]["num_rows"] = len(session_df)
+
+    for fp in files:
+        if fp not in to_read:
+            file_stats[fp]["num_rows"] = cached_files[fp]["num_rows"]
+
+    # deterministic order, independent of what came from the index
+    meta_df = [session_dfs[fp] for fp in files if fp in session_dfs]
+    assert len(meta_df) > 0, f"Found no session data in {dir}"
 
     meta_df = pd.concat(meta_df, axis=0, ignore_index=True)
     # unit_ids are not unique, so lets avoid using them as the index.
     meta_df.reset_index(inplace=True, drop=True)
 
+    # only touch the index on disk if something changed
+    if use_index and (len(to_read) > 0 or set(cached_files.keys()) != set(files)):
+        _write_meta_index(index_file, meta_df, file_stats)
+
     _meta_df = meta_df.copy()
 
+    if compact:
+        meta_df = compact_dtypes(meta_df, inplace=True)
+
     return meta_df
 
 
 def load_session(
-    filepath, meta_only=False, pad_spikes_to=None, filter=None, as_dict=False
+    filepath,
+    meta_only=False,
+    pad_spikes_to=None,
+    filter=None,
+    as_dict=False,
+    as_xarray=True,
+    as_samples=False,
 ):
     """
     Load a single session as pandas dataframe (or a dictionary)
@@ -165,138 +271,173 @@ def load_session(
     filter : dict or None (default)
         only load keys that are in the given filters.
         e.g. `filter=dict(stimulus=["stim_1"], block=["block_1", "block_2"])`
+        other keys are applied to the metadata columns, and only the rows (units)
+        that match are read from disk. values can be list-like or a callable
+        that takes the column and returns a boolean mask, e.g.
+        `filter=dict(unit_id=[951013153], firing_rate=lambda fr: fr > 1.0)`
     meta_only (bool): if True, only load metadata, not spiketimes
     as_dict (bool): if True, return a dictionary instead of a dataframe.
     pad_spikes_to (int): if not None, pad the spiketimes with nan to this length.
         might help when merging xarrays, later.
+    as_xarray (bool): if False, skip creating the nan-padded "data" xarrays,
+        and only provide the "ragged" arrays. Only relevant with `as_dict=True`.
+    as_samples (bool): if True, the "ragged" values are int64 sample indices
+        instead of seconds, at the block's "sampling_rate". Implies `as_xarray=False`.
 
     # Returns
     meta_df (pandas.DataFrame): dataframe holding the metadata, OR:
     session_dict (dict): nested dictionary with the following structure:
         session_dict[session][stimulus][block][kind]
         kind is either "meta" (holding a pandas dataframe)
-        or "data" (holding a xarray DataArray with spiketimes)
+        or "data" (holding a xarray DataArray with spiketimes, nan-padded)
+        or "ragged" (holding a tuple `(values, offsets)`, spikes of the i-th unit
+        are `values[offsets[i]:offsets[i+1]]`)
+
+    # Notes
+    - Spiketimes of a block are stored either as a nan-padded 2d array
+        (`_spiketimes` key) or ragged: a flat `_spiketimes` array and an `_offsets`
+        array of length num_units + 1. Both layouts are read transparently.
+        See `convert_session_to_ragged`.
+    - Blocks can also hold bit-packed sample indices, which are decoded to
+        float64 seconds. See `convert_session_to_samples`.
+    - Blocks are either flat keys in the file root (`session_{session}_stimulus_
+        {stimulus}_stimulus_block_{block}_{kind}`) or groups
+        `/{session}/{stimulus}/{block}/` holding the `{kind}` datasets. With groups,
+        only the ones that match the filter are visited. See `convert_session_to_groups`.
     """
 
     session_dict = dict()
-    num_spikes = dict()
+    # spike rows to read, per block. None for all rows
+    block_rows = dict()
     if filter is None:
         filter = dict()
+    if as_samples:
+        as_xarray = False
 
-    # in my current implementation, we touch the file a bunch of times :/
+    # everything is read from one open file handle. this works for files that
+    # were not written in swmr mode, and avoids reopening on network drives.
     with h5py.File(filepath, "r") as f:
         # there should only be one session per file, but this makes it easier to handle, later
-        keys = list(f.keys())
-
-        # we want the number of spikes in the metadata, but they are in the spiketimes
-        # note that num_spikes is the max number of spikes any unit had in that block
-        # due to the nan-padding
-        for key in keys:
-            if key.endswith("_spiketimes"):
-                num_spikes[key.replace("_spiketimes", "")] = f[key].shape[1]
-
-    # start by loading the metadata and setting the directory structure
-    for key in keys:
-        # keys are specific for stimulus-block pairs, and come in pairs:
-        # one ending with _metadata (a panadas dataframe)
-        # one ending with _spiketimes (a nan-padded 2d array, nid x spikes)
-        if not key.endswith("_metadata"):
-            continue
-
-        parts = _key_to_parts(key)
-        session = parts["session"]
-        stimulus = parts["stimulus"]
-        block = parts["block"]
+        block_parts = dict()
 
-        # only continue if we match the filter criteria.
-        # filter looks like this: dict(session=["session_1"], block=["block_1", "block_2"])
-        if np.any([parts[k] not in v for k, v in filter.items() if k in parts]):
-            continue
-
-        if session not in session_dict:
-            session_dict[session] = dict()
-            # this becomes a problem when trying to get the metadata across all units
-            # session_dict[session]["_filepath"] = filepath
-
-        if stimulus not in session_dict[session]:
-            session_dict[session][stimulus] = dict()
-
-        if block not in session_dict[session][stimulus]:
-            session_dict[session][stimulus][block] = dict()
-
-        # load the metadata.
-        # pandas operates on the file -> have to open twice
-        # which will only work if we saved in swmr mode.
-        meta_df = pd.read_hdf(filepath, key=key.replace("_spiketimes", "_metadata"))
-        # set unit_id as index, but keep it as a column for convenience
-        meta_df.set_index("unit_id", inplace=True, drop=False)
-
-        meta_df["filepath"] = filepath
-
-        # we will later need the max number of spikes, so we can pad the arrays
-        meta_df["num_spikes"] = num_spikes[key.replace("_metadata", "")]
-        session_dict[session][stimulus][block]["meta"] = meta_df
+        # start by loading the metadata and setting the directory structure.
+        # every stimulus-block pair has a metadata frame and the spiketimes.
+        # only blocks that match the filter criteria are visited, e.g.
+        # filter looks like this: dict(session=[1], block=["block_1", "block_2"])
+        for parts, spikes_key in _iter_blocks(f, filter):
+            session = parts["session"]
+            stimulus = parts["stimulus"]
+            block = parts["block"]
 
-        # on the block level, units should be unique
-        assert len(meta_df) == len(meta_df["unit_id"].unique())
+            # load the metadata, pandas frame written with `to_hdf`
+            meta_df = _read_hdf_frame(f[_block_key(spikes_key, "metadata")])
+
+            # select units, so we only read the spikes we need
+            rows = _filter_rows(meta_df, filter)
+            if rows is not None:
+                if len(rows) == 0:
+                    continue
+                meta_df = meta_df.iloc[rows].copy()
+            block_rows[spikes_key] = rows
+            block_parts[spikes_key] = parts
+
+            if session not in session_dict:
+                session_dict[session] = dict()
+                # this becomes a problem when trying to get the metadata across all units
+                # session_dict[session]["_filepath"] = filepath
+
+            if stimulus not in session_dict[session]:
+                session_dict[session][stimulus] = dict()
+
+            if block not in session_dict[session][stimulus]:
+                session_dict[session][stimulus][block] = dict()
+
+            # set unit_id as index, but keep it as a column for convenience
+            meta_df.set_index("unit_id", inplace=True, drop=False)
+
+            meta_df["filepath"] = filepath
+
+            # we want the number of spikes in the metadata, but they are in the spiketimes
+            # note that num_spikes is the max number of spikes any unit had in that block
+            # due to the nan-padding. for ragged blocks, we get the actual number.
+            offsets = _read_offsets(f, spikes_key)
+            if "num_spikes" in meta_df.columns:
+                # per-unit stats were stored when writing
+                pass
+            elif offsets is None:
+                meta_df["num_spikes"] = f[spikes_key].shape[1]
+            else:
+                num_spikes = np.diff(offsets)
+                meta_df["num_spikes"] = num_spikes if rows is None else num_spikes[rows]
+
+            session_dict[session][stimulus][block]["meta"] = meta_df
+            # where to find the spikes of our units in the file, for lazy loading
+            session_dict[session][stimulus][block]["key"] = spikes_key
+            session_dict[session][stimulus][block]["rows"] = (
+                np.arange(len(meta_df)) if rows is None else rows
+            )
+            session_dict[session][stimulus][block]["offsets"] = offsets
+            session_dict[session][stimulus][block]["sampling_rate"] = _sampling_rate(
+                f[spikes_key]
+            )
 
-    if meta_only:
-        if as_dict:
-            return session_dict
-        else:
-            return _session_dict_to_df(session_dict)
+            # on the block level, units should be unique
+            assert len(meta_df) == len(meta_df["unit_id"].unique())
 
-    # now load the spiketimes
-    with h5py.File(filepath, "r") as f:
-        for key in keys:
-            if not key.endswith("_spiketimes"):
-                continue
+        if meta_only:
+            if as_dict:
+                return session_dict
+            else:
+                return _session_dict_to_df(session_dict)
 
-            parts = _key_to_parts(key)
+        # now load the spiketimes, blocks without selected units were skipped above
+        for key, parts in block_parts.items():
             session = parts["session"]
             stimulus = parts["stimulus"]
             block = parts["block"]
 
-            # check the filter
-            if np.any([parts[k] not in v for k, v in filter.items() if k in parts]):
-                continue
+            meta_df = session_dict[session][stimulus][block]["meta"]
 
-            # load data to ram, and convert to xarray so we can to conveniently
-            # index via unit_id
-            da = xr.DataArray(
-                data=f[key][:],
-                dims=["unit_id", "spiketimes"],
-                coords={"unit_id": meta_df.index.values},
-            )
-            # add the stimulus and block as dimensions, so we can later merge
-            da = da.expand_dims(
-                {"session": [session], "stimulus": [stimulus], "block": [block]}
+            # load data to ram
+            values, offsets = _read_ragged(
+                f, key, rows=block_rows[key], as_samples=as_samples
             )
-
-            if pad_spikes_to is not None and len(da["spiketimes"]) < pad_spikes_to:
-                # extend the dimesions to that length, so that it can be merged
-                # outside
-                # the xarray pad api is likely to change. written for version 2023.1.0
-                da = da.pad(
-                    spiketimes=(0, pad_spikes_to - len(da["spiketimes"])),
-                    mode="constant",
-                    constant_values=np.nan,
+            session_dict[session][stimulus][block]["ragged"] = (values, offsets)
+
+            if as_dict and as_xarray:
+                # convert to xarray so we can to conveniently index via unit_id
+                da = xr.DataArray(
+                    data=_ragged_to_padded(values, offsets),
+                    dims=["unit_id", "spiketimes"],
+                    coords={"unit_id": meta_df.index.values},
                 )
-
-            session_dict[session][stimulus][block]["data"] = da
-            # update num_spikes column in the metadata
-            for uid in session_dict[session][stimulus][block]["meta"]["unit_id"].unique():
-                session_dict[session][stimulus][block]["meta"].loc[uid, "num_spikes"] = (
-                    np.isfinite(da.sel(unit_id=uid)).sum().item()
+                # add the stimulus and block as dimensions, so we can later merge
+                da = da.expand_dims(
+                    {"session": [session], "stimulus": [stimulus], "block": [block]}
                 )
 
+                if pad_spikes_to is not None and len(da["spiketimes"]) < pad_spikes_to:
+                    # extend the dimesions to that length, so that it can be merged
+                    # outside
+                    # the xarray pad api is likely to change. written for version 2023.1.0
+                    da = da.pad(
+                        spiketimes=(0, pad_spikes_to - len(da["spiketimes"])),
+                        mode="constant",
+                        constant_values=np.nan,
+                    )
+
+                session_dict[session][stimulus][block]["data"] = da
+
+            # update num_spikes column in the metadata, rows are in the same order
+            meta_df["num_spikes"] = np.diff(offsets)
+
     if as_dict:
         return session_dict
     else:
         return _session_dict_to_df(session_dict)
 
 
-def load_spikes(meta_df, format="numpy"):
+def load_spikes(meta_df, format="numpy", lazy=False, mmap_dir=None):
     """
     After filtering the global index for desired untis / criteria,
     provide the filtered meta dataframe here, to load spiketimes as xarray,
@@ -311,10 +452,29 @@ def load_spikes(meta_df, format="numpy"):
 
     # Parameters
     meta_df (pd.DataFrame): filtered meta dataframe
-    format (str): "numpy" or "xarray".
+    format (str): "numpy", "xarray" or "samples".
         if "xarray", the spiketimes are loaded as xarray.DataArray and
-        have dimensions (session, stimulus, block, spiketimes).
-        with "numpy", you get a simple flat 1d array of the spiketimes.
+        have dimensions (session, stimulus, block, spiketimes), nan-padded.
+        with "numpy", you get a simple flat 1d array of the spiketimes, without
+        nan-padding.
+        with "samples", you get flat 1d int64 arrays of sample indices, and a
+        `sampling_rate` column. Pass it to `binned_spike_count(sampling_rate=...)`.
+        Exact for files written by `convert_session_to_samples`, otherwise the
+        seconds are rounded to `default_sampling_rate`.
+    lazy (bool): if True, do not read any spikes. Instead, the `spiketimes` column
+        holds a `SpikeHandle` per row, that is read on first access and kept in a
+        shared LRU cache (see `set_spike_cache_size`). `prepare_spike_times`,
+        `merge_blocks` and `binned_spike_count` accept handles, elsewhere use
+        `np.asarray(handle)` or `resolve_spikes(column)`.
+        With lazy, `num_spikes` and `recording_length` are kept from the metadata.
+        Only works with format="numpy".
+    mmap_dir (str or None): directory for uncompressed, memory-mapped copies
+        of the spike data. Filled once per session file (and updated when the file
+        changes). The `spiketimes` column then holds read-only views into the
+        mapping, and the os page cache is shared by all processes on a node.
+        default: None, use the module-wide `mmap_cache_dir` (see `set_mmap_cache_dir`)
+        which is None by default, reading from the hdf5 files.
+        Only works with format="numpy" and not with lazy.
 
     # Returns
     df : pd.DataFrame
@@ -333,23 +493,40 @@ def load_spikes(meta_df, format="numpy"):
     # there will be a lot of not-used indices (nans) requiring tons of ram.
     # instead: add an xr array as a column to the pandas dataframe
 
-    max_num_spikes = meta_df["num_spikes"].max()
-    sessions = meta_df["session"].unique()
+    if format not in ["xarray", "numpy", "samples"]:
+        raise ValueError(f"Unknown format {format}, use 'xarray', 'numpy' or 'samples'")
+    if lazy and format != "numpy":
+        raise ValueError("lazy loading only works with format='numpy'")
+
+    if mmap_dir is None:
+        mmap_dir = mmap_cache_dir
+    if mmap_dir is not None and (lazy or format != "numpy"):
+        raise ValueError("mmap_dir only works with format='numpy' and lazy=False")
+
     stimuli = meta_df["stimulus"].unique()
     blocks = meta_df["block"].unique()
     units = meta_df["unit_id"].unique()
     files = meta_df["filepath"].unique()
 
-    res_df = meta_df.copy()
-    # add column to hold objects (arrays)
-    res_df["spiketimes"] = None
-    res_df["spiketimes"] = res_df["spiketimes"].astype(object)
+    res_df = meta_df.reset_index(drop=True)
+    res_units = res_df["unit_id"].to_numpy()
 
-    res_df.set_index(["session", "stimulus", "block", "unit_id"], inplace=True, drop=True)
+    # positions of our rows, for every block of every file. the block-level
+    # data is then matched to these positions in one go, via get_indexer.
+    block_rows = res_df.groupby(
+        ["filepath", "stimulus", "block"], sort=False, observed=True
+    ).indices
+
+    # columns we fill
+    spiketimes = np.empty(len(res_df), dtype=object)
+    num_spikes = np.zeros(len(res_df), dtype=np.int64)
+    recording_length = np.zeros(len(res_df), dtype=np.float64)
+    sampling_rate = np.zeros(len(res_df), dtype=np.float64)
+    loaded = np.zeros(len(res_df), dtype=bool)
 
     filter = dict(
-        # lets try to be smart with the filtering. units: no!
-        # sessions neither, as we iterate them.
+        # lets try to be smart with the filtering.
+        # sessions not, as we iterate them. units per file, below.
         # blocks and stimuli are sensible.
         stimulus=list(stimuli),
         block=list(blocks),
@@ -359,74 +536,270 @@ def load_spikes(meta_df, format="numpy"):
         f"Loading spikes for {len(units)} units, {len(res_df)} rows for pandas dataframe."
     )
 
-    # create an empty datarray with our known coordinates
-    num_rows = 0
-
     for fdx, file in enumerate(tqdm(files, desc="Loading spikes for sessions")):
-        session_dict = load_session(file, filter=filter, as_dict=True)
+        # only read the rows of units that we need
+        filter["unit_id"] = meta_df.loc[meta_df["filepath"] == file, "unit_id"].unique()
+        session_dict = load_session(
+            file,
+            filter=filter,
+            as_dict=True,
+            as_xarray=(format == "xarray"),
+            as_samples=(format == "samples"),
+            meta_only=lazy or mmap_dir is not None,
+        )
+        if mmap_dir is not None:
+            mmapped = _mmap_session(file, mmap_dir)
 
-        # iterate the dict, find out where to put each units dataframe.
+        # iterate the dict, find out where to put each block
         session = list(session_dict.keys())[0]
         sd = session_dict[session]
         for stim in sd.keys():
             for block in sd[stim].keys():
-                da = sd[stim][block]["data"]
-                for unit in da["unit_id"].values:
-                    index = (session, stim, block, unit)
-                    if not index in res_df.index:
-                        continue
+                rows = block_rows.get((file, stim, block))
+                if rows is None:
+                    continue
+
+                # position of each of our rows in the block
+                block_units = sd[stim][block]["meta"]["unit_id"].to_numpy()
+                pos = pd.Index(block_units).get_indexer(res_units[rows])
+                found = pos >= 0
+                rows, pos = rows[found], pos[found]
+                loaded[rows] = True
+
+                if lazy:
+                    spiketimes[rows] = _block_handles(file, sd[stim][block])[pos]
+                    continue
+
+                if mmap_dir is not None:
+                    # all units of the block are mapped, select ours.
+                    # this only touches the pages of first and last spikes.
+                    values, offsets = mmapped[sd[stim][block]["key"]]
+                    file_rows = sd[stim][block]["rows"]
+                    block_num_spikes, t_first, t_last = [
+                        x[file_rows] for x in _ragged_stats(values, offsets)
+                    ]
+                    values = _object_array(
+                        [values[offsets[r] : offsets[r + 1]] for r in file_rows]
+                    )
+                else:
+                    values, offsets = sd[stim][block]["ragged"]
+                    block_num_spikes, t_first, t_last = _ragged_stats(values, offsets)
+                if format == "samples":
+                    block_rate = sd[stim][block]["sampling_rate"]
+                    sampling_rate[rows] = block_rate
+                    t_first, t_last = t_first / block_rate, t_last / block_rate
+                num_spikes[rows] = block_num_spikes[pos]
+                recording_length[rows] = np.where(
+                    block_num_spikes > 1, t_last - t_first, 0.0
+                )[pos]
+
+                if mmap_dir is not None:
+                    spiketimes[rows] = values[pos]
+                elif format in ["numpy", "samples"]:
+                    # views into the flat block array, no copies
+                    spiketimes[rows] = _ragged_to_object_array(values, offsets)[pos]
+                else:
+                    da = sd[stim][block]["data"]
+                    for row, p in zip(rows, pos):
+                        spiketimes[row] = da.isel(unit_id=p)
+
+    if not loaded.all():
+        raise ValueError(f"Loaded {loaded.sum()} rows, but expected {len(res_df)}")
+
+    if not lazy:
+        res_df["num_spikes"] = num_spikes
+        res_df["recording_length"] = recording_length
+    if format == "samples":
+        res_df["sampling_rate"] = sampling_rate
+    # add column to hold objects (arrays)
+    res_df["spiketimes"] = pd.Series(spiketimes, index=res_df.index, dtype=object)
+
+    # same column order as we had in the past: the block-level index first
+    index_cols = ["session", "stimulus", "block", "unit_id"]
+    res_df = res_df[index_cols + [c for c in res_df.columns if c not in index_cols]]
 
-                    # assign data to df, and update the num_spikes column
-                    arr = da.sel(unit_id=unit)
-                    squeezed = arr.squeeze()
-                    if len(squeezed.shape) != 1:
-                        log.warning("spiketimes should have one variable dimension")
-
-                    num_spikes = np.isfinite(squeezed).sum().item()
-                    res_df.loc[index, "num_spikes"] = num_spikes
-                    if num_spikes > 1:
-                        res_df.loc[index, "recording_length"] = (
-                            squeezed[num_spikes - 1] - squeezed[0]
-                        ).item()
-                    else:
-                        res_df.loc[index, "recording_length"] = 0.0
-
-                    if format == "xarray":
-                        res_df.at[index, "spiketimes"] = arr
-                    elif format == "numpy":
-                        # we use the .at[] method instead of .loc[] to be able to set
-                        # cells to iterables.
-                        # https://stackoverflow.com/questions/13842088/set-value-for-particular-cell-in-pandas-dataframe-using-index
-                        res_df.at[index, "spiketimes"] = arr.values.flatten()
-                    else:
-                        raise ValueError(
-                            f"Unknown format {format}, use 'xarray' or 'numpy'"
-                        )
-
-                    num_rows += 1
-
-    if not num_rows == len(res_df):
-        raise ValueError(f"Loaded {num_rows} rows, but expected {len(res_df)}")
-
-    # we dropped the columns above, so here we need to re-insert by drop=False
-    res_df.reset_index(inplace=True, drop=False)
     return res_df
 
 
-def default_filter(meta_df, trim=True, inplace=False):
+def iter_units(meta_df, prepare=True, merge=True, read_ahead=1, **load_kwargs):
+    """
+    Generator to analyse units with memory proportional to one session.
+    Loads the spikes of one session (file) at a time, applies
+    `prepare_spike_times` and `merge_blocks`, and yields the units.
+
+    # Example
+    ```
+    meta_df = utl.all_unit_metadata()
+    meta_df = utl.default_filter(meta_df, trim=False)
+    for row, spikes in utl.iter_units(meta_df, read_ahead=2):
+        result = analyse(spikes)
+    ```
+
+    # Parameters
+    meta_df : filtered meta dataframe, as for `load_spikes`
+    prepare : bool, call `prepare_spike_times` for each row (default: True)
+    merge : bool, call `merge_blocks` for each session (default: True).
+        with merge, only the merged rows are yielded.
+    read_ahead : int, number of sessions to load in the background while the
+        current one is being consumed. 0 to load only when needed.
+    load_kwargs : passed to `load_spikes`, e.g. `mmap_dir`
+
+    # Yields
+    row : pd.Series, the metadata (without the `spiketimes` column)
+    spikes : 1d numpy array, spiketimes
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    files = meta_df["filepath"].unique()
+
+    def load(file):
+        df = load_spikes(meta_df[meta_df["filepath"] == file], **load_kwargs)
+        spikes = None
+        if prepare:
+            spikes = prepare_spike_times_batch(df["spiketimes"], df["stimulus"])
+        if merge:
+            df = merge_blocks(df, inplace=False, spikes=spikes)
+        elif spikes is not None:
+            df["spiketimes"] = _ragged_to_object_array(*spikes)
+            _refresh_spike_stats(df, *spikes)
+        return df
+
+    with ThreadPoolExecutor(max_workers=max(read_ahead, 1)) as executor:
+        futures = []
+        for fdx, file in enumerate(files):
+            # keep `read_ahead` sessions in flight, beyond the current one
+            while len(futures) <= read_ahead and fdx + len(futures) < len(files):
+                futures.append(executor.submit(load, files[fdx + len(futures)]))
+
+            df = futures.pop(0).result()
+            for _, row in df.iterrows():
+                yield row.drop("spiketimes"), row["spiketimes"]
+            del df
+
+
+def _qc_recording_length(meta_df):
+    # with per-unit stats in the metadata, we know the exact duration from first
+    # to last spike, which is what `prepare_spike_times` checks.
+    if "t_first" in meta_df.columns and "t_last" in meta_df.columns:
+        return (meta_df["t_last"] - meta_df["t_first"]).fillna(0.0)
+    return meta_df["recording_length"]
+
+
+def _qc_rate(meta_df):
+    # We find a minimal firing rate of approximately 0.02 Hz and a maximal firing rate of approximately 90 Hz, with 95\% of firing rates in the range of 0.19 Hz to 21.11 Hz. The highest firing rates are certainly biologically implausible, but units with these values are few so that they should not distort results in any significant way\
+    # This check effectively filters units without _any_ spiking
+    return meta_df["firing_rate"] < 0.01
+
+
+def _qc_empty(meta_df):
+    return _qc_recording_length(meta_df) == 0
+
+
+def _qc_stationarity(meta_df, max_rel_diff=0.5):
+    # group by units and stimuli, and if the stim has two blocks,
+    # check that the rate is not too far off between blocks.
+    # both blocks of a unit get rejected.
+    grouped = meta_df.groupby(["unit_id", "stimulus"], observed=True, sort=False)[
+        "firing_rate"
+    ]
+    num_blocks = grouped.transform("size")
+    fr_lo = grouped.transform("min").astype(np.float64)
+    fr_hi = grouped.transform("max").astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rel_diff = (fr_hi - fr_lo) / ((fr_hi + fr_lo) / 2)
+    return (num_blocks == 2) & (rel_diff > max_rel_diff)
+
+
+def _qc_duration(meta_df):
+    # we calculated recording durations from first to last spike.
+    # FC are around ~900 seconds, BO ~600, and we allow ~30 sec tolerance.
+    # these are the same minimal lengths that `prepare_spike_times` requires.
+    min_len = (
+        meta_df["stimulus"]
+        .astype(object)
+        .map({stim: lengths[0] for stim, lengths in prepare_lengths.items()})
+        .astype(np.float64)
+    )
+    return _qc_recording_length(meta_df) < min_len
+
+
+# rules of the quality control, in order of precedence: if a row fails several
+# rules, the status of the last one ends up in `invalid_spiketimes_check`.
+# name: (status, function taking the metadata frame and returning a mask of rejects)
+qc_rules = {
+    "rate": ("ERR_LO_FIR_RATE", _qc_rate),
+    "empty": ("ERR_EMPTY", _qc_empty),
+    "stationarity": ("ERR_STATIONARITY", _qc_stationarity),
+    "duration": ("ERR_REC_LEN", _qc_duration),
+}
+
+
+def quality_masks(meta_df, rules=None):
+    """
+    Evaluate quality-control rules on the metadata frame, without modifying it.
+
+    # Parameters
+    meta_df: the metadata dataframe
+    rules : list of rule names from `qc_rules`, default None uses all of them.
+
+    # Returns
+    masks : DataFrame with one boolean column per rule (same index as `meta_df`),
+        True where the row is rejected by the rule.
+    """
+    if rules is None:
+        rules = list(qc_rules.keys())
+
+    masks = pd.DataFrame(index=meta_df.index)
+    for rule in rules:
+        _, func = qc_rules[rule]
+        masks[rule] = np.asarray(func(meta_df), dtype=bool)
+    return masks
+
+
+def quality_summary(meta_df):
+    """
+    Per-stimulus table of how many rows were rejected with which status.
+    Expects the `invalid_spiketimes_check` column as set by `default_filter`.
+
+    # Returns
+    summary : DataFrame indexed by stimulus, with columns `num_total`,
+        one count column per status other than `SUCCESS`, and `num_valid`.
+    """
+    status = meta_df["invalid_spiketimes_check"].astype(object)
+    stimulus = meta_df["stimulus"].astype(object)
+    summary = pd.crosstab(stimulus, status)
+    summary.columns.name = None
+    if "SUCCESS" not in summary.columns:
+        summary["SUCCESS"] = 0
+    num_valid = summary.pop("SUCCESS")
+    summary.insert(0, "num_total", summary.sum(axis=1) + num_valid)
+    summary["num_valid"] = num_valid
+    return summary
+
+
+def default_filter(meta_df, trim=True, inplace=False, rules=None):
     """
     Apply our default set of quality controls to the metadata frame.
 
+    All rules are evaluated as boolean masks (see `quality_masks`), and rejected
+    rows get the status of the last rule (in order of `qc_rules`) that they failed.
+
     # Parameters
     meta_df: the metadata dataframe
-    min_rec_len: in seconds
-        rows where the `recording_length` column is less than this get `ERR_REC_LEN`
     inplace : default False, returning a copy.
     trim : if True (default)
         remove rows that failed the quality checks.
         to get the full-length dataframe, set to False, and
         this will update the `invalid_spiketimes_check` column. Then you can query like:
         `meta_df.query("invalid_spiketimes_check == 'SUCCESS'")`
+    rules : list of rule names from `qc_rules`, default None uses all of them:
+        - `rate`: firing rate below 0.01 Hz -> `ERR_LO_FIR_RATE`
+        - `empty`: zero recording length -> `ERR_EMPTY`
+        - `stationarity`: the rates of the two blocks of a unit and stimulus
+            differ by more than 50% of their mean -> `ERR_STATIONARITY`
+        - `duration`: recording length shorter than the minimum from
+            `prepare_lengths` -> `ERR_REC_LEN`
 
     # Returns
     meta_df: the modified dataframe
@@ -436,75 +809,40 @@ def default_filter(meta_df, trim=True, inplace=False):
     if not inplace:
         meta_df = meta_df.copy()
 
-    _num_no_success = len(meta_df.query("invalid_spiketimes_check != 'SUCCESS'"))
+    status_col = meta_df["invalid_spiketimes_check"]
+    _num_no_success = int((status_col != "SUCCESS").sum())
     if _num_no_success > 0:
         log.warning(
             f"{_num_no_success} rows already have values other than `SUCCESS` in the"
             " `invalid_spiketimes_check`. We overwrite them."
         )
-        meta_df["invalid_spiketimes_check"] = "SUCCESS"
 
-    def _num_good(df):
-        return len(df.query("invalid_spiketimes_check == 'SUCCESS'"))
+    log.debug(f"Default quality checks, valid rows before: {len(meta_df)}")
 
-    log.debug(f"Default quality checks, valid rows before: {_num_good(meta_df)}")
+    masks = quality_masks(meta_df, rules)
+    for rule in masks.columns:
+        log.debug(f"Rule {rule} rejects {masks[rule].sum()} rows")
 
-    # We find a minimal firing rate of approximately 0.02 Hz and a maximal firing rate of approximately 90 Hz, with 95\% of firing rates in the range of 0.19 Hz to 21.11 Hz. The highest firing rates are certainly biologically implausible, but units with these values are few so that they should not distort results in any significant way\
-    # This check effectively filters units without _any_ spiking
-    meta_df.loc[
-        meta_df["firing_rate"] < 0.01, "invalid_spiketimes_check"
-    ] = "ERR_LO_FIR_RATE"
-    log.debug(f"After rate check: {_num_good(meta_df)}")
-
-    meta_df.loc[
-        meta_df["recording_length"] == 0, "invalid_spiketimes_check"
-    ] = "ERR_EMPTY"
-    log.debug(f"After zero-length check: {_num_good(meta_df)}")
+    # last failing rule wins, in a single pass over the mask matrix
+    failed = masks.to_numpy()
+    statuses = np.array(
+        [qc_rules[rule][0] for rule in masks.columns] + ["SUCCESS"], dtype=object
+    )
+    last = failed.shape[1] - 1 - np.argmax(failed[:, ::-1], axis=1)
+    last[~failed.any(axis=1)] = len(statuses) - 1
+    status = statuses[last]
 
-    # stationarity.
-    # group by units and stimuli, and if the stim has two blocks,
-    # check that the rate is not too far off between blocks
-    # requires "neutral" index
-
-    # including stationarity checks did not change results.
-    # for (unit_id, stimulus), df in tqdm(
-    #     meta_df.groupby(["unit_id", "stimulus"]), desc="Stationarity check"
-    # ):
-    #     if len(df) < 2:
-    #         continue
-
-    #     # get the firing rate for the first and second block
-    #     fr1 = df.iloc[0]["firing_rate"]
-    #     fr2 = df.iloc[1]["firing_rate"]
-
-    #     # if the difference is too big, mark the unit as invalid
-    #     if abs(fr1 - fr2) / np.mean([fr1, fr2]) > 0.5:
-    #         meta_df.loc[
-    #             (unit_id, stimulus), "invalid_spiketimes_check"
-    #         ] = "ERR_STATIONARITY"
-    # log.debug(f"After stationarity check: {_num_good(meta_df)}")
-
-    # duration
-    idx = meta_df.query(
-        # we calculated recording durations from first to last spike.
-        # FC are around ~900 seconds, BO ~600, and we allow ~30 sec tolerance
-        f"(stimulus == 'spontaneous' & recording_length < 870) |"
-        + f"(stimulus == 'natural_movie_one_more_repeats' & recording_length < 870) |"
-        + f"(stimulus == 'natural_movie_three' & recording_length < 570)",
-    ).index
-    meta_df.loc[idx, "invalid_spiketimes_check"] = "ERR_REC_LEN"
-    log.debug(f"After minmum-duration check: {_num_good(meta_df)}")
+    if isinstance(status_col.dtype, pd.CategoricalDtype):
+        categories = list(status_col.cat.categories)
+        categories += [s for s in statuses if s not in categories]
+        status = pd.Categorical(status, categories=categories)
+    meta_df["invalid_spiketimes_check"] = status
 
     # how many units did we exclude per stimulus?
-    for stim in meta_df["stimulus"].unique():
-        num_total = len(meta_df.query(f"stimulus == '{stim}'"))
-        num_bad = len(
-            meta_df.query(f"stimulus == '{stim}' & invalid_spiketimes_check != 'SUCCESS'")
-        )
-        log.debug(f"Excluded {num_bad} / {num_total} units for stimulus {stim}")
+    log.debug(f"Excluded units per stimulus:\n{quality_summary(meta_df)}")
 
     if trim:
-        meta_df = meta_df.query("invalid_spiketimes_check == 'SUCCESS'")
+        meta_df = meta_df[meta_df["invalid_spiketimes_check"] == "SUCCESS"]
 
     return meta_df
 
@@ -512,6 +850,7 @@ def default_filter(meta_df, trim=True, inplace=False):
 def merge_blocks(
     meta_df,
     inplace=False,
+    spikes=None,
 ):
     """
     Merge the spiking data from two blocks (for those stimuli that have two blocks).
@@ -519,6 +858,9 @@ def merge_blocks(
 
     # Parameters
     meta_df: the metadata dataframe, data already loaded, checks performed.
+    spikes: tuple `(values, offsets)` or None.
+        ragged spiketimes of the rows of meta_df, e.g. from
+        `prepare_spike_times_batch`, used instead of the `spiketimes` column.
 
     # Returns
     meta_df: dataframe that only holds the now merged blocks (inplace=False, default)
@@ -526,77 +868,52 @@ def merge_blocks(
 
     """
 
-    new_rows = []
-    dropped_units = 0
-
     if not inplace:
         meta_df = meta_df.copy()
 
-    assert "spiketimes" in meta_df.columns, "call `load_spikes` first"
-
-    try:
-        groupby = meta_df.groupby(["session", "stimulus", "unit_id"])
-    except ValueError:
-        # this happens when the index is set to unit_id (and unit_id is still a column)
-        # resetting is not great, it will modify the outer df which seems unexpected.
-        meta_df = meta_df.reset_index(drop=True)
-        groupby = meta_df.groupby(["session", "stimulus", "unit_id"])
-
-    for df_idx, df in tqdm(groupby, desc="Merging blocks for units", total=len(groupby)):
-        if len(df) == 1:
-            # the unit was only recorded in one block
-            dropped_units += 1
-            continue
-        elif len(df) != 2:
-            raise ValueError("Expected two blocks for each stimulus")
-
-        try:
-            # squeeze effectively gets rid of len-1 dimensions
-            spikes1 = df.iloc[0]["spiketimes"].copy().squeeze()
-            spikes2 = df.iloc[1]["spiketimes"].copy().squeeze()
-
-            # remove the nan-padding
-            spikes1 = spikes1[np.isfinite(spikes1)]
-            spikes2 = spikes2[np.isfinite(spikes2)]
-
-            # align second spike train to the end of the first
-            # Note: in prepare_spike_times we align to zero before removing
-            # the transient period. Hence, we can merge the blocks here
-            # without accidentally creating simultaneous spikes.
-            spikes2 = spikes2 + spikes1[-1]
-
-            # assign the new coordinates (block) to xarray
-            new_block = f"merged_{df.iloc[0]['block']}_and_{df.iloc[1]['block']}"
-            try:
-                # xarray
-                spikes1.coords["block"] = new_block
-                spikes2.coords["block"] = new_block
-                spikes = xr.concat([spikes1, spikes2], dim="spiketimes")
-            except AttributeError:
-                # 1d numpy
-                assert len(spikes1.shape) == 1
-                assert len(spikes2.shape) == 1
-                spikes = np.concatenate([spikes1, spikes2])
-
-            # create the new row, updating columns
-            new_row = df.iloc[0].copy()
-            new_row["spiketimes"] = spikes
-            new_row["block"] = new_block
-            new_row["num_spikes"] = len(spikes)
-            try:
-                new_row["recording_length"] = (spikes[-1] - spikes[0]).values[()]
-            except:
-                new_row["recording_length"] = spikes[-1] - spikes[0]
-            new_row["firing_rate"] = len(spikes) / new_row["recording_length"]
-            new_rows.append(new_row)
-
-        except IndexError:
-            # if the unit has bad spike times or is shorter than our target lengths...
-            # log.debug(f"Unit {df.iloc[0]['unit_id']} could not be merged.")
-            dropped_units += 1
-            continue
+    if spikes is None:
+        assert "spiketimes" in meta_df.columns, "call `load_spikes` first"
+    elif len(spikes[1]) != len(meta_df) + 1:
+        raise ValueError("Need one spike train per row of meta_df")
+
+    # lazy loading: read all spikes at once, grouped by file
+    if spikes is None and np.any(
+        [isinstance(st, SpikeHandle) for st in meta_df["spiketimes"]]
+    ):
+        resolved = _object_array(resolve_spikes(meta_df["spiketimes"]))
+        meta_df = meta_df.assign(spiketimes=resolved)
+
+    # pair the blocks of each unit and stimulus. a stable sort keeps the order
+    # of the blocks within the frame, and gives the order of a sorted groupby.
+    sessions = meta_df["session"].to_numpy()
+    stimuli = pd.factorize(meta_df["stimulus"], sort=True)[0]
+    units = meta_df["unit_id"].to_numpy()
+    order = np.lexsort((units, stimuli, sessions))
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = (
+        (np.diff(sessions[order]) != 0)
+        | (np.diff(stimuli[order]) != 0)
+        | (np.diff(units[order]) != 0)
+    )
+    starts = np.flatnonzero(new_group)
+    sizes = np.diff(np.r_[starts, len(order)])
+
+    if np.any(sizes > 2):
+        raise ValueError("Expected two blocks for each stimulus")
+    # units that were only recorded in one block are dropped
+    first = order[starts[sizes == 2]]
+    second = order[starts[sizes == 2] + 1]
+
+    if spikes is None and np.any(
+        [isinstance(st, xr.DataArray) for st in meta_df["spiketimes"]]
+    ):
+        res_df, dropped_units = _merge_blocks_xarray(meta_df, first, second)
+    else:
+        if spikes is None:
+            spikes = _spikes_to_ragged(meta_df["spiketimes"].to_numpy())
+        res_df, dropped_units = _merge_blocks_numpy(meta_df, first, second, *spikes)
+    dropped_units += np.sum(sizes == 1)
 
-    res_df = pd.DataFrame(new_rows)
     log.debug(
         f"Did not merge {dropped_units} units (failed criteria)."
         f" {len(res_df['unit_id'].unique())} units remained."
@@ -611,7 +928,168 @@ def merge_blocks(
     return meta_df
 
 
-def prepare_spike_times(spikes, stimulus: str):
+def _merge_blocks_numpy(meta_df, first, second, values, offsets):
+    """
+    Merge the spike trains at positions `first` and `second` of meta_df,
+    pairwise, by concatenating ragged arrays. See `merge_blocks`.
+
+    # Parameters
+    values, offsets : ragged spiketimes of all rows of meta_df
+
+    # Returns
+    res_df : one row per merged pair, based on the row of the first block
+    dropped : number of pairs that could not be merged
+    """
+    counts = np.diff(offsets)
+
+    # without spikes in the first block, there is nothing to align to.
+    # this happens if the unit has bad spike times or is shorter than our
+    # target lengths (see `prepare_spike_times`)
+    keep = counts[first] > 0
+    first, second = first[keep], second[keep]
+    num1, num2 = counts[first], counts[second]
+    values1 = values[_ragged_positions(offsets[first], num1)]
+    values2 = values[_ragged_positions(offsets[second], num2)]
+    last1 = values[offsets[first + 1] - 1]
+
+    # align second spike train to the end of the first
+    # Note: in prepare_spike_times we align to zero before removing
+    # the transient period. Hence, we can merge the blocks here
+    # without accidentally creating simultaneous spikes.
+    values2 = values2 + np.repeat(last1, num2).astype(values2.dtype)
+
+    # interleave: first block, then second block, for every unit
+    num_spikes = num1 + num2
+    offsets = np.zeros(len(num_spikes) + 1, dtype=np.int64)
+    np.cumsum(num_spikes, out=offsets[1:])
+    values = np.empty(offsets[-1], dtype=np.result_type(values1, values2))
+    values[_ragged_positions(offsets[:-1], num1)] = values1
+    values[_ragged_positions(offsets[:-1] + num1, num2)] = values2
+
+    recording_length = values[offsets[1:] - 1] - values[offsets[:-1]]
+    with np.errstate(divide="ignore"):
+        firing_rate = num_spikes.astype(values.dtype) / recording_length
+
+    # create the new rows, updating columns
+    res_df = meta_df.iloc[first].copy()
+    blocks1 = meta_df["block"].to_numpy()[first].astype(str)
+    blocks2 = meta_df["block"].to_numpy()[second].astype(str)
+    res_df["spiketimes"] = _ragged_to_object_array(values, offsets)
+    res_df["block"] = np.char.add(
+        np.char.add(np.char.add("merged_", blocks1), "_and_"), blocks2
+    ).astype(object)
+    res_df["num_spikes"] = num_spikes
+    res_df["recording_length"] = recording_length
+    res_df["firing_rate"] = firing_rate
+    _refresh_spike_stats(res_df, values, offsets)
+
+    return res_df, np.sum(~keep)
+
+
+def _merge_blocks_xarray(meta_df, first, second):
+    """
+    `_merge_blocks_numpy` for xarray spike trains, unit by unit, so that the
+    merged trains get the new block as coordinate.
+    """
+    new_rows = []
+    dropped = 0
+    for idx1, idx2 in zip(first, second):
+        # squeeze effectively gets rid of len-1 dimensions
+        spikes1 = meta_df["spiketimes"].iloc[idx1].copy().squeeze()
+        spikes2 = meta_df["spiketimes"].iloc[idx2].copy().squeeze()
+
+        # remove the nan-padding
+        spikes1 = spikes1[np.isfinite(spikes1)]
+        spikes2 = spikes2[np.isfinite(spikes2)]
+        if len(spikes1) == 0:
+            dropped += 1
+            continue
+
+        spikes2 = spikes2 + spikes1[-1]
+
+        # assign the new coordinates (block) to xarray
+        new_block = (
+            f"merged_{meta_df['block'].iloc[idx1]}_and_{meta_df['block'].iloc[idx2]}"
+        )
+        spikes1.coords["block"] = new_block
+        spikes2.coords["block"] = new_block
+        spikes = xr.concat([spikes1, spikes2], dim="spiketimes")
+
+        # create the new row, updating columns
+        new_row = meta_df.iloc[idx1].copy()
+        new_row["spiketimes"] = spikes
+        new_row["block"] = new_block
+        new_row["num_spikes"] = len(spikes)
+        new_row["recording_length"] = (spikes[-1] - spikes[0]).values[()]
+        new_row["firing_rate"] = len(spikes) / new_row["recording_length"]
+        new_rows.append(new_row)
+
+    res_df = pd.DataFrame(new_rows, columns=meta_df.columns)
+    _refresh_spike_stats(res_df, *_spikes_to_ragged(res_df["spiketimes"]))
+    return res_df, dropped
+
+
+def _refresh_spike_stats(df, values, offsets):
+    """
+    Recompute the per-unit stats columns (see `_unit_spike_stats`) that `df`
+    has, from its new ragged spiketimes, e.g. after merging or preparing.
+    Otherwise they would still describe the blocks as stored on disk.
+    Modifies `df` in place, keeping the dtypes of its columns.
+    """
+    cols = [c for c in _spike_stat_columns if c in df.columns]
+    if len(cols) == 0:
+        return
+    stats = _unit_spike_stats(values, offsets)
+    for col in cols:
+        df[col] = stats[col].astype(df[col].dtype)
+
+
+def _spikes_to_ragged(spikes):
+    """
+    Flat values and offsets from an iterable of 1d spike trains,
+    nan-padding is removed.
+    """
+    spikes = [np.asarray(st).reshape(-1) for st in spikes]
+    offsets = np.zeros(len(spikes) + 1, dtype=np.int64)
+    np.cumsum([len(st) for st in spikes], out=offsets[1:])
+    if len(spikes) == 0:
+        return np.zeros(0), offsets
+    values = np.concatenate(spikes)
+
+    finite = np.isfinite(values)
+    if not finite.all():
+        num_finite = np.zeros(len(finite) + 1, dtype=np.int64)
+        np.cumsum(finite, out=num_finite[1:])
+        offsets = num_finite[offsets]
+        values = values[finite]
+    return values, offsets
+
+
+def _ragged_positions(starts, counts):
+    """
+    Flat indices `starts[i] + arange(counts[i])` for all i, concatenated.
+    """
+    total = np.sum(counts)
+    pos = np.arange(total, dtype=np.int64)
+    begins = np.zeros(len(counts), dtype=np.int64)
+    np.cumsum(counts[:-1], out=begins[1:])
+    return pos + np.repeat(starts - begins, counts)
+
+
+# preprocessing of spike times, per stimulus, in seconds:
+# (min_len, max_output_len, transient_length)
+# see `prepare_spike_times`. Change the entries here, or pass `lengths`.
+prepare_lengths = {
+    # Functional connectivity
+    "spontaneous": (870, 840, 60),
+    "natural_movie_one_more_repeats": (870, 840, 60),
+    # Brain observatory
+    "natural_movie_three": (570, 540, 60),
+    "spontaneous_for_merged": (870 * 2, 840 * 2, 60),
+}
+
+
+def prepare_spike_times(spikes, stimulus: str, lengths=None):
     """
     applies our default spike-time preprocessing, which depends
     on the experiment type (stimulus).
@@ -621,9 +1099,12 @@ def prepare_spike_times(spikes, stimulus: str):
     'spont' (FC) require 870, remove first 60, limit output duration to 840
 
     # Parameters
-    spikes : np.ndarray or xarray.DataArray
+    spikes : np.ndarray or xarray.DataArray or SpikeHandle
     stimulus : str,
         one of "spontaneous", "natural_movie_one_more_repeats", "natural_movie_three"
+    lengths : dict or None,
+        stimulus -> (min_len, max_output_len, transient_length).
+        default: None, use the module-level `prepare_lengths`
 
     # Returns
     a flat 1d numpy array or an xarray holding the spiketimes.
@@ -636,27 +1117,9 @@ def prepare_spike_times(spikes, stimulus: str):
     ```
     """
 
-    if stimulus.lower() in ["spontaneous", "natural_movie_one_more_repeats"]:
-        # Functional connectivity
-        min_len = 870
-        max_output_len = 840
-        transient_length = 60
-    elif stimulus.lower() == "natural_movie_three":
-        # Brain observatory
-        min_len = 570
-        max_output_len = 540
-        transient_length = 60
-    elif stimulus.lower() == "spontaneous_for_merged":
-        min_len = 870*2
-        max_output_len = 840*2
-        transient_length = 60
-    else:
-        raise ValueError(
-            f"Unknown stimulus {stimulus}, known values are: 'spontaneous',"
-            " 'natural_movie_one_more_repeats', 'natural_movie_three'"
-        )
+    min_len, max_output_len, transient_length = _lengths_for(stimulus, lengths)
 
-    spikes = spikes.copy().squeeze()
+    spikes = _resolve_spikes(spikes).copy().squeeze()
 
     # remove the nan-padding
     spikes = spikes[np.isfinite(spikes)]
@@ -679,12 +1142,156 @@ def prepare_spike_times(spikes, stimulus: str):
     return spikes
 
 
+def prepare_spike_times_batch(spikes, stimuli, lengths=None):
+    """
+    `prepare_spike_times` for many spike trains at once, working on one flat
+    array instead of one array per unit. Gives the same spikes.
+
+    # Example
+    ```
+    spikes = utl.prepare_spike_times_batch(df["spiketimes"], df["stimulus"])
+    merged_df = utl.merge_blocks(df, spikes=spikes)
+    ```
+
+    # Parameters
+    spikes : iterable of 1d arrays (e.g. the `spiketimes` column) or a tuple
+        `(values, offsets)` of ragged spiketimes, the i-th train being
+        `values[offsets[i]:offsets[i+1]]`
+    stimuli : iterable of str, one stimulus per spike train
+    lengths : dict or None, see `prepare_spike_times`
+
+    # Returns
+    values, offsets : ragged spiketimes after preprocessing. trains that failed
+        the checks have no spikes.
+    """
+    if isinstance(spikes, tuple):
+        values, offsets = spikes
+        values = np.asarray(values)
+        offsets = np.asarray(offsets, dtype=np.int64)
+    else:
+        values, offsets = _spikes_to_ragged(resolve_spikes(spikes))
+
+    # per-train lengths, looked up once per stimulus
+    stim_codes, stim_names = pd.factorize(np.asarray(stimuli, dtype=object))
+    table = np.array(
+        [_lengths_for(stim, lengths) for stim in stim_names], dtype=np.float64
+    ).reshape(-1, 3)
+    min_len, max_output_len, transient_length = table[stim_codes].T
+
+    num_spikes, t_first, t_last = _ragged_stats(values, offsets)
+    # if one of the blocks is shorter than min_len_per_block, discard it
+    valid = (num_spikes > 0) & ~((t_last - t_first) < min_len)
+
+    # align to first spike, remove the transient and limit the duration.
+    # same dtype as values, as in the unit-wise version.
+    t_first = np.where(valid, t_first, 0).astype(values.dtype)
+    aligned = values - np.repeat(t_first, num_spikes)
+    transient = np.repeat(transient_length.astype(values.dtype), num_spikes)
+    keep = np.repeat(valid, num_spikes) & (aligned > transient)
+    aligned = aligned - transient
+    keep &= aligned < np.repeat(max_output_len, num_spikes)
+
+    num_kept = np.zeros(len(keep) + 1, dtype=np.int64)
+    np.cumsum(keep, out=num_kept[1:])
+    return aligned[keep], num_kept[offsets]
+
+
+def _lengths_for(stimulus, lengths=None):
+    """(min_len, max_output_len, transient_length) for a stimulus."""
+    if lengths is None:
+        lengths = prepare_lengths
+    try:
+        return lengths[stimulus.lower()]
+    except KeyError:
+        raise ValueError(
+            f"Unknown stimulus {stimulus}, known values are: 'spontaneous',"
+            " 'natural_movie_one_more_repeats', 'natural_movie_three'"
+        )
+
+
 # ------------------------------------------------------------------------------ #
 # pandas dataframe related helpers
 # ------------------------------------------------------------------------------ #
 
+# categories of the string columns of the metadata frame, see `compact_dtypes`.
+# None: use the values found in the frame. values that are not listed are added,
+# categories are kept sorted so that groupby and sort give the order of strings.
+metadata_categories = {
+    "stimulus": [
+        "natural_movie_one_more_repeats",
+        "natural_movie_three",
+        "spontaneous",
+    ],
+    "invalid_spiketimes_check": [
+        "ERR_EMPTY",
+        "ERR_INVALID_TIMES",
+        "ERR_LO_FIR_RATE",
+        "ERR_NON_STATIONARY",
+        "ERR_REC_LEN",
+        "ERR_STATIONARITY",
+        "SUCCESS",
+    ],
+    "ecephys_structure_acronym": sorted(structure_names.keys()),
+    "block": None,
+    "filepath": None,
+}
+
+# numeric columns that we can store with less precision.
+# times (recording_length, t_first, t_last) stay float64, they are compared
+# against our duration thresholds.
+metadata_dtypes = {
+    "session": "int32",
+    "unit_id": "int32",
+    "num_spikes": "int32",
+    "firing_rate": "float32",
+    "isi_mean": "float32",
+    "isi_cv": "float32",
+}
+
+
+def compact_dtypes(meta_df, inplace=False):
+    """
+    Convert the string columns of the metadata frame to categoricals
+    (`metadata_categories`) and the numeric ones to smaller types
+    (`metadata_dtypes`), where present. Integer columns whose values do not
+    fit are kept as int64. This makes `query` and `groupby` faster, and the frame
+    smaller.
+
+    # Parameters
+    meta_df : pd.DataFrame
+    inplace : default False, returning a copy.
+
+    # Returns
+    meta_df : the modified dataframe
+    """
+    if not inplace:
+        meta_df = meta_df.copy()
+
+    for col, categories in metadata_categories.items():
+        if col not in meta_df.columns:
+            continue
+        values = meta_df[col].astype(object)
+        found = set(values.dropna().unique())
+        categories = sorted(found | set(categories or []))
+        meta_df[col] = pd.Categorical(values, categories=categories)
+
+    for col, dtype in metadata_dtypes.items():
+        if col not in meta_df.columns or not is_numeric_dtype(meta_df[col]):
+            continue
+        if np.dtype(dtype).kind == "i":
+            if meta_df[col].isna().any():
+                continue
+            info = np.iinfo(dtype)
+            if meta_df[col].min() < info.min or meta_df[col].max() > info.max:
+                continue
+        meta_df[col] = meta_df[col].astype(dtype)
+
+    return meta_df
+
 
-def load_metrics(meta_df, data_dir, inplace=False, csvs=None, cols=None):
+def load_metrics(
+    meta_df, data_dir, inplace=False, csvs=None, cols=None, use_cache=True
+):
     """
     Load metrics from the Allen Institute csv files,
     (brain_observatory_1.1_analysis_metrics.csv and
@@ -696,7 +1303,9 @@ def load_metrics(meta_df, data_dir, inplace=False, csvs=None, cols=None):
     - inplace : if True, modify the dataframe in place. Otherwise, return a copy.
     - csvs : list of csv filenames to load. default : None, standard file names
     - cols : list of columns to load.
-        default : None -> ["g_dsi_dg", "image_selectivity_ns", "mod_idx_dg"]
+        default : None -> ["g_dsi_dg", "image_selectivity_ns", "mod_idx_dg", "on_screen_rf"]
+    - use_cache : if True (default), keep the parsed csv columns in a parquet file
+        next to each csv (see `_load_metrics_from_csv`), so later loads skip parsing.
 
     # Notes
     - focus is on numerical columns of the csv.
@@ -727,7 +1336,7 @@ def load_metrics(meta_df, data_dir, inplace=False, csvs=None, cols=None):
     loaded_csvs = []
     for csv in csvs:
         csv_path = os.path.abspath(os.path.join(data_dir, csv))
-        df = _load_metrics_from_csv(csv_path, cols=cols)
+        df = _load_metrics_from_csv(csv_path, cols=cols, use_cache=use_cache)
         log.debug(f"Loaded columns {df.columns.to_list()} from {csv_path}")
         loaded_dfs.append(df)
         loaded_csvs.append(csv_path)
@@ -742,13 +1351,14 @@ def load_metrics(meta_df, data_dir, inplace=False, csvs=None, cols=None):
             cols_in_multiple_dfs.append(col)
             log.info(f"Column {col} found in multiple dataframes.")
 
-        if col in meta_df.columns and meta_df[col].isfinite().sum() > 0:
+        if col in meta_df.columns and meta_df[col].notna().sum() > 0:
             raise ValueError(f"Column {col} already exists in meta_df, and has values.")
 
         meta_df[col] = np.nan
 
     # merge the dataframes, by unit_id. units likely occur multiple times in meta_df.
-    # merging can be finicky, doing this manually may a bit slower but should be safe
+    # we look up the row of each unit in the csv frame once, and then assign
+    # whole columns. values from later csvs take precedence, unless they are nan.
     cols_copied = []
     for idx, df in enumerate(loaded_dfs):
         if len(df.columns) == 1 or len(df) == 0:
@@ -768,25 +1378,23 @@ def load_metrics(meta_df, data_dir, inplace=False, csvs=None, cols=None):
         if len(cois) == 0:
             continue
 
-        for unit in meta_df["unit_id"].unique():
-            if not unit in df["unit_id"].values:
-                continue
-
-            meta_df_rows = meta_df[meta_df["unit_id"] == unit]
+        if not df["unit_id"].is_unique:
+            raise ValueError(f"Duplicate unit_ids in {loaded_csvs[idx]}")
 
-            for c in cois:
-                new_value = df.loc[df["unit_id"] == unit, c].values
+        # values of `df` for each row of `meta_df`, nan where the unit is missing
+        matched = same_units.to_numpy()
+        new_dfs = df.set_index("unit_id")[cois].reindex(meta_df["unit_id"].to_numpy())
 
-                for index in meta_df_rows.index:
-                    old_value = meta_df_rows.loc[index, c]
+        for c in cois:
+            new_values = new_dfs[c].to_numpy()
+            old_values = meta_df[c].to_numpy()
 
-                    if not pd.isna(new_value):
-                        meta_df.loc[index, c] = new_value
+            # but check with old values.
+            inconsistent = matched & pd.notna(old_values) & (old_values != new_values)
+            for unit in meta_df.loc[inconsistent, "unit_id"].unique():
+                log.warning(f"Inconsistency found in column {c} for unit {unit}")
 
-                    # but check with old value.
-                    if not pd.isna(old_value):
-                        if old_value != new_value:
-                            log.warning(f"Inconsistency found in column {c} for unit {unit}")
+            meta_df[c] = meta_df[c].where(~(matched & pd.notna(new_values)), new_values)
 
         cols_copied.extend(cois)
 
@@ -950,107 +1558,1794 @@ def _session_dict_to_xr(session_dict):
     return session_df
 
 
-def _key_to_parts(key):
+def _crawl_session_metadata(files, workers=None):
     """
-    We have a convention to store data in hdf5 files.
-    Each group key looks like this:
-    `session_774875821_stimulus_natural_movie_one_more_repeats_ \
-    stimulus_block_8.0_spiketimes`
+    Generator yielding `(filepath, session_df)` for the given files, in order.
+    session_df is None for files that raise a ValueError (no session data).
 
-    with this helper we use regex to get the individual parts as a dict:
-    session (int):
-    stimulus (str):
-    block (str):
-    kind (str): either metadata or spiketimes
+    with `workers` > 1, files are read in a process pool. Results still
+    come back in the order of `files`. Workers are spawned, not forked: the
+    parent may hold numba's thread pool, read-ahead threads or open hdf5 files,
+    none of which survive a fork.
     """
+    if workers is None or workers <= 1 or len(files) <= 1:
+        for fp in tqdm(files, desc="Fetching metadata from sessions"):
+            yield fp, _load_session_meta_or_none(fp)
+        return
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(files)),
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as executor:
+        results = executor.map(_load_session_meta_or_none, files)
+        for fp, session_df in tqdm(
+            zip(files, results),
+            desc="Fetching metadata from sessions",
+            total=len(files),
+        ):
+            yield fp, session_df
+
+
+def _load_session_meta_or_none(filepath):
+    """
+    `load_session(meta_only=True)` that returns None instead of raising a ValueError.
+    Lives on module level so a process pool can pickle it.
+    """
+    try:
+        return load_session(filepath, meta_only=True)
+    except ValueError:
+        return None
 
-    parts = dict()
-
-    # regex magic to get parts of the key
-    # session is the integer sequence after `session_`
-    parts["session"] = re.search(r"session_(\d+)_", key).group(1)
-    parts["stimulus"] = re.search(r"stimulus_(.+)_stimulus_block", key).group(1)
-    parts["block"] = re.search(r"stimulus_block_(.+)_", key).group(1)
-    # word characters after last `_` and before the end of the key
-    parts["kind"] = re.search(r"_([a-zA-Z0-9.-]+)$", key).group(1)
 
-    if parts["kind"] not in ["metadata", "spiketimes"]:
-        raise ValueError(f"Unknown kind {parts['kind']} for key '{key}'")
+def _dir_is_writable(dir):
+    return os.access(dir, os.W_OK | os.X_OK)
 
-    # blocks shall always remain strings, make sure sessions are integers?
-    # units from metadata dataframe are int64, anyway. mightaswell be consistent.
-    parts["session"] = int(parts["session"])
 
-    return parts
+def _default_meta_index_file(dir):
+    """
+    Index file for the session files in `dir`: next to them if we can write
+    there, otherwise in the per-user `meta_index_cache_dir`.
+    """
+    if _dir_is_writable(dir):
+        return os.path.join(dir, _meta_index_name)
+    dir_hash = hashlib.md5(dir.encode()).hexdigest()[:16]
+    index_file = os.path.join(meta_index_cache_dir, f"{dir_hash}_{_meta_index_name}")
+    log.debug(f"{dir} is not writable, using metadata index {index_file}")
+    return index_file
 
 
-def _load_metrics_from_csv(csv_path, cols=None):
+def _read_meta_index(index_file):
     """
-    Loads Allen Institute metrics from the specified csv file, keeping only the
-    desired columns (None for all).
+    Read the on-disk metadata index written by `_write_meta_index`.
 
-    cols may contain columns not found in the csv, these are ignored.
+    # Returns
+    meta_df : pandas.DataFrame or None, if there is no (valid) index
+    files : dict, filepath -> dict(size, mtime_ns, num_rows)
     """
-    metric_df = pd.read_csv(csv_path, index_col=None)
+    import pyarrow.parquet as pq
 
-    # rename columns to match our format
-    metric_df.rename(columns={"ecephys_unit_id": "unit_id"}, inplace=True)
-    assert "unit_id" in metric_df.columns
-
-    # drop columns that we don't need
-    if cols is not None:
-        cols = cols.copy()
-        assert isinstance(cols, list)
-        cols = ["unit_id"] + cols
-        cols_to_drop = [c for c in metric_df.columns if c not in cols]
-        metric_df.drop(columns=cols_to_drop, inplace=True)
-
-    return metric_df
+    if not os.path.isfile(index_file):
+        return None, dict()
 
+    try:
+        table = pq.read_table(index_file)
+        info = json.loads(table.schema.metadata[b"its_meta_index"])
+        assert info["version"] == _meta_index_version, "outdated index version"
+        meta_df = table.to_pandas()
+    except Exception as e:
+        log.warning(f"Ignoring metadata index {index_file}: {e}")
+        return None, dict()
 
-# ------------------------------------------------------------------------------ #
-# Saving the dataframe
-# ------------------------------------------------------------------------------ #
+    log.debug(f"Loaded metadata index {index_file} with {len(meta_df)} rows")
+    return meta_df, info["files"]
 
 
-def save_dataframe(meta_df, path, cols_to_skip=None):
+def _write_meta_index(index_file, meta_df, files):
     """
-    Thin wrapper around pandas df.to_hdf
+    Write the metadata frame as parquet, together with the file table
+    that we need for revalidation. Writes to a temporary file first,
+    so concurrent readers never see a partial index.
     """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    info = dict(version=_meta_index_version, files=files)
 
-    if cols_to_skip is None:
-        cols_to_skip = []
-    cols_to_save = [c for c in meta_df.columns if c not in cols_to_skip]
-    df_to_save = meta_df[cols_to_save]
     try:
-        df_to_save.to_feather(path, key="meta_df", mode="w", complib="zlib", complevel=9)
+        table = pa.Table.from_pandas(meta_df, preserve_index=False)
+        metadata = table.schema.metadata or dict()
+        metadata[b"its_meta_index"] = json.dumps(info).encode()
+        table = table.replace_schema_metadata(metadata)
+
+        os.makedirs(os.path.dirname(os.path.abspath(index_file)), exist_ok=True)
+        tmp_file = f"{index_file}.{os.getpid()}.tmp"
+        pq.write_table(table, tmp_file)
+        os.replace(tmp_file, index_file)
+        log.debug(f"Wrote metadata index {index_file}")
     except Exception as e:
-        log.debug(f"Saving dataframe failed, trying without compression {e}")
-        df_to_save.to_hdf(path, key="meta_df", mode="w")
+        log.warning(f"Could not write metadata index {index_file}: {e}")
 
 
-# ------------------------------------------------------------------------------ #
-# spike processing
-# ------------------------------------------------------------------------------ #
-
+def _read_hdf_frame(group):
+    """
+    Read a pandas dataframe that was stored with `df.to_hdf()` (fixed format)
+    from an open h5py group, without reopening the file via `pd.read_hdf`.
 
-def binned_spike_count(spiketimes, bin_size):
+    Falls back to `pd.read_hdf` for everything we do not decode ourselves,
+    e.g. table format, datetimes or multi-indices.
     """
-    Get a number of spike counts in a time bin, per neuron.
 
-    Parameters
-    ----------
-    spiketimes : list of lists or 2d nan-padded array
-        where first dim is neuron/block and second index are spiketimes.
-        for a single neuron, pass `[your_spiketimes_as_array]`
-    bin_size :
-        float, in units of spiketimes
+    try:
+        return _decode_fixed_frame(group)
+    except NotImplementedError as e:
+        log.debug(f"Falling back to pd.read_hdf for {group.name}: {e}")
+        return pd.read_hdf(group.file.filename, key=group.name)
+
+
+def _decode_fixed_frame(group):
+    """
+    pandas fixed format, written by `pandas.io.pytables.FrameFixed`:
+    - `axis0` holds the column names, `axis1` the index
+    - columns are grouped into blocks of the same dtype,
+        `block{i}_items` holds their names, `block{i}_values` the values.
+    - object blocks (e.g. strings) are pickled into a variable-length uint8 array
+    - bool blocks are hdf5 bitfields
+    """
+    attrs = group.attrs
+    if _decode_attr(attrs.get("pandas_type")) != "frame":
+        raise NotImplementedError(f"pandas_type {attrs.get('pandas_type')}")
+    if int(attrs.get("ndim", 2)) != 2:
+        raise NotImplementedError("only 2d frames")
+    encoding = _decode_attr(attrs.get("encoding", b"UTF-8")) or "UTF-8"
+
+    def read_axis(name):
+        if _decode_attr(attrs.get(f"{name}_variety", b"regular")) != "regular":
+            raise NotImplementedError(f"{name} is not a regular index")
+        ds = group[name]
+        kind = _decode_attr(ds.attrs.get("kind"))
+        values = ds[()]
+        if kind == "string":
+            values = np.array([v.decode(encoding) for v in values], dtype=object)
+        elif kind not in ["integer", "float"]:
+            raise NotImplementedError(f"index of kind {kind}")
+        index_name = _decode_attr(ds.attrs.get("name", b"N."))
+        return pd.Index(values, name=None if index_name == "N." else index_name)
+
+    columns = read_axis("axis0")
+    index = read_axis("axis1")
+
+    data = dict()
+    for bdx in range(int(attrs["nblocks"])):
+        items = read_axis(f"block{bdx}_items")
+        ds = group[f"block{bdx}_values"]
+        if "value_type" in ds.attrs and _decode_attr(ds.attrs["value_type"]) not in [
+            "str",
+            "object",
+        ]:
+            raise NotImplementedError(f"block of type {ds.attrs['value_type']}")
+
+        type_class = ds.id.get_type().get_class()
+        if _decode_attr(ds.attrs.get("PSEUDOATOM")) == "object":
+            # pandas does the same thing when reading: unpickle the vlarray.
+            values = pickle.loads(ds[0].tobytes())
+        elif type_class == h5py.h5t.BITFIELD:
+            # pytables stores bool columns as 8-bit bitfields, h5py reads uint8
+            values = ds[()].astype(bool)
+        elif type_class in [h5py.h5t.INTEGER, h5py.h5t.FLOAT]:
+            values = ds[()]
+        else:
+            raise NotImplementedError(f"block of hdf5 type class {type_class}")
+
+        if int(ds.attrs.get("transposed", 0)):
+            values = values.T
+        values = np.atleast_2d(values)
+
+        for idx, item in enumerate(items):
+            data[item] = values[idx]
+
+    return pd.DataFrame(data, index=index, columns=columns)
+
+
+def _decode_attr(value):
+    """hdf5 string attributes come back as bytes (or np.bytes_)"""
+    if isinstance(value, bytes):
+        return value.decode()
+    return value
+
+
+def _read_ragged(f, key, rows=None, as_samples=False):
+    """
+    Read the spiketimes of a block from an open h5py file, in either layout.
+
+    # Parameters
+    f : h5py.File
+    key : str, the `_spiketimes` key of the block
+    rows : array of int or None, sorted row indices (units) to read.
+        default: None, read all.
+    as_samples : bool, return int64 sample indices instead of seconds.
+        blocks that store seconds are rounded to the `_sampling_rate` of the block.
+
+    # Returns
+    values : 1d array, spiketimes of all (selected) units, concatenated
+    offsets : 1d int64 array of length num_units + 1.
+        the i-th unit's spikes are `values[offsets[i]:offsets[i+1]]`
+    """
+    offsets_key = _block_key(key, "offsets")
+    dset = f[key]
+
+    if _is_sample_encoded(dset):
+        samples, offsets = _read_samples(f, key, rows=rows)
+        if as_samples:
+            return samples, offsets
+        # float64 seconds, without a detour via float32
+        return samples / _sampling_rate(dset), offsets
+
+    if offsets_key not in f:
+        # nan-padded. h5py only reads the chunks that hold the selected rows,
+        # but is slow with many single-row selections.
+        if rows is None or len(rows) > dset.shape[0] // 2:
+            padded = dset[:]
+            if rows is not None:
+                padded = padded[rows]
+        else:
+            padded = dset[rows, :]
+        values, offsets = _padded_to_ragged(padded)
+    else:
+        offsets = f[offsets_key][:].astype(np.int64)
+        if rows is None:
+            values = dset[:]
+        else:
+            values, offsets = _read_rows(dset, offsets, rows)
+
+    if as_samples:
+        values = _seconds_to_samples(values, _sampling_rate(dset))
+    return values, offsets
+
+
+def _read_rows(dset, bounds, rows):
+    """
+    Read `dset[bounds[r]:bounds[r+1]]` for sorted `rows` from a flat dataset.
+    Consecutive rows are coalesced into a single read, and if more than half
+    of the dataset is needed, we read it completely.
+
+    # Returns
+    values : 1d array, concatenated parts of the rows
+    new_bounds : 1d int64 array of length len(rows) + 1
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    counts = bounds[rows + 1] - bounds[rows]
+    new_bounds = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(counts, out=new_bounds[1:])
+
+    if new_bounds[-1] > len(dset) // 2:
+        values = dset[:]
+        parts = [values[bounds[r] : bounds[r + 1]] for r in rows]
+    else:
+        # coalesce consecutive rows into a single read
+        breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+        starts = rows[np.r_[0, breaks]]
+        stops = rows[np.r_[breaks - 1, len(rows) - 1]] + 1
+        parts = [
+            dset[bounds[start] : bounds[stop]] for start, stop in zip(starts, stops)
+        ]
+
+    values = np.concatenate([np.zeros(0, dtype=dset.dtype)] + parts)
+    return values, new_bounds
+
+
+def _read_offsets(f, key):
+    """
+    Offsets of a ragged block (length num_units + 1) or None for nan-padded blocks.
+    """
+    offsets_key = _block_key(key, "offsets")
+    if offsets_key in f:
+        return f[offsets_key][:].astype(np.int64)
+    return None
+
+
+def _filter_rows(meta_df, filter):
+    """
+    Apply the filter entries that refer to metadata columns (not to parts of the
+    hdf5 keys) to a block-level metadata frame.
+
+    # Returns
+    rows : sorted array of matching row indices, or None if no column filter applies.
+    """
+    col_filter = {k: v for k, v in filter.items() if k not in _key_parts}
+    if len(col_filter) == 0:
+        return None
+
+    mask = np.ones(len(meta_df), dtype=bool)
+    for col, value in col_filter.items():
+        if col not in meta_df.columns:
+            raise ValueError(f"Cannot filter by {col}, not a metadata column")
+        if callable(value):
+            mask &= np.asarray(value(meta_df[col]), dtype=bool)
+        else:
+            mask &= meta_df[col].isin(np.atleast_1d(value)).to_numpy()
+
+    return np.flatnonzero(mask)
+
+
+def _ragged_stats(values, offsets):
+    """
+    Number of spikes, first and last spike time for each unit of a ragged block.
+    first and last are nan for units without spikes, in the dtype of values
+    (float64 for integer sample indices).
+    """
+    num_spikes = np.diff(offsets)
+    nonempty = num_spikes > 0
+    dtype = values.dtype if values.dtype.kind == "f" else np.float64
+    t_first = np.full(len(num_spikes), np.nan, dtype=dtype)
+    t_last = np.full(len(num_spikes), np.nan, dtype=dtype)
+    t_first[nonempty] = values[offsets[:-1][nonempty]]
+    t_last[nonempty] = values[offsets[1:][nonempty] - 1]
+    return num_spikes, t_first, t_last
+
+
+def _ragged_to_object_array(values, offsets):
+    """
+    Object array holding one (view) array per unit, from `(values, offsets)`.
+    """
+    if len(offsets) < 2:
+        return np.empty(0, dtype=object)
+    return _object_array(np.split(values, offsets[1:-1]))
+
+
+def _object_array(items):
+    """
+    1d object array from a list of arrays. Assigning a list of arrays to an
+    object array tries to broadcast them, so we need to fill element-wise.
+    """
+    res = np.empty(len(items), dtype=object)
+    for idx, item in enumerate(items):
+        res[idx] = item
+    return res
+
+
+def _padded_to_ragged(padded):
+    """
+    Convert a 2d nan-padded array (units x spikes) to `(values, offsets)`.
+    Padding is expected to be trailing, as written by `write_spike_times_hdf5.py`.
+    """
+    finite = np.isfinite(padded)
+    offsets = np.zeros(len(padded) + 1, dtype=np.int64)
+    np.cumsum(finite.sum(axis=1), out=offsets[1:])
+    return padded[finite], offsets
+
+
+def _ragged_to_padded(values, offsets, width=None):
+    """
+    Convert `(values, offsets)` to a 2d nan-padded array (units x spikes).
+    """
+    counts = np.diff(offsets)
+    if width is None:
+        width = counts.max() if len(counts) > 0 else 0
+    padded = np.full((len(counts), width), np.nan, dtype=values.dtype)
+    # position of each value within its row
+    rows = np.repeat(np.arange(len(counts)), counts)
+    cols = np.arange(len(values)) - np.repeat(offsets[:-1], counts)
+    padded[rows, cols] = values
+    return padded
+
+
+_key_parts = ["session", "stimulus", "block", "kind"]
+# datasets (or pandas groups) that belong to a block
+_kinds = ["metadata", "spiketimes", "offsets", "base", "bits"]
+# the ones holding spike data
+_spike_kinds = ["spiketimes", "offsets", "base", "bits"]
+
+
+def _key_to_parts(key):
+    """
+    We have a convention to store data in hdf5 files.
+    Each group key looks like this:
+    `session_774875821_stimulus_natural_movie_one_more_repeats_ \
+    stimulus_block_8.0_spiketimes`
+
+    or, for the grouped layout, `/774875821/natural_movie_one_more_repeats/8.0/spiketimes`
+
+    with this helper we use regex to get the individual parts as a dict:
+    session (int):
+    stimulus (str):
+    block (str):
+    kind (str): metadata, spiketimes, offsets (ragged layout),
+        base or bits (sample-index encoding)
+    """
+
+    parts = dict()
+
+    if "/" in key.strip("/"):
+        # grouped layout: `/{session}/{stimulus}/{block}/{kind}`
+        (
+            parts["session"],
+            parts["stimulus"],
+            parts["block"],
+            parts["kind"],
+        ) = key.strip("/").split("/")
+        if parts["kind"] not in _kinds:
+            raise ValueError(f"Unknown kind {parts['kind']} for key '{key}'")
+        parts["session"] = int(parts["session"])
+        return parts
+
+    # regex magic to get parts of the key
+    # session is the integer sequence after `session_`
+    parts["session"] = re.search(r"session_(\d+)_", key).group(1)
+    parts["stimulus"] = re.search(r"stimulus_(.+)_stimulus_block", key).group(1)
+    parts["block"] = re.search(r"stimulus_block_(.+)_", key).group(1)
+    # word characters after last `_` and before the end of the key
+    parts["kind"] = re.search(r"_([a-zA-Z0-9.-]+)$", key).group(1)
+
+    if parts["kind"] not in _kinds:
+        raise ValueError(f"Unknown kind {parts['kind']} for key '{key}'")
+
+    # blocks shall always remain strings, make sure sessions are integers?
+    # units from metadata dataframe are int64, anyway. mightaswell be consistent.
+    parts["session"] = int(parts["session"])
+
+    return parts
+
+
+def _block_key(key, kind):
+    """
+    Key of another dataset of the same block, for both layouts, e.g.
+    `session_1_stimulus_spontaneous_stimulus_block_null_spiketimes` -> `..._offsets`
+    or `/1/spontaneous/null/spiketimes` -> `/1/spontaneous/null/offsets`.
+    """
+    if "/" in key.strip("/"):
+        return key.rsplit("/", 1)[0] + "/" + kind
+    return key.rsplit("_", 1)[0] + "_" + kind
+
+
+def _iter_blocks(f, filter=None):
+    """
+    Find the blocks of an open session file, in either layout.
+    Only the session, stimulus and block entries of `filter` are considered,
+    and with the grouped layout, we only descend into groups that match.
+
+    # Yields
+    parts : dict with session (int), stimulus and block
+    spikes_key : str, key of the block's spiketimes dataset
+    """
+    if filter is None:
+        filter = dict()
+
+    def selected(part, value):
+        return part not in filter or value in filter[part]
+
+    for name in f.keys():
+        if re.fullmatch(r"\d+", name):
+            # grouped layout: /{session}/{stimulus}/{block}/
+            session = int(name)
+            if not selected("session", session):
+                continue
+            for stimulus in f[name].keys():
+                if not selected("stimulus", stimulus):
+                    continue
+                for block, group in f[name][stimulus].items():
+                    if not selected("block", block) or "metadata" not in group:
+                        continue
+                    parts = dict(session=session, stimulus=stimulus, block=block)
+                    yield parts, f"/{name}/{stimulus}/{block}/spiketimes"
+
+        elif name.endswith("_metadata"):
+            parts = _key_to_parts(name)
+            del parts["kind"]
+            if all(selected(part, value) for part, value in parts.items()):
+                yield parts, _block_key(name, "spiketimes")
+
+
+def _copy_except(src, dst, skip):
+    """
+    Copy all items and attributes of h5py group `src` to `dst`, except the ones
+    whose full names (starting with `/`) are in `skip`. Groups that contain
+    skipped items are recreated, the other items are copied as they are.
+    """
+    for key, value in src.attrs.items():
+        dst.attrs[key] = value
+
+    for name in src.keys():
+        item = src[name]
+        if item.name in skip:
+            continue
+        if isinstance(item, h5py.Group) and any(
+            s.startswith(item.name + "/") for s in skip
+        ):
+            _copy_except(item, dst.require_group(name), skip)
+        else:
+            src.copy(item, dst, name=name)
+
+
+def _full_names(spikes_keys, kinds):
+    """Full hdf5 names of the `kinds` datasets of the given blocks."""
+    return {"/" + _block_key(key, kind).strip("/") for key in spikes_keys for kind in kinds}
+
+
+# parsed metric csvs are cached as parquet files next to the csv.
+# the csv size and mtime, and the requested columns live in the parquet
+# key-value metadata, so that we can tell when the cache is outdated.
+_metrics_cache_suffix = ".cache.parquet"
+
+
+def _load_metrics_from_csv(csv_path, cols=None, use_cache=True):
+    """
+    Loads Allen Institute metrics from the specified csv file, keeping only the
+    desired columns (None for all).
+
+    cols may contain columns not found in the csv, these are ignored.
+
+    With `use_cache`, the column-pruned frame is read from (or written to)
+    `{csv_path}.cache.parquet`, which is revalidated against the csv's size and
+    modification time, and against the requested columns.
+    """
+    if cols is not None:
+        cols = cols.copy()
+        assert isinstance(cols, list)
+        cols = ["unit_id"] + cols
+
+    cache_path = csv_path + _metrics_cache_suffix
+    stat = os.stat(csv_path)
+    info = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, cols=cols)
+
+    if use_cache:
+        metric_df = _read_metrics_cache(cache_path, info)
+        if metric_df is not None:
+            return metric_df
+
+    metric_df = pd.read_csv(csv_path, index_col=None)
+
+    # rename columns to match our format
+    metric_df.rename(columns={"ecephys_unit_id": "unit_id"}, inplace=True)
+    assert "unit_id" in metric_df.columns
+
+    # drop columns that we don't need
+    if cols is not None:
+        cols_to_drop = [c for c in metric_df.columns if c not in cols]
+        metric_df.drop(columns=cols_to_drop, inplace=True)
+
+    if use_cache:
+        _write_metrics_cache(cache_path, metric_df, info)
+
+    return metric_df
+
+
+def _read_metrics_cache(cache_path, info):
+    """
+    Read the cached metric frame, if it matches the csv described by `info`.
+    A cache holding more columns than requested is fine, we select from it.
+
+    # Returns
+    metric_df : pandas.DataFrame or None, if there is no (valid) cache
+    """
+    import pyarrow.parquet as pq
+
+    if not os.path.isfile(cache_path):
+        return None
+
+    try:
+        schema = pq.read_schema(cache_path)
+        cached = json.loads(schema.metadata[b"its_metrics_cache"])
+    except Exception as e:
+        log.warning(f"Ignoring metrics cache {cache_path}: {e}")
+        return None
+
+    if cached["size"] != info["size"] or cached["mtime_ns"] != info["mtime_ns"]:
+        log.debug(f"Metrics cache {cache_path} is outdated")
+        return None
+    if cached["cols"] is not None and (
+        info["cols"] is None or not set(info["cols"]).issubset(cached["cols"])
+    ):
+        log.debug(f"Metrics cache {cache_path} lacks requested columns")
+        return None
+
+    columns = None
+    if info["cols"] is not None:
+        columns = [c for c in schema.names if c in info["cols"]]
+    metric_df = pq.read_table(cache_path, columns=columns).to_pandas()
+    log.debug(f"Loaded metrics cache {cache_path}")
+    return metric_df
+
+
+def _write_metrics_cache(cache_path, metric_df, info):
+    """
+    Write the metric frame as parquet, via a temporary file.
+    Failing to write (e.g. read-only data directories) is not an error.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    try:
+        table = pa.Table.from_pandas(metric_df, preserve_index=False)
+        metadata = table.schema.metadata or dict()
+        metadata[b"its_metrics_cache"] = json.dumps(info).encode()
+        table = table.replace_schema_metadata(metadata)
+
+        tmp_file = f"{cache_path}.{os.getpid()}.tmp"
+        pq.write_table(table, tmp_file)
+        os.replace(tmp_file, cache_path)
+        log.debug(f"Wrote metrics cache {cache_path}")
+    except Exception as e:
+        log.warning(f"Could not write metrics cache {cache_path}: {e}")
+
+
+# ------------------------------------------------------------------------------ #
+# Lazy spike access
+# ------------------------------------------------------------------------------ #
+
+
+class SpikeHandle:
+    """
+    Lightweight reference to the spiketimes of one unit in one block of a
+    session file, as placed in the `spiketimes` column by `load_spikes(lazy=True)`.
+
+    Spikes are read on first access and kept in a shared LRU cache with a
+    byte budget (`set_spike_cache_size`). Resolved arrays are read-only.
+
+    # Example
+    ```
+    spikes = handle.resolve()  # or np.asarray(handle)
+    ```
+    """
+
+    __slots__ = ("filepath", "key", "row", "start", "stop")
+
+    def __init__(self, filepath, key, row, start=None, stop=None):
+        self.filepath = filepath
+        self.key = key
+        # row of the unit in the block. for ragged blocks we also know where
+        # the unit's spikes start and stop in the flat array.
+        self.row = int(row)
+        self.start = None if start is None else int(start)
+        self.stop = None if stop is None else int(stop)
+
+    def resolve(self):
+        """Get the spiketimes as (read-only) numpy array."""
+        return _spike_cache.get(self)
+
+    def __array__(self, dtype=None, copy=None):
+        spikes = self.resolve()
+        if dtype is not None:
+            return spikes.astype(dtype)
+        return spikes.copy() if copy else spikes
+
+    def __len__(self):
+        if self.start is not None:
+            return self.stop - self.start
+        return len(self.resolve())
+
+    def __repr__(self):
+        return f"SpikeHandle({os.path.basename(self.filepath)}, {self.key}, row {self.row})"
+
+    @property
+    def cache_key(self):
+        return (self.filepath, self.key, self.row)
+
+
+def resolve_spikes(spikes):
+    """
+    Resolve an iterable of `SpikeHandle`s (e.g. the lazy `spiketimes` column)
+    to a list of numpy arrays. Entries that are already arrays are passed through.
+    Uncached handles are read grouped by file, opening each file only once.
+    """
+    return _spike_cache.get_many(list(spikes))
+
+
+def set_spike_cache_size(max_bytes):
+    """
+    Set the byte budget of the cache that holds resolved `SpikeHandle`s.
+    Least recently used spike trains are evicted first. 0 disables caching.
+    """
+    _spike_cache.resize(int(max_bytes))
+
+
+def clear_spike_cache():
+    """Drop all resolved spike trains from the cache."""
+    _spike_cache.clear()
+
+
+class _SpikeCache:
+    """
+    LRU cache for spike arrays, bounded by the total number of bytes.
+    Thread-safe, so read-ahead threads can share it.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._arrays = OrderedDict()
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, handle):
+        return self.get_many([handle])[0]
+
+    def get_many(self, handles):
+        res = [None] * len(handles)
+        misses = dict()  # filepath -> list of positions
+
+        with self._lock:
+            for idx, handle in enumerate(handles):
+                if not isinstance(handle, SpikeHandle):
+                    res[idx] = handle
+                    continue
+                spikes = self._arrays.get(handle.cache_key)
+                if spikes is None:
+                    misses.setdefault(handle.filepath, []).append(idx)
+                else:
+                    self._arrays.move_to_end(handle.cache_key)
+                    res[idx] = spikes
+
+        for filepath, indices in misses.items():
+            arrays = _read_handles(filepath, [handles[idx] for idx in indices])
+            for idx, spikes in zip(indices, arrays):
+                spikes.flags.writeable = False
+                res[idx] = spikes
+                self._put(handles[idx].cache_key, spikes)
+
+        return res
+
+    def _put(self, key, spikes):
+        if spikes.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._arrays:
+                return
+            self._arrays[key] = spikes
+            self._num_bytes += spikes.nbytes
+            self._evict()
+
+    def _evict(self):
+        while self._num_bytes > self.max_bytes and len(self._arrays) > 0:
+            _, spikes = self._arrays.popitem(last=False)
+            self._num_bytes -= spikes.nbytes
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._arrays.clear()
+            self._num_bytes = 0
+
+
+# default budget of 2 GB
+_spike_cache = _SpikeCache(max_bytes=2 * 1024**3)
+
+
+def _read_handles(filepath, handles):
+    """
+    Read the spikes for a list of handles that all point to the same file.
+    """
+    res = []
+    f = _open_h5(filepath)
+    encoded = dict()
+    for handle in handles:
+        dset = f[handle.key]
+        if handle.key not in encoded:
+            encoded[handle.key] = _is_sample_encoded(dset)
+        if encoded[handle.key]:
+            res.append(_read_ragged(f, handle.key, rows=np.array([handle.row]))[0])
+        elif handle.start is not None:
+            res.append(dset[handle.start : handle.stop])
+        else:
+            spikes = dset[handle.row]
+            res.append(spikes[np.isfinite(spikes)])
+    return res
+
+
+# resolving handles one-by-one (e.g. in `df.apply`) should not reopen the file
+# every time, so we keep a few read-only handles around.
+_open_files = OrderedDict()
+_max_open_files = 8
+
+
+def _open_h5(filepath):
+    """
+    Read-only h5py file, reused across calls. Reopened when the file changed
+    on disk, or when we are in a different process (e.g. after forking).
+    """
+    stat = os.stat(filepath)
+    key = (os.getpid(), filepath)
+    with _spike_cache._lock:
+        if key in _open_files:
+            mtime_ns, f = _open_files[key]
+            if mtime_ns == stat.st_mtime_ns and f.id.valid:
+                _open_files.move_to_end(key)
+                return f
+            f.close()
+            del _open_files[key]
+
+        f = h5py.File(filepath, "r")
+        _open_files[key] = (stat.st_mtime_ns, f)
+        while len(_open_files) > _max_open_files:
+            _, (_, old_f) = _open_files.popitem(last=False)
+            old_f.close()
+    return f
+
+
+def _block_handles(filepath, block_dict):
+    """
+    Object array of `SpikeHandle`s for all units of a block from `load_session`,
+    in the order of the block's metadata.
+    """
+    key = block_dict["key"]
+    rows = block_dict["rows"]
+    offsets = block_dict["offsets"]
+
+    handles = np.empty(len(rows), dtype=object)
+    for idx, row in enumerate(rows):
+        if offsets is None:
+            handles[idx] = SpikeHandle(filepath, key, row)
+        else:
+            handles[idx] = SpikeHandle(
+                filepath, key, row, offsets[row], offsets[row + 1]
+            )
+    return handles
+
+
+def _resolve_spikes(spikes):
+    """Resolve a single `SpikeHandle`, pass through everything else."""
+    if isinstance(spikes, SpikeHandle):
+        return spikes.resolve()
+    return spikes
+
+
+# ------------------------------------------------------------------------------ #
+# Memory-mapped spike access
+# ------------------------------------------------------------------------------ #
+
+# directory for uncompressed, memory-mapped copies of the spike data.
+# None: read from the (compressed) hdf5 files.
+mmap_cache_dir = None
+
+
+def set_mmap_cache_dir(directory):
+    """
+    Set the module-wide default for `load_spikes(mmap_dir=...)`.
+    Call this on every (dask) worker, or pass `mmap_dir` explicitly.
+    None disables memory mapping.
+    """
+    global mmap_cache_dir
+    if directory is not None:
+        directory = os.path.abspath(os.path.expanduser(directory))
+    mmap_cache_dir = directory
+
+
+def _mmap_session(filepath, mmap_dir):
+    """
+    Memory-mapped spike data of all blocks of a session file.
+
+    On first use (or when the session file changed), every block is written as
+    uncompressed `.npy` (flat spiketimes and offsets) into a subdirectory of
+    `mmap_dir`. The spiketimes are then opened with `np.load(mmap_mode="r")`.
+
+    # Returns
+    dict : spikes key -> (values, offsets), values is a read-only np.memmap
+    """
+    filepath = os.path.abspath(filepath)
+    stat = os.stat(filepath)
+    source = dict(filepath=filepath, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+    # name after the file, but make sure different directories do not collide
+    name = os.path.basename(filepath).replace(".h5", "")
+    name += "_" + hashlib.md5(filepath.encode()).hexdigest()[:8]
+    target = os.path.join(os.path.abspath(os.path.expanduser(mmap_dir)), name)
+
+    info = _read_mmap_info(target)
+    if info is None or info["source"] != source:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # only one process builds the cache, the others wait and use it.
+        # the lock file stays, removing it would race with processes waiting on it.
+        with open(f"{target}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                info = _read_mmap_info(target)
+                if info is None or info["source"] != source:
+                    _build_mmap_cache(filepath, source, target)
+                    info = _read_mmap_info(target)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        if info is None or info["source"] != source:
+            raise ValueError(f"Failed to create mmap cache for {filepath} in {target}")
+
+    res = dict()
+    for key, fname in info["files"].items():
+        values = np.load(os.path.join(target, f"{fname}.values.npy"), mmap_mode="r")
+        offsets = np.load(os.path.join(target, f"{fname}.offsets.npy"))
+        res[key] = (values, offsets)
+    return res
+
+
+def _build_mmap_cache(filepath, source, target):
+    """
+    Write the `.npy` files of all blocks into a temporary directory, and then
+    replace the (outdated) cache at `target`. Call with the lock held.
+    """
+    log.debug(f"Creating mmap cache for {filepath} in {target}")
+    tmp_dir = f"{target}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    files = dict()
+    with h5py.File(filepath, "r") as f:
+        for _, key in _iter_blocks(f):
+            values, offsets = _read_ragged(f, key)
+            fname = key.strip("/").replace("/", "__")
+            np.save(os.path.join(tmp_dir, f"{fname}.values.npy"), values)
+            np.save(os.path.join(tmp_dir, f"{fname}.offsets.npy"), offsets)
+            files[key] = fname
+
+    # the info file marks a complete cache
+    with open(os.path.join(tmp_dir, "info.json"), "w") as f:
+        json.dump(dict(source=source, files=files), f)
+
+    # processes that still map the outdated files keep them until they are done
+    shutil.rmtree(target, ignore_errors=True)
+    os.rename(tmp_dir, target)
+
+
+def _read_mmap_info(target):
+    """info.json of an mmap cache directory, or None if it does not exist (yet)"""
+    try:
+        with open(os.path.join(target, "info.json"), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# ------------------------------------------------------------------------------ #
+# Converting session files
+# ------------------------------------------------------------------------------ #
+
+
+def convert_session_to_ragged(
+    filepath, target=None, compression="gzip", compression_opts=9
+):
+    """
+    Rewrite a session file so that all blocks use the ragged layout:
+    a flat `_spiketimes` array per block and an `_offsets` array of length
+    num_units + 1. Metadata is copied as is. Blocks that already are ragged
+    are copied, too.
+
+    # Parameters
+    filepath : str, session file to convert
+    target : str or None, where to write the converted file.
+        default: None, replace the original file (after successful conversion)
+    compression, compression_opts : passed to `h5py.create_dataset`
+
+    # Returns
+    target : str, path of the converted file
+    """
+
+    filepath = os.path.abspath(os.path.expanduser(filepath))
+    in_place = target is None
+    if in_place:
+        target = f"{filepath}.{os.getpid()}.tmp"
+    target = os.path.abspath(os.path.expanduser(target))
+
+    with h5py.File(filepath, "r") as src, h5py.File(target, "w", libver="latest") as dst:
+        # everything but the spike data is copied as is
+        keys = [key for _, key in _iter_blocks(src)]
+        _copy_except(src, dst, skip=_full_names(keys, _spike_kinds))
+
+        for key in keys:
+            values, offsets = _read_ragged(src, key)
+            dst.create_dataset(
+                key,
+                data=values,
+                chunks=_spike_chunks(values.shape),
+                compression=compression,
+                compression_opts=compression_opts,
+            )
+            dst.create_dataset(
+                _block_key(key, "offsets"),
+                data=offsets,
+                compression=compression,
+                compression_opts=compression_opts,
+            )
+
+    log.debug(
+        f"Converted {filepath} ({naturalsize(os.path.getsize(filepath))}) to ragged"
+        f" layout ({naturalsize(os.path.getsize(target))})"
+    )
+
+    if in_place:
+        os.replace(target, filepath)
+        target = filepath
+
+    return target
+
+
+def convert_session_to_groups(filepath, target=None):
+    """
+    Rewrite a session file from flat keys in the file root
+    (`session_{session}_stimulus_{stimulus}_stimulus_block_{block}_{kind}`)
+    to groups `/{session}/{stimulus}/{block}/{kind}`. Block groups carry
+    `session`, `stimulus` and `block` attributes (stimulus groups the first two,
+    session groups the first). Datasets are copied as they are, already grouped
+    blocks, too.
+
+    # Parameters
+    filepath : str, session file to convert
+    target : str or None, where to write the converted file.
+        default: None, replace the original file (after successful conversion)
+
+    # Returns
+    target : str, path of the converted file
+    """
+
+    filepath = os.path.abspath(os.path.expanduser(filepath))
+    in_place = target is None
+    if in_place:
+        target = f"{filepath}.{os.getpid()}.tmp"
+    target = os.path.abspath(os.path.expanduser(target))
+
+    with h5py.File(filepath, "r") as src, h5py.File(target, "w", libver="latest") as dst:
+        for key, value in src.attrs.items():
+            dst.attrs[key] = value
+
+        for key in src.keys():
+            try:
+                parts = _key_to_parts(key)
+            except (AttributeError, ValueError):
+                # not a flat block key, e.g. an already grouped session
+                src.copy(src[key], dst, name=key)
+                continue
+
+            group = dst.require_group(str(parts["session"]))
+            group.attrs["session"] = parts["session"]
+            group = group.require_group(parts["stimulus"])
+            group.attrs["session"] = parts["session"]
+            group.attrs["stimulus"] = parts["stimulus"]
+            group = group.require_group(parts["block"])
+            for part in ["session", "stimulus", "block"]:
+                group.attrs[part] = parts[part]
+            src.copy(src[key], group, name=parts["kind"])
+
+    if in_place:
+        os.replace(target, filepath)
+        target = filepath
+
+    return target
+
+
+def _spike_chunks(shape, chunk_len=4096):
+    """
+    Chunk shape for spike datasets, such that reading a single unit only
+    needs to decompress few (small) chunks.
+    - ragged (1d): `chunk_len` spikes per chunk.
+    - nan-padded (2d): one unit per chunk.
+    returns None (let h5py decide) for empty datasets.
+    """
+    if np.prod(shape) == 0:
+        return None
+    if len(shape) == 1:
+        return (min(shape[0], chunk_len),)
+    return (1, shape[1])
+
+
+def repack_session_file(
+    filepath, target=None, chunks="unit", codec="gzip", level=4, benchmark=True
+):
+    """
+    Rewrite the spike datasets of a session file with a different chunk shape
+    and compression codec. Key names, layouts (ragged or nan-padded) and
+    metadata stay as they are.
+
+    # Parameters
+    filepath : str, session file to repack
+    target : str or None, where to write the repacked file.
+        default: None, replace the original file (after successful repacking)
+    chunks : "unit", "auto" or int
+        - "unit": one unit per chunk for nan-padded blocks. ragged blocks
+            get chunks of the mean number of spikes per unit.
+        - "auto": let h5py decide.
+        - int: number of spikes (ragged) or units (nan-padded) per chunk.
+    codec : "gzip", "lzf", "blosc", "lz4" or None (no compression).
+        blosc and lz4 need `hdf5plugin`, we fall back to gzip if it is missing.
+    level : int, compression level for gzip and blosc
+    benchmark : bool, whether to time reads before and after repacking.
+
+    # Returns
+    report : dict with the `target` path, file sizes in bytes (`size_before`,
+        `size_after`) and, if `benchmark`, read throughput
+        `block_mb_per_s_before/after` (reading complete blocks) and
+        `unit_ms_before/after` (mean time to read a single unit).
+    """
+
+    filepath = os.path.abspath(os.path.expanduser(filepath))
+    in_place = target is None
+    if in_place:
+        target = f"{filepath}.{os.getpid()}.tmp"
+    target = os.path.abspath(os.path.expanduser(target))
+
+    codec_kwargs = _codec_kwargs(codec, level)
+    report = dict(target=target, size_before=os.path.getsize(filepath))
+    if benchmark:
+        for k, v in _benchmark_spike_reads(filepath).items():
+            report[f"{k}_before"] = v
+
+    with h5py.File(filepath, "r") as src, h5py.File(target, "w", libver="latest") as dst:
+        keys = [key for _, key in _iter_blocks(src)]
+        _copy_except(src, dst, skip=_full_names(keys, ["spiketimes"]))
+
+        for key in keys:
+            dset = src[key]
+            data = dset[:]
+            num_units = (
+                len(src[_block_key(key, "offsets")]) - 1
+                if dset.ndim == 1
+                else dset.shape[0]
+            )
+            this_chunks = _repack_chunks(data.shape, num_units, chunks)
+            new_dset = dst.create_dataset(
+                key,
+                data=data,
+                chunks=this_chunks,
+                **(codec_kwargs if this_chunks is not None else {}),
+            )
+            for attr_key, attr_value in dset.attrs.items():
+                new_dset.attrs[attr_key] = attr_value
+
+    report["size_after"] = os.path.getsize(target)
+
+    if in_place:
+        os.replace(target, filepath)
+        target = filepath
+        report["target"] = target
+
+    if benchmark:
+        for k, v in _benchmark_spike_reads(target).items():
+            report[f"{k}_after"] = v
+
+    log.debug(
+        f"Repacked {filepath} with codec {codec}, chunks {chunks}:"
+        f" {naturalsize(report['size_before'])} -> {naturalsize(report['size_after'])}"
+    )
+
+    return report
+
+
+def _codec_kwargs(codec, level):
+    """
+    Keyword arguments for `h5py.create_dataset` that select the compression.
+    """
+    if codec is None or codec == "none":
+        return dict()
+    if codec == "gzip":
+        return dict(compression="gzip", compression_opts=level, shuffle=True)
+    if codec == "lzf":
+        return dict(compression="lzf", shuffle=True)
+    if codec in ["blosc", "lz4"]:
+        if hdf5plugin is None:
+            log.warning(f"hdf5plugin is not installed, using gzip instead of {codec}")
+            return _codec_kwargs("gzip", level)
+        if codec == "lz4":
+            return dict(**hdf5plugin.LZ4())
+        return dict(
+            **hdf5plugin.Blosc(
+                cname="lz4", clevel=level, shuffle=hdf5plugin.Blosc.SHUFFLE
+            )
+        )
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def _repack_chunks(shape, num_units, chunks):
+    """
+    Chunk shape for `repack_session_file`, see there for the options.
+    """
+    if np.prod(shape) == 0:
+        return None
+    if chunks == "auto":
+        return True
+    if len(shape) == 1:
+        if chunks == "unit":
+            chunk_len = int(np.ceil(shape[0] / max(num_units, 1)))
+        else:
+            chunk_len = int(chunks)
+        return (max(1, min(shape[0], chunk_len)),)
+    units_per_chunk = 1 if chunks == "unit" else int(chunks)
+    return (max(1, min(shape[0], units_per_chunk)), shape[1])
+
+
+def _benchmark_spike_reads(filepath, num_units=50, seed=42):
+    """
+    Time reading the spike datasets of a session file.
+
+    # Returns
+    dict with `block_mb_per_s`, throughput when reading complete blocks,
+        and `unit_ms`, mean time to read a single (random) unit.
+    """
+    rng = np.random.default_rng(seed)
+    with h5py.File(filepath, "r") as f:
+        keys = [key for _, key in _iter_blocks(f)]
+
+        nbytes = 0
+        t_blocks = 0.0
+        units = []
+        for key in keys:
+            t = time.perf_counter()
+            values, offsets = _read_ragged(f, key)
+            t_blocks += time.perf_counter() - t
+            nbytes += values.nbytes + offsets.nbytes
+            units.extend((key, row) for row in range(len(offsets) - 1))
+
+        t_units = 0.0
+        picks = rng.permutation(len(units))[:num_units]
+        for idx in picks:
+            key, row = units[idx]
+            t = time.perf_counter()
+            _read_ragged(f, key, rows=np.array([row]))
+            t_units += time.perf_counter() - t
+
+    return dict(
+        block_mb_per_s=nbytes / 1024**2 / t_blocks if t_blocks > 0 else np.nan,
+        unit_ms=1e3 * t_units / len(picks) if len(picks) > 0 else np.nan,
+    )
+
+
+def backfill_spike_stats(filepath, target=None):
+    """
+    Add per-unit spike stats to the metadata of every block of a session file
+    written before the writer stored them. See `_unit_spike_stats` for the
+    columns. Existing stats columns are recomputed, everything else is kept.
+
+    With the stats in place, `all_unit_metadata` has the exact `num_spikes` and
+    `default_filter` checks the durations that `prepare_spike_times` requires
+    without reading spikes.
+
+    # Parameters
+    filepath : str, session file
+    target : str or None, where to write the updated file.
+        default: None, replace the original file (after successful update)
+
+    # Returns
+    target : str, path of the updated file
+    """
+
+    filepath = os.path.abspath(os.path.expanduser(filepath))
+    in_place = target is None
+    if in_place:
+        target = f"{filepath}.{os.getpid()}.tmp"
+    target = os.path.abspath(os.path.expanduser(target))
+
+    frames = dict()
+    with h5py.File(filepath, "r") as src, h5py.File(target, "w", libver="latest") as dst:
+        spikes_keys = [key for _, key in _iter_blocks(src)]
+        _copy_except(src, dst, skip=_full_names(spikes_keys, ["metadata"]))
+
+        for spikes_key in spikes_keys:
+            key = _block_key(spikes_key, "metadata")
+            meta_df = _read_hdf_frame(src[key])
+            values, offsets = _read_ragged(src, spikes_key)
+            if len(offsets) - 1 != len(meta_df):
+                raise ValueError(f"Metadata and spikes of {key} have different lengths")
+            for col, stat in _unit_spike_stats(values, offsets).items():
+                meta_df[col] = stat
+            frames[key] = meta_df
+
+    # pandas writes the metadata frames, as the download script does
+    for key, meta_df in frames.items():
+        meta_df.to_hdf(target, key=key)
+
+    if in_place:
+        os.replace(target, filepath)
+        target = filepath
+
+    return target
+
+
+_spike_stat_columns = ["num_spikes", "t_first", "t_last", "isi_mean", "isi_cv"]
+
+
+def _unit_spike_stats(values, offsets):
+    """
+    Per-unit summary stats of a ragged block, as stored in the metadata.
+
+    # Returns
+    dict of 1d arrays, one entry per unit:
+    - num_spikes : int64
+    - t_first, t_last : float64, first and last spike, nan without spikes
+    - isi_mean, isi_cv : float64, mean and coefficient of variation of the
+        inter-spike intervals, nan with less than two spikes.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    num_spikes, t_first, t_last = _ragged_stats(values, offsets)
+    num_units = len(num_spikes)
+
+    # intervals within units: drop the ones that span two units
+    unit_of_spike = np.repeat(np.arange(num_units), num_spikes)
+    within = unit_of_spike[1:] == unit_of_spike[:-1]
+    isis = np.diff(values)[within]
+    unit_of_isi = unit_of_spike[1:][within]
+
+    num_isis = np.bincount(unit_of_isi, minlength=num_units)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        isi_mean = np.bincount(unit_of_isi, isis, minlength=num_units) / num_isis
+        deviations = (isis - isi_mean[unit_of_isi]) ** 2
+        isi_std = np.sqrt(
+            np.bincount(unit_of_isi, deviations, minlength=num_units) / num_isis
+        )
+        isi_cv = isi_std / isi_mean
+
+    return dict(
+        num_spikes=num_spikes.astype(np.int64),
+        t_first=t_first,
+        t_last=t_last,
+        isi_mean=isi_mean,
+        isi_cv=isi_cv,
+    )
+
+
+# ------------------------------------------------------------------------------ #
+# Sample-index encoding
+# ------------------------------------------------------------------------------ #
+
+# neuropixels probes sample at (nominally) 30 kHz. spiketimes that are stored
+# in seconds are rounded to this grid when we need sample indices.
+default_sampling_rate = 30000.0
+
+
+def convert_session_to_samples(
+    filepath,
+    target=None,
+    sampling_rate=None,
+    compression="gzip",
+    compression_opts=9,
+):
+    """
+    Rewrite a session file so that spikes are stored as integer sample indices
+    instead of float seconds. Per block and unit, we keep the first sample
+    (`_base`, int64) and the differences between consecutive samples, bit-packed
+    with the smallest width that fits the longest inter-spike interval of the unit
+    (`_bits`). The packed bytes of all units go into the `_spiketimes` dataset
+    (uint8, each unit starting at a full byte), `_offsets` stays as in the ragged
+    layout. Metadata is copied as is.
+
+    Loading is transparent, `load_session` and `load_spikes` decode to float64
+    seconds. `load_spikes(format="samples")` gives the sample indices, which
+    `binned_spike_count` can bin without going through floats.
+
+    # Parameters
+    filepath : str, session file to convert
+    target : str or None, where to write the converted file.
+        default: None, replace the original file (after successful conversion)
+    sampling_rate : float or None, samples per second to round to.
+        default: None, `default_sampling_rate`. Already encoded blocks are
+        copied with their sampling rate.
+    compression, compression_opts : passed to `h5py.create_dataset`
+
+    # Returns
+    target : str, path of the converted file
+    """
+
+    if sampling_rate is None:
+        sampling_rate = default_sampling_rate
+
+    filepath = os.path.abspath(os.path.expanduser(filepath))
+    in_place = target is None
+    if in_place:
+        target = f"{filepath}.{os.getpid()}.tmp"
+    target = os.path.abspath(os.path.expanduser(target))
+
+    with h5py.File(filepath, "r") as src, h5py.File(target, "w", libver="latest") as dst:
+        keys = [key for _, key in _iter_blocks(src)]
+        _copy_except(src, dst, skip=_full_names(keys, _spike_kinds))
+
+        for key in keys:
+            if _is_sample_encoded(src[key]):
+                this_rate = _sampling_rate(src[key])
+                samples, offsets = _read_samples(src, key)
+            else:
+                this_rate = sampling_rate
+                values, offsets = _read_ragged(src, key)
+                samples = _seconds_to_samples(values, this_rate)
+
+            base, bits, packed = _encode_samples(samples, offsets)
+            dset = dst.create_dataset(
+                key,
+                data=packed,
+                chunks=_spike_chunks(packed.shape),
+                compression=compression,
+                compression_opts=compression_opts,
+            )
+            dset.attrs["encoding"] = "delta_samples"
+            dset.attrs["sampling_rate"] = this_rate
+            for kind, data in [("offsets", offsets), ("base", base), ("bits", bits)]:
+                dst.create_dataset(
+                    _block_key(key, kind),
+                    data=data,
+                    compression=compression,
+                    compression_opts=compression_opts,
+                )
+
+    log.debug(
+        f"Converted {filepath} ({naturalsize(os.path.getsize(filepath))}) to sample"
+        f" indices ({naturalsize(os.path.getsize(target))})"
+    )
+
+    if in_place:
+        os.replace(target, filepath)
+        target = filepath
+
+    return target
+
+
+def _is_sample_encoded(dset):
+    """Whether a `_spiketimes` dataset holds bit-packed sample indices."""
+    return _decode_attr(dset.attrs.get("encoding", "")) == "delta_samples"
+
+
+def _sampling_rate(dset):
+    """Sampling rate of a `_spiketimes` dataset, `default_sampling_rate` if unset."""
+    return float(dset.attrs.get("sampling_rate", default_sampling_rate))
+
+
+def _seconds_to_samples(values, sampling_rate):
+    """Round spiketimes in seconds to int64 sample indices."""
+    return np.round(np.asarray(values, dtype=np.float64) * sampling_rate).astype(
+        np.int64
+    )
+
+
+def _encode_samples(samples, offsets):
+    """
+    Delta-encode and bit-pack ragged int64 sample indices.
+
+    # Returns
+    base : int64 array, first sample of every unit (0 for units without spikes)
+    bits : uint8 array, bit width of the deltas of every unit
+    packed : uint8 array, the deltas of all units, every unit starts at a new byte
+    """
+    counts = np.diff(offsets)
+    max_delta, min_delta = _delta_range(samples, offsets)
+    if min_delta < 0:
+        raise ValueError("Spiketimes have to be sorted to encode them as samples")
+
+    bits = np.zeros(len(counts), dtype=np.int64)
+    has_deltas = counts > 1
+    # bit length. log2 may be off by one for large numbers, which the check fixes
+    bits[has_deltas] = np.floor(np.log2(np.maximum(max_delta[has_deltas], 1))) + 1
+    bits[has_deltas] += (max_delta[has_deltas] >> bits[has_deltas]) > 0
+    if np.any(bits > 56):
+        raise ValueError("Inter-spike intervals are too long to be bit-packed")
+
+    base = np.zeros(len(counts), dtype=np.int64)
+    base[counts > 0] = samples[offsets[:-1][counts > 0]]
+    byte_offsets = _packed_byte_offsets(counts, bits)
+    packed = _pack_deltas(samples, offsets, bits, byte_offsets)
+
+    return base, bits.astype(np.uint8), packed
+
+
+def _read_samples(f, key, rows=None):
+    """
+    Read and decode the sample indices of a block written by
+    `convert_session_to_samples`. Parameters and returns as `_read_ragged`,
+    but values are int64 sample indices.
+    """
+    dset = f[key]
+    offsets = f[_block_key(key, "offsets")][:].astype(np.int64)
+    base = f[_block_key(key, "base")][:].astype(np.int64)
+    bits = f[_block_key(key, "bits")][:].astype(np.int64)
+    counts = np.diff(offsets)
+    byte_offsets = _packed_byte_offsets(counts, bits)
+
+    if rows is None:
+        packed = dset[:]
+    else:
+        # only the bytes of the selected units
+        rows = np.asarray(rows, dtype=np.int64)
+        packed, byte_offsets = _read_rows(dset, byte_offsets, rows)
+        counts, base, bits = counts[rows], base[rows], bits[rows]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+    samples = _unpack_deltas(packed, byte_offsets, counts, bits, base)
+    return samples, offsets
+
+
+def _packed_byte_offsets(counts, bits):
+    """Where the packed deltas of each unit start, length num_units + 1."""
+    num_bytes = (np.maximum(counts - 1, 0) * bits + 7) // 8
+    byte_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(num_bytes, out=byte_offsets[1:])
+    return byte_offsets
+
+
+@jit(nopython=True, parallel=False, fastmath=False, cache=True)
+def _delta_range(samples, offsets):
+    """
+    Largest difference between consecutive samples, per unit, and the smallest
+    difference across all units (negative if spikes are not sorted).
+    """
+    num_n = len(offsets) - 1
+    max_delta = np.zeros(num_n, dtype=np.int64)
+    min_delta = 0
+    for n_id in range(num_n):
+        for idx in range(offsets[n_id] + 1, offsets[n_id + 1]):
+            delta = samples[idx] - samples[idx - 1]
+            max_delta[n_id] = max(max_delta[n_id], delta)
+            min_delta = min(min_delta, delta)
+    return max_delta, min_delta
+
+
+@jit(nopython=True, parallel=False, fastmath=False, cache=True)
+def _pack_deltas(samples, offsets, bits, byte_offsets):
+    """
+    Write the deltas of each unit with `bits[n_id]` bits each, little-endian,
+    starting at `byte_offsets[n_id]`.
+    """
+    packed = np.zeros(byte_offsets[-1], dtype=np.uint8)
+    for n_id in range(len(offsets) - 1):
+        acc = np.uint64(0)
+        num_acc = 0
+        pos = byte_offsets[n_id]
+        for idx in range(offsets[n_id] + 1, offsets[n_id + 1]):
+            delta = np.uint64(samples[idx] - samples[idx - 1])
+            acc |= delta << np.uint64(num_acc)
+            num_acc += bits[n_id]
+            while num_acc >= 8:
+                packed[pos] = np.uint8(acc & np.uint64(0xFF))
+                acc >>= np.uint64(8)
+                num_acc -= 8
+                pos += 1
+        if num_acc > 0:
+            packed[pos] = np.uint8(acc & np.uint64(0xFF))
+    return packed
+
+
+@jit(nopython=True, parallel=False, fastmath=False, cache=True)
+def _unpack_deltas(packed, byte_offsets, counts, bits, base):
+    """
+    Inverse of `_pack_deltas`, returns the flat int64 samples of all units.
+    """
+    samples = np.empty(np.sum(counts), dtype=np.int64)
+    out = 0
+    for n_id in range(len(counts)):
+        if counts[n_id] == 0:
+            continue
+        samples[out] = base[n_id]
+        width = bits[n_id]
+        mask = (np.uint64(1) << np.uint64(width)) - np.uint64(1)
+        acc = np.uint64(0)
+        num_acc = 0
+        pos = byte_offsets[n_id]
+        for idx in range(out + 1, out + counts[n_id]):
+            while num_acc < width:
+                acc |= np.uint64(packed[pos]) << np.uint64(num_acc)
+                num_acc += 8
+                pos += 1
+            samples[idx] = samples[idx - 1] + np.int64(acc & mask)
+            acc >>= np.uint64(width)
+            num_acc -= width
+        out += counts[n_id]
+    return samples
+
+
+# ------------------------------------------------------------------------------ #
+# Saving the dataframe
+# ------------------------------------------------------------------------------ #
+
+
+# struct columns from dicts get this extra field, holding the keys of each dict.
+# it tells apart missing keys, None values and cells that were nan, not a dict.
+_dict_keys_field = "__keys__"
+
+
+def save_dataframe(meta_df, path, cols_to_skip=None, compression="zstd"):
+    """
+    Save the dataframe as parquet, so that single columns can be loaded without
+    reading the whole file (`load_dataframe(path, columns=[...])`).
+
+    Object columns are stored with proper arrow types instead of pickles:
+    - spike trains (1d numeric arrays) become list columns
+    - dicts, e.g. the `tau_R_details` or `tau_single_details` of the fits, become
+        struct columns. numpy values are converted, 2d arrays (e.g. `pcov`)
+        are stored as lists of lists. nan stays nan, and every dict comes back
+        with the keys it had.
+
+    # Parameters
+    meta_df : dataframe to save, index is kept
+    path : str, file to write, ending in `.parquet` (not `.h5`, that is what
+        we used to write with `to_hdf`)
+    cols_to_skip : list of column names that are not saved
+    compression : parquet compression codec, default "zstd"
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if os.path.splitext(path)[1] in [".h5", ".hdf5"]:
+        raise ValueError(f"save_dataframe writes parquet, use a .parquet file: {path}")
+
+    if cols_to_skip is None:
+        cols_to_skip = []
+    cols_to_save = [c for c in meta_df.columns if c not in cols_to_skip]
+    df_to_save = meta_df[cols_to_save].copy(deep=False)
+
+    # arrow infers everything but the dicts, those we convert ourselves
+    dict_cols = dict()
+    for col in cols_to_save:
+        if df_to_save[col].dtype != object:
+            continue
+        values = df_to_save[col].to_numpy()
+        if _is_dict_column(values):
+            dict_cols[col] = values
+            df_to_save[col] = None
+        else:
+            df_to_save[col] = [_to_arrow_value(v) for v in values]
+
+    try:
+        table = pa.Table.from_pandas(df_to_save, preserve_index=True)
+        for col, values in dict_cols.items():
+            table = table.set_column(
+                table.schema.get_field_index(str(col)),
+                str(col),
+                _dict_column_to_arrow(values),
+            )
+    except (pa.ArrowException, TypeError, ValueError) as e:
+        raise TypeError(f"Cannot convert dataframe to arrow: {e}") from e
+
+    pq.write_table(table, path, compression=compression)
+
+
+def load_dataframe(path, columns=None):
+    """
+    Load a dataframe written by `save_dataframe`.
+
+    # Parameters
+    path : str, parquet file. hdf5 files, as written by older versions with
+        `to_hdf`, are read with `pd.read_hdf(path, key="meta_df")`.
+    columns : list of column names to load, default None loads all.
+        only these columns are read from disk, the index is always included.
+        (for hdf5 files, everything is read and then selected)
+
+    # Returns
+    meta_df : pandas.DataFrame. list columns hold numpy arrays, struct
+        columns hold dicts.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    with open(path, "rb") as f:
+        is_hdf5 = f.read(8) == b"\x89HDF\r\n\x1a\n"
+    if is_hdf5:
+        meta_df = pd.read_hdf(path, key="meta_df")
+        return meta_df if columns is None else meta_df[columns]
+
+    table = pq.read_table(path, columns=columns, use_pandas_metadata=True)
+    meta_df = table.to_pandas()
+
+    for field in table.schema:
+        if pa.types.is_struct(field.type) and field.type.get_field_index(
+            _dict_keys_field
+        ) >= 0:
+            meta_df[field.name] = _object_array(
+                [_restore_dict(v) for v in meta_df[field.name].to_numpy()]
+            )
+        elif pa.types.is_struct(field.type):
+            meta_df[field.name] = [
+                _restore_nested(v) for v in meta_df[field.name].to_numpy()
+            ]
+
+    return meta_df
+
+
+def _is_nan_scalar(value):
+    return isinstance(value, (float, np.floating)) and np.isnan(value)
+
+
+def _is_dict_column(values):
+    """True if all cells are dicts, None or nan, and at least one is a dict."""
+    has_dict = False
+    for v in values:
+        if isinstance(v, dict):
+            has_dict = True
+        elif not (v is None or _is_nan_scalar(v)):
+            return False
+    return has_dict
+
+
+def _dict_column_to_arrow(values):
+    """
+    Struct array from dicts, None (null) and nan cells, see `_dict_keys_field`.
+    Converted without pandas semantics, so that nan values stay nan.
+    """
+    import pyarrow as pa
+
+    rows = []
+    for v in values:
+        if v is None:
+            rows.append(None)
+        elif isinstance(v, dict):
+            row = _to_arrow_value(v)
+            row[_dict_keys_field] = list(row.keys())
+            rows.append(row)
+        else:
+            rows.append({_dict_keys_field: None})
+    return pa.array(rows, from_pandas=False)
+
+
+def _restore_dict(value):
+    """Inverse of `_dict_column_to_arrow`, for one cell."""
+    if value is None:
+        return None
+    keys = value[_dict_keys_field]
+    if keys is None:
+        return np.nan
+    return {k: _restore_nested(value[k]) for k in keys}
+
+
+def _to_arrow_value(value):
+    """Recursively make nested python / numpy values digestible for arrow."""
+    if isinstance(value, dict):
+        return {str(k): _to_arrow_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_arrow_value(v) for v in value]
+    if isinstance(value, np.ndarray):
+        if value.ndim > 1:
+            return [_to_arrow_value(v) for v in value]
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, SpikeHandle):
+        return value.resolve()
+    return value
+
+
+def _restore_nested(value):
+    """
+    Inverse of `_to_arrow_value` for values read back from struct columns:
+    lists of equally long arrays become 2d arrays again.
+    """
+    if isinstance(value, dict):
+        return {k: _restore_nested(v) for k, v in value.items()}
+    if isinstance(value, np.ndarray) and value.dtype == object and len(value) > 0:
+        restored = np.empty(len(value), dtype=object)
+        for idx, v in enumerate(value):
+            restored[idx] = _restore_nested(v)
+        if all(isinstance(v, np.ndarray) for v in restored) and len(
+            set(v.shape for v in restored)
+        ) == 1:
+            return np.stack(restored)
+        return restored
+    return value
+
+
+# ------------------------------------------------------------------------------ #
+# spike processing
+# ------------------------------------------------------------------------------ #
+
+
+def binned_spike_count(spiketimes, bin_size, sampling_rate=None):
+    """
+    Get a number of spike counts in a time bin, per neuron.
+
+    Parameters
+    ----------
+    spiketimes : list of arrays (of different lengths) or 2d nan-padded array
+        where first dim is neuron/block and second index are spiketimes.
+        for a single neuron, pass `[your_spiketimes_as_array]`.
+        `SpikeHandle`s (from lazy loading) are resolved.
+        for spikes that already are in the ragged layout, use `binned_ragged_count`.
+    bin_size :
+        float, in units of spiketimes (seconds if `sampling_rate` is given)
+    sampling_rate : float or None
+        if given, spiketimes are integer sample indices (e.g. from
+        `load_spikes(format="samples")`) and are binned without converting
+        them to float. default: None, spiketimes are floats.
 
     Returns
     -------
-    counts : 2d array
+    counts : 2d array of unsigned integers
         time series of the counted number of spikes per bin,
-        one row for each neuron, in steps of bin_size
+        one row for each neuron, in steps of bin_size.
+        uint8, unless a bin holds more than 255 spikes (then uint16 or uint32).
 
     Notes
     -----
@@ -1060,66 +3355,1033 @@ def binned_spike_count(spiketimes, bin_size):
         the spike times are aligned to the first one in the block.
     """
     # type checking is easier here than in numba
+    if isinstance(spiketimes, SpikeHandle):
+        spiketimes = spiketimes.resolve()
+    elif isinstance(spiketimes, (list, tuple, np.ndarray, pd.Series)) and np.any(
+        [isinstance(st, SpikeHandle) for st in spiketimes]
+    ):
+        spiketimes = resolve_spikes(spiketimes)
+
     if len(spiketimes) == 0:
         return np.array([])
 
-    # this is only needed because we want to use numba, which doesnt like xarray
+    if sampling_rate is not None:
+        return _bin_samples(spiketimes, bin_size, sampling_rate)
+
+    spiketimes = _as_trains(spiketimes)
+
+    # nan-padded or ragged, as flat values and offsets
+    values, offsets = _spikes_to_ragged(spiketimes)
+    if values.dtype not in [np.float32, np.float64]:
+        values = values.astype(np.float64)
+
+    log.debug(f"Binning spiketimes: {len(offsets) - 1} trains, {len(values)} spikes")
+    return binned_ragged_count(values, offsets, bin_size)
+
+
+def _as_trains(spiketimes):
+    """
+    List of 1d spike trains from what `binned_spike_count` accepts:
+    a single train, a 2d (nan-padded) array, or any sequence of trains,
+    e.g. a list of arrays with different lengths or a `pd.Series`.
+    xarrays become numpy arrays, numba does not like them.
+    """
     if isinstance(spiketimes, xr.DataArray):
         spiketimes = spiketimes.to_numpy()
-    elif isinstance(spiketimes, list):
-        if isinstance(spiketimes[0], xr.DataArray):
-            spiketimes = [spiketimes[n_id].to_numpy() for n_id in range(len(spiketimes))]
 
-    spiketimes = np.array(spiketimes)
-    # now we are sure to have a numpy array. check it's 2d
-    try:
-        len(spiketimes[0])
-    except TypeError:
-        spiketimes = np.array([spiketimes])
+    if isinstance(spiketimes, np.ndarray) and spiketimes.dtype != object:
+        if spiketimes.ndim > 2:
+            raise ValueError(
+                "spiketimes must have at most 2 dimensions: (neuron, time), "
+                f"found {spiketimes.ndim}. Consider `np.squeeze()`"
+            )
+        # a single unit as 1d array, or one row per unit
+        return [spiketimes] if spiketimes.ndim == 1 else list(spiketimes)
 
-    if len(spiketimes.shape) > 2:
-        raise ValueError(
-            "spiketimes must have at most 2 dimensions: (neuron, time), "
-            f"found {len(spiketimes.shape)}. Consider `np.squeeze()`"
-        )
-    # but it might still be ragged, as in differnt length per neuron.
-    # thats fine though.
+    # positional, also for a (filtered) pd.Series
+    trains = list(spiketimes)
+    if np.ndim(trains[0]) == 0:
+        # a single unit, as list of floats
+        return [np.asarray(trains)]
+    return [
+        st.to_numpy() if isinstance(st, xr.DataArray) else np.asarray(st)
+        for st in trains
+    ]
 
-    log.debug(
-        f"Binning spiketimes: dtype {type(spiketimes)} with shape {spiketimes.shape}"
+
+def binned_ragged_count(values, offsets, bin_size, dtype=None):
+    """
+    `binned_spike_count` for spike trains in the ragged layout, e.g. as returned
+    by `prepare_spike_times_batch`: train `i` is `values[offsets[i]:offsets[i+1]]`.
+
+    Each train is aligned to its own first spike, and all trains get the number
+    of bins needed for the longest range across trains.
+
+    # Parameters
+    values : 1d float array, sorted spike times per train
+    offsets : 1d int array, of length num_trains + 1
+    bin_size : float, in units of values
+    dtype : dtype of the counts, default None uses the smallest of
+        uint8, uint16 and uint32 that holds the largest count.
+
+    # Returns
+    counts : 2d array (neuron, time)
+    """
+    values = np.asarray(values)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    # the kernel does not check bounds
+    if (
+        len(offsets) == 0
+        or offsets[0] < 0
+        or offsets[-1] > len(values)
+        or np.any(np.diff(offsets) < 0)
+    ):
+        raise ValueError("offsets must be non-decreasing, within the values")
+    num_bins = _ragged_num_bins(values, offsets, bin_size)
+
+    return _count_into_bins(
+        _binned_spike_count, values, offsets, bin_size, num_bins, dtype
     )
-    return _binned_spike_count(spiketimes, bin_size)
 
 
-@jit(nopython=True, parallel=False, fastmath=False, cache=True)
-def _binned_spike_count(spiketimes, bin_size):
+def _ragged_num_bins(values, offsets, bin_size):
+    """
+    Number of bins `binned_ragged_count` uses: the range across all trains.
+    """
+    starts, ends = offsets[:-1], offsets[1:]
+    non_empty = ends > starts
+    if not np.any(non_empty):
+        return 0
+    # segments between the starts of non-empty trains hold exactly one train,
+    # the last one would run to the end of values.
+    values = values[offsets[0] : offsets[-1]]
+    starts = starts[non_empty] - offsets[0]
+    t_min = float(np.minimum.reduceat(values, starts).min())
+    t_max = float(np.maximum.reduceat(values, starts).max())
+    return int((t_max - t_min) / bin_size) + 1
+
+
+# numba's fallback threading layer, "workqueue", aborts when parallel kernels
+# are called from several threads at once (e.g. dask workers or `iter_units`).
+# tbb (see environment.yaml) and omp are fine. Until numba picked a layer, we
+# do not know which one we get, so we serialize to be safe.
+_workqueue_lock = threading.Lock()
+
+
+def _parallel_kernel_guard():
+    try:
+        layer = numba.threading_layer()
+    except ValueError:
+        layer = None
+    return _workqueue_lock if layer in [None, "workqueue"] else nullcontext()
+
+
+def _count_into_bins(kernel, values, offsets, bin_len, num_bins, dtype):
+    """
+    Run a binning kernel on a fresh (neuron, time) counts matrix. Without a
+    given dtype, start with uint8 and move to larger ones when a count overflows.
     """
-    lower level, here we rely on a 2d array of spiketimes,
-    first dim neuron, second dim spiketimes, nan-padded.
+    num_n = len(offsets) - 1
+    dtypes = [np.uint8, np.uint16, np.uint32] if dtype is None else [dtype]
+    for dtype in dtypes:
+        counts = np.zeros(shape=(num_n, num_bins), dtype=dtype)
+        if np.issubdtype(counts.dtype, np.integer):
+            max_count = np.iinfo(counts.dtype).max
+        else:
+            max_count = np.inf
+        with _parallel_kernel_guard():
+            overflow = kernel(values, offsets, bin_len, counts, max_count)
+        if not overflow:
+            return counts
+        log.debug(f"Spike counts overflow {np.dtype(dtype).name}")
+    raise OverflowError(f"Spike counts do not fit into {np.dtype(dtype).name}")
+
+
+@jit(nopython=True, parallel=True, fastmath=False, cache=True)
+def _binned_spike_count(values, offsets, bin_size, counts, max_count):
+    """
+    lower level, ragged float spiketimes. counts are written into the provided
+    (neuron, time) array, one neuron per thread.
+    Returns True if a count would exceed `max_count`.
     """
-    num_n = len(spiketimes)
+    num_n = len(offsets) - 1
+    overflow = np.zeros(num_n, dtype=np.bool_)
+
+    for n_id in prange(0, num_n):
+        start = offsets[n_id]
+        for idx in range(start, offsets[n_id + 1]):
+            # align to the block-level t min (not the global one). in float64,
+            # as the number of bins, so float32 rounding cannot overshoot it.
+            diff = np.float64(values[idx]) - np.float64(values[start])
+            t_idx = int(diff / bin_size)
+            if counts[n_id, t_idx] >= max_count:
+                overflow[n_id] = True
+                break
+            counts[n_id, t_idx] += 1
 
-    t_min = np.inf
-    t_max = 0
+    return np.any(overflow)
 
-    for n_id in range(0, num_n):
-        t_min = min(t_min, np.nanmin(spiketimes[n_id]))
-        t_max = max(t_max, np.nanmax(spiketimes[n_id]))
 
-    num_bins = int((t_max - t_min) / bin_size) + 1
-    counts = np.zeros(shape=(num_n, num_bins))
+def _bin_samples(spiketimes, bin_size, sampling_rate):
+    """
+    `binned_spike_count` for integer sample indices, same alignment.
+    """
+    trains = [st.astype(np.int64, copy=False) for st in _as_trains(spiketimes)]
+    offsets = np.zeros(len(trains) + 1, dtype=np.int64)
+    np.cumsum([len(st) for st in trains], out=offsets[1:])
+    samples = np.concatenate([np.zeros(0, dtype=np.int64)] + trains)
+
+    # stay in integers when the bins are a whole number of samples
+    bin_len = bin_size * sampling_rate
+    if np.isclose(bin_len, np.round(bin_len)):
+        bin_len = np.int64(np.round(bin_len))
+
+    starts, ends = offsets[:-1], offsets[1:]
+    non_empty = ends > starts
+    num_bins = 0
+    if np.any(non_empty):
+        s_min = samples[starts[non_empty]].min()
+        s_max = samples[ends[non_empty] - 1].max()
+        num_bins = int((s_max - s_min) // bin_len) + 1
+
+    return _count_into_bins(
+        _binned_sample_count, samples, offsets, bin_len, num_bins, None
+    )
+
 
-    for n_id in range(0, num_n):
-        train = spiketimes[n_id]
-        for t in train:
-            # we have nan-padding. stop when that starts
-            if not np.isfinite(t):
+@jit(nopython=True, parallel=True, fastmath=False, cache=True)
+def _binned_sample_count(samples, offsets, bin_len, counts, max_count):
+    """
+    lower level, ragged int64 sample indices. bin_len in samples, either an
+    integer or a float. Same conventions as `_binned_spike_count`.
+    """
+    num_n = len(offsets) - 1
+    overflow = np.zeros(num_n, dtype=np.bool_)
+
+    for n_id in prange(0, num_n):
+        start = offsets[n_id]
+        for idx in range(start, offsets[n_id + 1]):
+            # align to the block-level first spike, as for float spiketimes
+            t_idx = int((samples[idx] - samples[start]) // bin_len)
+            if counts[n_id, t_idx] >= max_count:
+                overflow[n_id] = True
                 break
-            # align to the block-level t min (not the global one)
-            t_idx = int((t - train[0]) / bin_size)
             counts[n_id, t_idx] += 1
 
-    return counts
+    return np.any(overflow)
+
+
+def cached_binned_spike_count(spiketimes, bin_size, unit_id, stimulus):
+    """
+    `binned_spike_count` with a memory, for analyses that bin the same units
+    at several bin sizes.
+
+    Results are cached per `(unit_id, stimulus, bin_size)` in a shared LRU
+    cache with a byte budget (`set_binning_cache_size`), and are read-only.
+    Bin sizes that are a multiple of a cached one are summed up from those
+    counts without touching the spiketimes again. Units with many spikes per
+    bin are binned once at `binning_base_bin_size` (1 ms) to derive all coarser
+    bin sizes from. For sparse units, binning the spikes is cheaper than
+    summing mostly empty bins, so they are binned directly.
+
+    # Parameters
+    spiketimes : as for `binned_spike_count`, the trains (blocks) of one unit
+    bin_size : float, seconds
+    unit_id, stimulus : identify the spikes in the cache. If the same unit is
+        binned from different spikes (e.g. merged and single blocks),
+        make the stimulus unique, e.g. `(stimulus, block)`.
+
+    # Returns
+    counts : 2d array (block, time), as `binned_spike_count`. Up to spikes
+        on the edge of a bin, where floating point rounding may differ,
+        the counts are the same.
+    """
+    return _binning_cache.get(spiketimes, bin_size, (unit_id, stimulus))
+
+
+def set_binning_cache_size(max_bytes):
+    """
+    Set the byte budget of the cache behind `cached_binned_spike_count`.
+    Least recently used counts are evicted first. 0 disables caching.
+    """
+    _binning_cache.resize(int(max_bytes))
+
+
+def clear_binning_cache():
+    """Drop all binned spike counts from the cache."""
+    _binning_cache.clear()
+
+
+binning_base_bin_size = 0.001  # seconds
+
+# summing up bins is cheaper than binning spikes (per element), up to about
+# this many bins per spike.
+_coarsen_bins_per_spike = 2
+
+
+class _BinningCache(_SpikeCache):
+    """
+    Byte-bounded LRU cache of binned counts, keyed by (unit key, bin size).
+    """
+
+    def get(self, spiketimes, bin_size, key):
+        bin_size = float(bin_size)
+        counts = self._lookup((key, bin_size))
+        if counts is not None:
+            return counts
+
+        if isinstance(spiketimes, SpikeHandle):
+            spiketimes = [spiketimes]
+        trains = _as_trains(resolve_spikes(spiketimes))
+        num_spikes = sum(len(st) for st in trains)
+        max_bins = num_spikes * _coarsen_bins_per_spike
+
+        # the coarsest cached bin size we can sum up from
+        source, source_size = None, None
+        with self._lock:
+            for (other_key, other_size), other in self._arrays.items():
+                if other_key != key or not _bin_factor(bin_size, other_size):
+                    continue
+                if source is None or other.size < source.size:
+                    source, source_size = other, other_size
+
+        base_size = binning_base_bin_size
+        if source is None and _bin_factor(bin_size, base_size):
+            duration = sum(st[-1] - st[0] for st in trains if len(st) > 0)
+            if duration / base_size <= max_bins:
+                source, source_size = binned_spike_count(trains, base_size), base_size
+                source.flags.writeable = False
+                self._put((key, base_size), source)
+
+        if source is not None and source.size <= max_bins:
+            counts = _coarsen_counts(source, _bin_factor(bin_size, source_size))
+        else:
+            counts = binned_spike_count(trains, bin_size)
+
+        counts.flags.writeable = False
+        self._put((key, bin_size), counts)
+        return counts
+
+    def _lookup(self, key):
+        with self._lock:
+            counts = self._arrays.get(key)
+            if counts is not None:
+                self._arrays.move_to_end(key)
+            return counts
+
+
+_binning_cache = _BinningCache(max_bytes=1024**3)
+
+
+def _bin_factor(bin_size, finer_bin_size):
+    """
+    How many bins of `finer_bin_size` make up one of `bin_size`,
+    0 if not a whole number.
+    """
+    factor = bin_size / finer_bin_size
+    if factor < 1 or abs(factor - round(factor)) > 1e-6 * factor:
+        return 0
+    return round(factor)
+
+
+def _coarsen_counts(counts, factor):
+    """
+    Sum every `factor` consecutive bins. The last bin holds the remainder,
+    so the number of bins matches binning with `factor * bin_size` directly.
+    """
+    if factor == 1 or counts.size == 0:
+        return counts.copy()
+    num_n, num_bins = counts.shape
+    coarse = np.zeros((num_n, -(-num_bins // factor)), dtype=np.uint32)
+    with _parallel_kernel_guard():
+        _sum_bins(counts, factor, coarse)
+
+    # keep the smallest dtype, as `binned_spike_count`
+    max_count = coarse.max(initial=0)
+    for dtype in [np.uint8, np.uint16]:
+        if max_count <= np.iinfo(dtype).max:
+            return coarse.astype(dtype)
+    return coarse
+
+
+@jit(nopython=True, parallel=True, fastmath=False, cache=True)
+def _sum_bins(counts, factor, coarse):
+    """
+    lower level, add every `factor` consecutive bins of the (neuron, time)
+    counts into `coarse`, one neuron per thread.
+    """
+    num_bins = counts.shape[1]
+    for n_id in prange(0, counts.shape[0]):
+        for c_idx in range(coarse.shape[1]):
+            total = 0
+            for t_idx in range(c_idx * factor, min((c_idx + 1) * factor, num_bins)):
+                total += counts[n_id, t_idx]
+            coarse[n_id, c_idx] = total
+
+
+# ------------------------------------------------------------------------------ #
+# autocorrelation coefficients
+# ------------------------------------------------------------------------------ #
+
+
+def coefficients_fft(binned, steps, dt=1.0, dtunit="ms", max_bytes=256 * 1024**2):
+    """
+    Autocorrelation coefficients as `mre.coefficients(method="ts")`, for many
+    units at once. All lags of a trial come from one zero-padded real FFT,
+    instead of one pass over the time series per lag.
+
+    # Parameters
+    binned : list of spike counts, one entry per unit, each either a 1d time
+        series or a 2d array (trial, time) as for `mre.coefficients`.
+        A 2d array (unit, time) is one single-trial unit per row.
+    steps : `(min_step, max_step)` or an array of steps, as `mre.coefficients`.
+        For a range, max_step is capped at half the trial length, per unit.
+    dt, dtunit : passed on to the results, as for `mre.coefficients`
+    max_bytes : float, the memory that the FFT of a batch of trials may use
+
+    # Returns
+    results : list of `mre.CoefficientResult`, one per unit, to pass to
+        `mre.fit`. No bootstrapping, `stderrs` are None.
+    """
+    import mrestimator as mre
+
+    units = [np.asarray(counts) for counts in binned]
+    units = [counts.reshape(1, -1) if counts.ndim == 1 else counts for counts in units]
+    unit_steps = [_resolve_steps(steps, counts.shape[1]) for counts in units]
+    coefficients = _trial_coefficients_fft(units, unit_steps, max_bytes)
+
+    results = []
+    for counts, steps, trial_rks in zip(units, unit_steps, coefficients):
+        results.append(
+            mre.CoefficientResult(
+                coefficients=np.mean(trial_rks, axis=0),
+                steps=steps,
+                dt=dt,
+                dtunit=dtunit,
+                method="trialseparated",
+                trialactivities=np.mean(counts, axis=1, dtype=np.float64),
+                trialvariances=np.var(counts, axis=1, ddof=1, dtype=np.float64),
+                triallen=counts.shape[1],
+            )
+        )
+    return results
+
+
+def _resolve_steps(steps, num_bins):
+    """
+    The steps `mre.coefficients` uses for a trial of `num_bins`.
+    """
+    steps = np.asarray(steps)
+    if len(steps) != 2:
+        return steps.astype(int)
+    min_step = 1 if steps[0] is None else int(steps[0])
+    max_step = int(num_bins / 10) if steps[1] is None else int(steps[1])
+    if min_step > max_step or min_step < 1:
+        min_step = 1
+    if max_step > num_bins / 2 or max_step < min_step:
+        max_step = int(num_bins / 2)
+    return np.arange(min_step, max_step + 1, dtype=int)
+
+
+def _trial_coefficients_fft(units, unit_steps, max_bytes=256 * 1024**2):
+    """
+    Per-trial coefficients `r_k` for a list of (trial, time) arrays.
+    Trials of the same length (and steps) share FFTs, in batches of at most
+    `max_bytes`. Returns a list of (trial, step) arrays.
+    """
+    res = [None] * len(units)
+    groups = dict()  # (length, max step) -> unit indices
+    for idx, (counts, steps) in enumerate(zip(units, unit_steps)):
+        key = (counts.shape[1], int(steps.max(initial=0)))
+        groups.setdefault(key, []).append(idx)
+
+    for (num_bins, max_step), indices in groups.items():
+        if max_step >= num_bins:
+            raise ValueError(f"Steps up to {max_step} for {num_bins} bins")
+        trials = np.concatenate([units[idx] for idx in indices], axis=0)
+        # linear, not circular, correlation up to the largest lag
+        n_fft = sp_fft.next_fast_len(num_bins + max_step, real=True)
+        batch = max(1, int(max_bytes // (n_fft * 24)))
+        trial_rks = np.concatenate(
+            [
+                _lagged_covariances(trials[start : start + batch], max_step, n_fft)
+                for start in range(0, len(trials), batch)
+            ]
+        )
+        first = 0
+        for idx in indices:
+            last = first + len(units[idx])
+            res[idx] = trial_rks[first:last, unit_steps[idx]]
+            first = last
+
+    return res
+
+
+def _lagged_covariances(trials, max_step, n_fft):
+    """
+    `r_k` of the trialseparated method for lags 0 to `max_step`, for each row.
+    With `x = a[:-k]` and `y = a[k:]`, `r_k = cov(x, y) / var(x)` using the
+    means of x and y, each over the `T - k` overlapping bins.
+    """
+    num_bins = trials.shape[1]
+    # coefficients do not change when shifting a trial, centering first keeps
+    # the differences below from cancelling.
+    a = trials.astype(np.float64)
+    a -= a.mean(axis=1, keepdims=True)
+
+    spectrum = sp_fft.rfft(a, n=n_fft, axis=1, workers=-1)
+    spectrum *= spectrum.conj()
+    sum_xy = sp_fft.irfft(spectrum, n=n_fft, axis=1, workers=-1)[:, : max_step + 1]
+
+    # sums over x (the first T - k bins) and y (the last T - k bins)
+    cum = np.zeros((len(a), num_bins + 1))
+    np.cumsum(a, axis=1, out=cum[:, 1:])
+    cum_sq = np.zeros((len(a), num_bins + 1))
+    np.cumsum(a**2, axis=1, out=cum_sq[:, 1:])
+
+    lags = np.arange(max_step + 1)
+    num = num_bins - lags
+    mean_x = cum[:, num] / num
+    mean_y = (cum[:, -1:] - cum[:, lags]) / num
+    var_x = cum_sq[:, num] / num - mean_x**2
+    cov_xy = sum_xy / num - mean_x * mean_y
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return cov_xy / var_x
+
+
+def event_coefficients(spikes, bin_size, steps, dtunit="s"):
+    """
+    Autocorrelation coefficients as `coefficients_fft` of the binned spikes,
+    but computed from the spike times, without binning.
+
+    The coefficients only need the number of spike pairs that are k bins
+    apart and how many spikes fall into the first and last T - k bins.
+    Pairs are counted in one sorted sweep per train up to the largest step,
+    so the cost scales with spikes x rate x tmax instead of the number of bins.
+    Bins are aligned as in `binned_spike_count`, so the results are the same.
+    Good for low rates, see `spike_coefficients` to choose per unit.
+
+    # Parameters
+    spikes : list with the spiketimes of each unit, either one train (1d) or
+        several trains (trials, as rows of `binned_spike_count`).
+    bin_size : float, in units of spiketimes
+    steps : `(min_step, max_step)` or an array of steps, in bins,
+        as for `coefficients_fft`.
+    dtunit : str, unit of bin_size, passed on to the results
+
+    # Returns
+    results : list of `mre.CoefficientResult`, one per unit, to pass to `mre.fit`
+    """
+    import mrestimator as mre
+
+    units = [_as_trains(resolve_spikes(_as_list(st))) for st in spikes]
+    values, offsets = _spikes_to_ragged([st for trains in units for st in trains])
+    if values.dtype not in [np.float32, np.float64]:
+        values = values.astype(np.float64)
+
+    # trials of a unit share the number of bins, as when binned together
+    unit_trials = np.cumsum([0] + [len(trains) for trains in units])
+    num_bins = np.zeros(len(offsets) - 1, dtype=np.int64)
+    unit_steps = []
+    for u_id in range(len(units)):
+        first, last = unit_trials[u_id], unit_trials[u_id + 1]
+        unit_offsets = offsets[first : last + 1]
+        num_bins[first:last] = _ragged_num_bins(values, unit_offsets, bin_size)
+        unit_steps.append(_resolve_steps(steps, num_bins[first]))
+    max_step = max([int(st.max(initial=0)) for st in unit_steps], default=0)
+
+    sums = [np.zeros((len(num_bins), max_step + 1), dtype=np.int64) for _ in range(4)]
+    with _parallel_kernel_guard():
+        _event_lag_sums(values, offsets, bin_size, num_bins, *sums)
+    pairs, sum_x, sum_y, sum_sq = sums
+
+    # as in `_lagged_covariances`, over the T - k overlapping bins
+    lags = np.arange(max_step + 1)
+    num = (num_bins[:, np.newaxis] - lags).astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_x = sum_x / num
+        mean_y = sum_y / num
+        var_x = sum_sq / num - mean_x**2
+        trial_rks = (pairs / num - mean_x * mean_y) / var_x
+
+    num_spikes = np.diff(offsets)
+    results = []
+    for u_id, steps in enumerate(unit_steps):
+        first, last = unit_trials[u_id], unit_trials[u_id + 1]
+        T = num_bins[first]
+        activities = num_spikes[first:last] / T
+        variances = (sum_sq[first:last, 0] - T * activities**2) / (T - 1)
+        results.append(
+            mre.CoefficientResult(
+                coefficients=np.mean(trial_rks[first:last, steps], axis=0),
+                steps=steps,
+                dt=bin_size,
+                dtunit=dtunit,
+                method="trialseparated",
+                trialactivities=activities,
+                trialvariances=variances,
+                triallen=T,
+            )
+        )
+    return results
+
+
+# units up to this rate (Hz) go through `event_coefficients`, faster ones are
+# binned. For 840 s of spikes, tmax = 10 s and 5 ms bins, both take about the
+# same time at 25-30 Hz. The event-based cost grows with tmax, the binned one
+# with the recording length.
+event_coefficients_max_rate = 25.0
+
+
+def spike_coefficients(
+    spikes, bin_size, steps, dtunit="s", max_event_rate=None, rates=None
+):
+    """
+    Autocorrelation coefficients for each unit, from spiketimes. Units with
+    a low firing rate use `event_coefficients`, others are binned and
+    go through `coefficients_fft`. Both give the same coefficients.
+
+    # Parameters
+    spikes, bin_size, steps, dtunit : as for `event_coefficients`
+    max_event_rate : float, Hz, units up to this rate are not binned.
+        default None uses `event_coefficients_max_rate`.
+    rates : array of firing rates, one per unit, e.g. the `firing_rate` column
+        of the metadata frame. default None: spikes per time between the first
+        and last spike, per trial.
+
+    # Returns
+    results : list of `mre.CoefficientResult`, one per unit, to pass to `mre.fit`
+    """
+    if max_event_rate is None:
+        max_event_rate = event_coefficients_max_rate
+
+    units = [_as_trains(resolve_spikes(_as_list(st))) for st in spikes]
+    if rates is None:
+        rates = [_trial_rate(trains) for trains in units]
+    by_events = np.asarray(rates, dtype=np.float64) <= max_event_rate
+    log.debug(f"Event-based coefficients for {by_events.sum()}/{len(units)} units")
+
+    res = [None] * len(units)
+    idx = np.flatnonzero(by_events)
+    event_rks = event_coefficients([units[i] for i in idx], bin_size, steps, dtunit)
+    for i, rk in zip(idx, event_rks):
+        res[i] = rk
+
+    idx = np.flatnonzero(~by_events)
+    binned = [binned_spike_count(units[i], bin_size) for i in idx]
+    binned_rks = coefficients_fft(binned, steps, dt=bin_size, dtunit=dtunit)
+    for i, rk in zip(idx, binned_rks):
+        res[i] = rk
+
+    return res
+
+
+def _as_list(spikes):
+    """Wrap a single `SpikeHandle`, so `resolve_spikes` can iterate."""
+    return [spikes] if isinstance(spikes, SpikeHandle) else spikes
+
+
+def _trial_rate(trains):
+    """Mean firing rate between the first and last spike, across trains."""
+    num_spikes = sum(len(st) for st in trains)
+    duration = sum(float(st[-1] - st[0]) for st in trains if len(st) > 1)
+    return num_spikes / duration if duration > 0 else 0.0
+
+
+@jit(nopython=True, parallel=True, fastmath=False, cache=True)
+def _event_lag_sums(values, offsets, bin_size, num_bins, pairs, sum_x, sum_y, sum_sq):
+    """
+    lower level, for each train (row) and lag k (column) from 0 to the
+    largest step, with bins aligned as in `_binned_spike_count`:
+    - pairs : sum_t a_t a_t+k, the spike pairs k bins apart (k > 0)
+    - sum_x, sum_sq : sum of a_t and of a_t^2 over the first T - k bins
+    - sum_y : sum of a_t over the last T - k bins
+    where a_t are the binned counts and T is `num_bins` of the train.
+    """
+    max_step = pairs.shape[1] - 1
+
+    for n_id in prange(0, len(offsets) - 1):
+        start = offsets[n_id]
+        num_spikes = offsets[n_id + 1] - start
+        T = num_bins[n_id]
+        bins = np.empty(num_spikes, dtype=np.int64)
+        for idx in range(num_spikes):
+            diff = np.float64(values[start + idx]) - np.float64(values[start])
+            bins[idx] = int(diff / bin_size)
+
+        # two pointers: spikes lo < j < hi are at most max_step bins after lo
+        hi = 0
+        for lo in range(num_spikes):
+            while hi < num_spikes and bins[hi] - bins[lo] <= max_step:
+                hi += 1
+            for j in range(lo + 1, hi):
+                pairs[n_id, bins[j] - bins[lo]] += 1
+
+        # counts per occupied bin. each bin adds to the sums of all lags for
+        # which it is in the overlap, mark those in difference arrays.
+        idx = 0
+        while idx < num_spikes:
+            b = bins[idx]
+            c = 0
+            while idx < num_spikes and bins[idx] == b:
+                c += 1
+                idx += 1
+            # in the first T - k bins for k <= T - 1 - b
+            last = min(T - 1 - b, max_step)
+            sum_x[n_id, 0] += c
+            sum_sq[n_id, 0] += c * c
+            if last < max_step:
+                sum_x[n_id, last + 1] -= c
+                sum_sq[n_id, last + 1] -= c * c
+            # in the last T - k bins for k <= b
+            last = min(b, max_step)
+            sum_y[n_id, 0] += c
+            if last < max_step:
+                sum_y[n_id, last + 1] -= c
+
+        for k in range(1, max_step + 1):
+            sum_x[n_id, k] += sum_x[n_id, k - 1]
+            sum_sq[n_id, k] += sum_sq[n_id, k - 1]
+            sum_y[n_id, k] += sum_y[n_id, k - 1]
+        # lag 0, same-bin pairs counted above are not needed
+        pairs[n_id, 0] = sum_sq[n_id, 0]
+
+
+# ------------------------------------------------------------------------------ #
+# fitting
+# ------------------------------------------------------------------------------ #
+
+# starting points of the legacy fits (`allen_src/mre_estimation.py`), seconds.
+# tau, A, O
+fitpars_exponential_offset = np.array(
+    [
+        (0.1, 0.01, 0),
+        (0.1, 0.1, 0),
+        (1, 0.01, 0),
+        (1, 0.1, 0),
+    ]
+)
+
+# tau1, A1, tau2, A2
+fitpars_two_timescales = np.array(
+    [
+        (0.1, 0.01, 10, 0.01),
+        (0.1, 0.1, 10, 0.01),
+        (0.5, 0.01, 10, 0.001),
+        (0.5, 0.1, 10, 0.01),
+        (0.1, 0.01, 10, 0),
+        (0.1, 0.1, 10, 0),
+        (0.5, 0.01, 10, 0),
+        (0.5, 0.1, 10, 0),
+    ]
+)
+
+# fit functions of mrestimator that `fit_coefficients` knows, and their kernel id
+_fit_models = {
+    "f_exponential_offset": (0, fitpars_exponential_offset),
+    "f_two_timescales": (1, fitpars_two_timescales),
+}
+
+
+def fit_coefficients(rks, fitfunc="f_exponential_offset", fitpars=None, maxfev=None):
+    """
+    `mre.fit` for many units at once: every starting point of every unit is
+    fitted in parallel, with Levenberg-Marquardt as `scipy.optimize.curve_fit`
+    (which `mre.fit` uses, without bounds). As in `mre.fit`, starts that do
+    not converge within `maxfev` evaluations are dropped, the one with the
+    smallest residuals is kept, and units where no start converged are
+    repeated with 10000 evaluations.
+
+    # Parameters
+    rks : list of `mre.CoefficientResult`, e.g. from `coefficients_fft`
+    fitfunc : `mre.f_exponential_offset` or `mre.f_two_timescales`, or their name
+    fitpars : 2d array of starting points (start, parameter), default None uses
+        the ones of the legacy analysis, `fitpars_exponential_offset` or
+        `fitpars_two_timescales`. Note that `mre.fit` has other defaults.
+    maxfev : int, model evaluations per start, default `100 * (num_pars + 1)`
+
+    # Returns
+    fits : list of `mre.FitResult`, one per unit. For two timescales, `tau` is
+        the one with the larger amplitude, see `timescale_selection`.
+    """
+    import mrestimator as mre
+
+    name = fitfunc if isinstance(fitfunc, str) else fitfunc.__name__
+    if name not in _fit_models:
+        raise ValueError(f"Cannot fit {name}, only {list(_fit_models.keys())}")
+    model, default_pars = _fit_models[name]
+    fitfunc = getattr(mre, name)
+    fitpars = default_pars if fitpars is None else np.asarray(fitpars)
+    fitpars = np.atleast_2d(fitpars).astype(np.float64)
+    if maxfev is None:
+        maxfev = 100 * (fitpars.shape[1] + 1)
+
+    # units with the same steps share the x values
+    groups = dict()
+    for idx, rk in enumerate(rks):
+        groups.setdefault((tuple(rk.steps), rk.dt), []).append(idx)
+
+    fits = [None] * len(rks)
+    for (steps, dt), indices in groups.items():
+        steps = np.asarray(steps)
+        x = steps * dt
+        y = np.array([rks[idx].coefficients for idx in indices], dtype=np.float64)
+        popt, pcov, ssres = _fit_batch(model, x, y, fitpars, maxfev)
+
+        failed = ~np.isfinite(ssres)
+        if np.any(failed) and maxfev <= 10000:
+            log.debug(f"No fit converged for {failed.sum()} units, maxfev 10000")
+            popt[failed], pcov[failed], ssres[failed] = _fit_batch(
+                model, x, y[failed], fitpars, 10000
+            )
+
+        for i, idx in enumerate(indices):
+            rk = rks[idx]
+            if not np.isfinite(ssres[i]):
+                fits[idx] = mre.FitResult(
+                    tau=np.nan,
+                    mre=np.nan,
+                    fitfunc=fitfunc,
+                    steps=steps,
+                    dt=dt,
+                    dtunit=rk.dtunit,
+                    description=rk.description,
+                )
+                continue
+            tau = mre.tau_from_popt(fitfunc, popt[i])
+            # adjusted, as in `mre.fit`
+            sstot = np.sum((y[i] - np.mean(y[i])) ** 2)
+            rsquared = 1.0 - (ssres[i] / sstot)
+            dof = len(x) - 1 - len(popt[i])
+            rsquared = 1.0 - (1.0 - rsquared) * (len(x) - 1) / dof
+            fits[idx] = mre.FitResult(
+                tau=tau,
+                mre=np.exp(-1 * dt / tau),
+                fitfunc=fitfunc,
+                popt=popt[i],
+                pcov=pcov[i],
+                ssres=ssres[i],
+                rsquared=rsquared,
+                steps=steps,
+                dt=dt,
+                dtunit=rk.dtunit,
+                description=rk.description,
+            )
+    return fits
+
+
+def timescale_selection(popt):
+    """
+    Pick the timescale of a two-timescale fit that has the larger amplitude,
+    as the legacy `two_timescales_fit`.
+
+    # Parameters
+    popt : (tau1, A1, tau2, A2), or a 2d array with one row per fit
+
+    # Returns
+    tau_selected, A_selected, tau_rejected, A_rejected : floats, or arrays
+    """
+    popt = np.asarray(popt, dtype=np.float64)
+    taus = popt[..., [0, 2]]
+    amps = np.abs(popt[..., [1, 3]])
+    # argmax takes the first on ties, as the legacy code
+    sel = np.argmax(amps, axis=-1)[..., np.newaxis]
+    rej = 1 - sel
+    return tuple(
+        np.take_along_axis(values, choice, axis=-1)[..., 0]
+        for values, choice in [(taus, sel), (amps, sel), (taus, rej), (amps, rej)]
+    )
+
+
+def _fit_batch(model, x, y, fitpars, maxfev):
+    """
+    Fit all starts to all rows of `y`, keep the best start per row.
+    Returns popt (row, par), pcov (row, par, par) and ssres (row), inf if no
+    start converged.
+    """
+    num_units, num_starts, num_pars = len(y), len(fitpars), fitpars.shape[1]
+    popt = np.zeros((num_units * num_starts, num_pars))
+    jtj = np.zeros((num_units * num_starts, num_pars, num_pars))
+    ssres = np.zeros(num_units * num_starts)
+    with _parallel_kernel_guard():
+        _lm_fits(model, x, y, fitpars, maxfev, popt, jtj, ssres)
+
+    popt = popt.reshape(num_units, num_starts, num_pars)
+    jtj = jtj.reshape(num_units, num_starts, num_pars, num_pars)
+    ssres = ssres.reshape(num_units, num_starts)
+    # first of the smallest, as `mre.fit`
+    best = np.argmin(ssres, axis=1)
+    rows = np.arange(num_units)
+    popt, jtj, ssres = popt[rows, best], jtj[rows, best], ssres[rows, best]
+
+    # as `curve_fit`, the pseudo-inverse scaled by the residual variance
+    dof = max(len(x) - num_pars, 1)
+    pcov = np.full_like(jtj, np.inf)
+    finite = np.isfinite(ssres)
+    if np.any(finite):
+        rcond = (np.finfo(np.float64).eps * max(len(x), num_pars)) ** 2
+        pinv = np.linalg.pinv(jtj[finite], rcond=rcond, hermitian=True)
+        pcov[finite] = pinv * (ssres[finite] / dof)[:, np.newaxis, np.newaxis]
+    return popt, pcov, ssres
+
+
+# tolerances of `scipy.optimize.leastsq`
+_lm_ftol = 1.49012e-08
+_lm_xtol = 1.49012e-08
+
+
+@jit(nopython=True, parallel=True, fastmath=False, cache=True)
+def _lm_fits(model, x, y, fitpars, maxfev, popt, jtj, ssres):
+    """
+    lower level, Levenberg-Marquardt for every (row of y, start) pair, one fit
+    per thread. Fit `i` uses row `i // num_starts` and start `i % num_starts`.
+    A Jacobian counts as `num_pars` evaluations, as for the finite differences
+    of MINPACK. Fits that need more than `maxfev` get ssres = inf.
+    """
+    num_starts, num_pars = fitpars.shape
+    # steps are usually evenly spaced, then exponentials are powers of one factor
+    uniform = len(x) > 2
+    for k in range(2, len(x)):
+        if abs((x[k] - x[k - 1]) - (x[1] - x[0])) > 1e-9 * abs(x[1] - x[0]):
+            uniform = False
+
+    for f_id in prange(len(y) * num_starts):
+        data = y[f_id // num_starts]
+        p = fitpars[f_id % num_starts].copy()
+        p_try = np.zeros(num_pars)
+        a = np.zeros((num_pars, num_pars))
+        g = np.zeros(num_pars)
+        a_try = np.zeros((num_pars, num_pars))
+        g_try = np.zeros(num_pars)
+        b = np.zeros((num_pars, num_pars))
+        step = np.zeros(num_pars)
+        scale = np.zeros(num_pars)
+
+        ssr = _model_eval(model, x, uniform, data, p, a, g)
+        nfev = 1
+        lam = 1e-3
+        converged = False
+        while np.isfinite(ssr) and not converged and nfev <= maxfev:
+            # the jacobian came with the last accepted evaluation
+            nfev += num_pars
+            for j in range(num_pars):
+                # marquardt scaling, never shrinks (as MINPACK)
+                scale[j] = max(scale[j], a[j, j])
+
+            while nfev <= maxfev:
+                b[:] = a
+                for j in range(num_pars):
+                    b[j, j] += lam * (scale[j] if scale[j] > 0 else 1.0)
+                if not _solve_small(b, g, step):
+                    lam *= 10
+                    continue
+                p_norm = np.sqrt(np.sum(p**2))
+                step_norm = np.sqrt(np.sum(step**2))
+                p_try[:] = p + step
+                ssr_try = _model_eval(model, x, uniform, data, p_try, a_try, g_try)
+                nfev += 1
+                if np.isfinite(ssr_try) and ssr_try < ssr:
+                    converged = (ssr - ssr_try) <= _lm_ftol * ssr
+                    converged = converged or step_norm <= _lm_xtol * (p_norm + _lm_xtol)
+                    p[:] = p_try
+                    a[:] = a_try
+                    g[:] = g_try
+                    ssr = ssr_try
+                    lam = max(lam / 10, 1e-15)
+                    break
+                # no improvement, even for a negligible step: at the minimum
+                if step_norm <= _lm_xtol * (p_norm + _lm_xtol) or lam > 1e20:
+                    converged = True
+                    break
+                lam *= 10
+
+        popt[f_id] = p
+        jtj[f_id] = a
+        ssres[f_id] = ssr if converged else np.inf
+
+
+@jit(nopython=True, cache=True)
+def _model_eval(model, x, uniform, data, p, a, g):
+    """
+    Sum of squared residuals `r` of `mre.f_exponential_offset` (model 0) or
+    `mre.f_two_timescales` (model 1). Also fills `a = J^T J` and `g = J^T r`,
+    with the Jacobian `J` of the model. The derivative of `|A|` at 0 is taken
+    as 1, as the forward differences of MINPACK do.
+    """
+    num_pars = len(p)
+    jac = np.zeros(num_pars)
+    a[:] = 0.0
+    g[:] = 0.0
+    ssr = 0.0
+    two = model == 1
+    sign1 = 1.0 if p[1] >= 0 else -1.0
+    sign2 = 1.0 if two and p[3] >= 0 else -1.0
+    e1 = 0.0
+    e2 = 0.0
+    if uniform:
+        f1 = np.exp(-(x[1] - x[0]) / p[0])
+        f2 = np.exp(-(x[1] - x[0]) / p[2]) if two else 0.0
+
+    for k in range(len(x)):
+        if uniform and k > 0:
+            e1 *= f1
+            e2 *= f2
+        else:
+            e1 = np.exp(-x[k] / p[0])
+            e2 = np.exp(-x[k] / p[2]) if two else 0.0
+        jac[0] = np.abs(p[1]) * e1 * x[k] / p[0] ** 2
+        jac[1] = sign1 * e1
+        f = np.abs(p[1]) * e1
+        if two:
+            jac[2] = np.abs(p[3]) * e2 * x[k] / p[2] ** 2
+            jac[3] = sign2 * e2
+            f += np.abs(p[3]) * e2
+        else:
+            jac[2] = 1.0
+            f += p[2]
+        r = data[k] - f
+        ssr += r * r
+        for i in range(num_pars):
+            g[i] += jac[i] * r
+            for j in range(i + 1):
+                a[i, j] += jac[i] * jac[j]
+
+    for i in range(num_pars):
+        for j in range(i):
+            a[j, i] = a[i, j]
+    return ssr
+
+
+@jit(nopython=True, cache=True)
+def _solve_small(a, b, out):
+    """
+    Solve `a @ out = b` by gaussian elimination with partial pivoting, for the
+    few parameters of a fit. `a` is overwritten. Returns False if singular.
+    """
+    n = len(b)
+    rhs = b.copy()
+    for col in range(n):
+        pivot = col
+        for row in range(col + 1, n):
+            if abs(a[row, col]) > abs(a[pivot, col]):
+                pivot = row
+        if not np.isfinite(a[pivot, col]) or abs(a[pivot, col]) < 1e-300:
+            return False
+        if pivot != col:
+            for j in range(n):
+                a[col, j], a[pivot, j] = a[pivot, j], a[col, j]
+            rhs[col], rhs[pivot] = rhs[pivot], rhs[col]
+        for row in range(col + 1, n):
+            factor = a[row, col] / a[col, col]
+            for j in range(col, n):
+                a[row, j] -= factor * a[col, j]
+            rhs[row] -= factor * rhs[col]
+    for row in range(n - 1, -1, -1):
+        total = rhs[row]
+        for j in range(row + 1, n):
+            total -= a[row, j] * out[j]
+        out[row] = total / a[row, row]
+    return np.all(np.isfinite(out))
 
 
 # ------------------------------------------------------------------------------ #
@@ -42,6 +42,20 @@ quality_metrics = {'unmerged': {'presence_ratio_minimum': 0.9, # was -np.inf,  #
                               'isi_violations_maximum': 0.5}}
 
 list_version = 'unmerged'
+
+# how to store the spiketimes of a block, "ragged" or "padded".
+# "ragged" is a flat array of all spikes and an array of offsets for each unit,
+# "padded" is the original 2d array (units x spikes) padded with nans.
+# `utility.load_session` reads both, `run/convert_spike_files.py` converts old files.
+spike_layout = "ragged"
+
+# where to put the datasets of a block, "groups" or "flat".
+# "groups" nests them as /{session_id}/{stimulus}/{stimulus_block}/{kind}, so readers
+# only need to visit the groups they want. "flat" puts all keys into the root, as
+# session_{session_id}_stimulus_{stimulus}_stimulus_block_{stimulus_block}_{kind}.
+# `utility.load_session` reads both, `run/convert_spike_files.py` converts old files.
+key_layout = "groups"
+
 # stimulus block format
 def sbfmt(sb):
     try:
@@ -214,13 +228,45 @@ def get_spikes_and_attribute_lists(unit_ids, session, session_id, session_type,
 
     return spikes_list, ecephys_structure_acronym_list, invalid_spiketimes_check_list, rec_len_list, firing_rate_list
 
+def get_spike_stats(spikes_list):
+    """
+    Per-unit stats for the metadata, so that checks can run without loading spikes.
+    Computed from the float32 spiketimes as stored, the same columns that
+    `utility.backfill_spike_stats` adds to older files.
+    """
+    stats = {"num_spikes": [], "t_first": [], "t_last": [], "isi_mean": [], "isi_cv": []}
+    for spikes in spikes_list:
+        spikes = np.asarray(spikes, dtype=np.float32).astype(np.float64)
+        isis = np.diff(spikes)
+        stats["num_spikes"] += [len(spikes)]
+        stats["t_first"] += [spikes[0] if len(spikes) > 0 else np.nan]
+        stats["t_last"] += [spikes[-1] if len(spikes) > 0 else np.nan]
+        stats["isi_mean"] += [isis.mean() if len(isis) > 0 else np.nan]
+        stats["isi_cv"] += [isis.std() / isis.mean() if len(isis) > 0 else np.nan]
+    return stats
+
 # to read the file, use something like this
 def load_spike_data_hdf5(filepath, session_id, stimulus, stimulus_block, unit_index):
+    # reads both key layouts and both spike layouts written above.
+    # for files converted to sample indices, use `utility.load_session`.
     filename = f"{filepath}/spikes/session_{session_id}_spike_data.h5"
     f = h5py.File(os.path.expanduser(filename), "r", libver="latest")
-    spike_data = f[f"/{session_id}/{stimulus}/{stimulus_block}/spiketimes"]
-    metadata = pd.read_hdf(filename, f"/{session_id}/{stimulus}/{stimulus_block}/metadata")
-    spike_times_unit = spike_data[unit_index]
+    key = f"/{session_id}/{stimulus}/{stimulus_block}"
+    sep = "/"
+    if key not in f:
+        key = f"/session_{session_id}_stimulus_{stimulus}_stimulus_block_{stimulus_block}"
+        sep = "_"
+    spike_data = f[f"{key}{sep}spiketimes"]
+    if "encoding" in spike_data.attrs:
+        f.close()
+        raise ValueError(f"{filename} holds encoded spikes, use `utility.load_session`")
+    metadata = pd.read_hdf(filename, f"{key}{sep}metadata")
+    if f"{key}{sep}offsets" in f:
+        # ragged: the spikes of unit i are spike_data[offsets[i]:offsets[i+1]]
+        offsets = f[f"{key}{sep}offsets"]
+        spike_times_unit = spike_data[offsets[unit_index] : offsets[unit_index + 1]]
+    else:
+        spike_times_unit = spike_data[unit_index]
     spike_times_unit = spike_times_unit[np.isfinite(spike_times_unit)]
     metadata_unit = metadata.loc[unit_index]
     f.close()
@@ -254,33 +300,70 @@ def write_session_spikedata_to_h5(filepath, session, session_type, session_id, s
         log.debug("SWMR requires HDF5 version >= 1.9.178")
 
     spikes_list, ecephys_structure_acronym_list, invalid_spiketimes_check_list, rec_len_list, firing_rate_list = get_spikes_and_attribute_lists(unit_ids, session, session_id, session_type, stimulus_presentation_ids,target_length, stimulus, stimulus_block)
-    # creating dummy data for 2d nan-padded example
     num_units = len(unit_ids)
-    max_num_spikes = 0
-    for i in range(num_units):
-        max_num_spikes = np.amax([max_num_spikes, len(spikes_list[i])])
-    # init the empty thing
-    spike_times = np.nan * np.ones(
-        shape=(num_units, max_num_spikes), dtype=np.float32
-    )
+    if key_layout == "groups":
+        key = f"/{session_id}/{stimulus}/{stimulus_block}"
+        sep = "/"
+        group = file.require_group(key)
+        group.attrs["session"] = session_id
+        group.attrs["stimulus"] = stimulus
+        group.attrs["block"] = stimulus_block
+    else:
+        key = f"/session_{session_id}_stimulus_{stimulus}_stimulus_block_{stimulus_block}"
+        sep = "_"
+
+    if spike_layout == "ragged":
+        # one flat array with the spikes of all units, and the offsets where each
+        # unit starts: spikes of unit i are spike_times[offsets[i]:offsets[i+1]]
+        offsets = np.zeros(num_units + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(spikes) for spikes in spikes_list])
+        spike_times = np.concatenate(
+            [np.zeros(0)] + [np.asarray(spikes) for spikes in spikes_list]
+        ).astype(np.float32)
+
+        file.create_dataset(
+            f"{key}{sep}offsets",
+            data=offsets,
+            compression="gzip",
+            compression_opts=9,
+        )
+    else:
+        # creating dummy data for 2d nan-padded example
+        max_num_spikes = 0
+        for i in range(num_units):
+            max_num_spikes = np.amax([max_num_spikes, len(spikes_list[i])])
+        # init the empty thing
+        spike_times = np.nan * np.ones(
+            shape=(num_units, max_num_spikes), dtype=np.float32
+        )
 
-    # copy the spikes. this is not the efficient way but you get the idea
-    for udx, unit in enumerate(unit_ids):
-        for sdx, spike in enumerate(spikes_list[udx]):
-            spike_times[udx, sdx] = spike
+        # copy the spikes. this is not the efficient way but you get the idea
+        for udx, unit in enumerate(unit_ids):
+            for sdx, spike in enumerate(spikes_list[udx]):
+                spike_times[udx, sdx] = spike
+
+    # "ragged": 1d array, "padded": 2d array with first dim neuron id, second dim spike times
+    # chunks are small so that reading a single unit is cheap.
+    if spike_times.size == 0:
+        chunks = None
+    elif spike_layout == "ragged":
+        chunks = (min(len(spike_times), 4096),)
+    else:
+        chunks = (1, spike_times.shape[1])
 
-    # 2d array with first dim neuron id, second dim spike times
     spikes_dataset = file.create_dataset(
-        f"/session_{session_id}_stimulus_{stimulus}_stimulus_block_{stimulus_block}_spiketimes",
+        f"{key}{sep}spiketimes",
         data=spike_times,
+        chunks=chunks,
         compression="gzip",
         compression_opts=9,
     )
     file.close()
     # Store metadata for each unit via pandas dataframe
     d = {"unit_id": unit_ids, "ecephys_structure_acronym": ecephys_structure_acronym_list, "invalid_spiketimes_check": invalid_spiketimes_check_list, "recording_length": rec_len_list, "firing_rate": firing_rate_list}
+    d.update(get_spike_stats(spikes_list))
     metadata = pd.DataFrame(data = d)
-    metadata.to_hdf(filename, f"session_{session_id}_stimulus_{stimulus}_stimulus_block_{stimulus_block}_metadata")
+    metadata.to_hdf(filename, f"{key}{sep}metadata")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,138 @@
+# ------------------------------------------------------------------------------ #
+# Maintenance of the session hdf5 files holding the spiketimes.
+#
+# Convert nan-padded blocks to the ragged layout (in place):
+# `python convert_spike_files.py ragged /path/to/dat/spikes/`
+#
+# Store spikes as bit-packed sample indices instead of float seconds (in place):
+# `python convert_spike_files.py samples /path/to/dat/spikes/`
+#
+# Add per-unit spike stats to the metadata of files written without them (in place):
+# `python convert_spike_files.py backfill /path/to/dat/spikes/`
+#
+# Move blocks from flat keys into /{session}/{stimulus}/{block}/ groups (in place):
+# `python convert_spike_files.py groups /path/to/dat/spikes/`
+#
+# Change chunk shape and compression of the spike datasets (in place), and
+# report sizes and read throughput before and after:
+# `python convert_spike_files.py repack /path/to/dat/spikes/ --codec lzf`
+# ------------------------------------------------------------------------------ #
+
+import os
+import sys
+import glob
+import argparse
+import logging
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+
+from ana import utility as utl
+
+log = logging.getLogger("convert_spike_files")
+log.setLevel("INFO")
+utl.log.setLevel("DEBUG")
+
+
+def session_files(paths):
+    """Expand directories to the session files they contain (recursively)."""
+    files = []
+    for path in paths:
+        path = os.path.abspath(os.path.expanduser(path))
+        if os.path.isdir(path):
+            files.extend(glob.glob(path + "/**/session_*_spike_data.h5", recursive=True))
+        else:
+            files.append(path)
+    return sorted(files)
+
+
+def ragged(args):
+    for fp in session_files(args.paths):
+        log.info(f"Converting {fp}")
+        utl.convert_session_to_ragged(fp, compression_opts=args.gzip_level)
+
+
+def samples(args):
+    for fp in session_files(args.paths):
+        log.info(f"Converting {fp}")
+        utl.convert_session_to_samples(
+            fp, sampling_rate=args.sampling_rate, compression_opts=args.gzip_level
+        )
+
+
+def backfill(args):
+    for fp in session_files(args.paths):
+        log.info(f"Adding spike stats to {fp}")
+        utl.backfill_spike_stats(fp)
+
+
+def groups(args):
+    for fp in session_files(args.paths):
+        log.info(f"Converting {fp}")
+        utl.convert_session_to_groups(fp)
+
+
+def repack(args):
+    chunks = args.chunks if args.chunks in ["unit", "auto"] else int(args.chunks)
+    for fp in session_files(args.paths):
+        report = utl.repack_session_file(
+            fp, chunks=chunks, codec=args.codec, level=args.level
+        )
+        log.info(
+            f"{os.path.basename(fp)}:"
+            f" {utl.naturalsize(report['size_before'])}"
+            f" -> {utl.naturalsize(report['size_after'])},"
+            f" blocks {report['block_mb_per_s_before']:.1f}"
+            f" -> {report['block_mb_per_s_after']:.1f} MB/s,"
+            f" single unit {report['unit_ms_before']:.2f}"
+            f" -> {report['unit_ms_after']:.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(required=True)
+
+    parser_ragged = subparsers.add_parser(
+        "ragged", help="convert nan-padded blocks to the ragged layout, in place"
+    )
+    parser_ragged.add_argument("paths", nargs="+", help="session files or directories")
+    parser_ragged.add_argument("--gzip_level", type=int, default=9)
+    parser_ragged.set_defaults(func=ragged)
+
+    parser_samples = subparsers.add_parser(
+        "samples", help="store spikes as bit-packed sample indices, in place"
+    )
+    parser_samples.add_argument("paths", nargs="+", help="session files or directories")
+    parser_samples.add_argument(
+        "--sampling_rate", type=float, default=utl.default_sampling_rate
+    )
+    parser_samples.add_argument("--gzip_level", type=int, default=9)
+    parser_samples.set_defaults(func=samples)
+
+    parser_backfill = subparsers.add_parser(
+        "backfill", help="add per-unit spike stats to the metadata, in place"
+    )
+    parser_backfill.add_argument("paths", nargs="+", help="session files or directories")
+    parser_backfill.set_defaults(func=backfill)
+
+    parser_groups = subparsers.add_parser(
+        "groups", help="move blocks into /session/stimulus/block/ groups, in place"
+    )
+    parser_groups.add_argument("paths", nargs="+", help="session files or directories")
+    parser_groups.set_defaults(func=groups)
+
+    parser_repack = subparsers.add_parser(
+        "repack", help="change chunk shape and compression of the spike datasets"
+    )
+    parser_repack.add_argument("paths", nargs="+", help="session files or directories")
+    parser_repack.add_argument(
+        "--chunks", default="unit", help="'unit', 'auto' or spikes/units per chunk"
+    )
+    parser_repack.add_argument(
+        "--codec", default="gzip", choices=["gzip", "lzf", "blosc", "lz4", "none"]
+    )
+    parser_repack.add_argument("--level", type=int, default=4)
+    parser_repack.set_defaults(func=repack)
+
+    args = parser.parse_args()
+    args.func(args)
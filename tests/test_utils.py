@@ -3,9 +3,11 @@ log = logging.getLogger("tests")
 log.setLevel("DEBUG")
 
 import numpy as np
+import pandas as pd
 import h5py as h5
 import os.path
 import sys
+import pytest
 sys.path.insert(0, './experiment_analysis/ana')
 
 import utility as utl
@@ -39,3 +41,1036 @@ def test_binning_formats():
     assert np.allclose(b1, br1)
     assert np.allclose(b2, br2)
     assert np.allclose(b3, br3)
+
+
+def test_binning_ragged():
+    rng = np.random.default_rng(42)
+    trains = [
+        np.sort(rng.uniform(t0, t0 + 100, size=n)).astype(np.float32)
+        for t0, n in zip([0, 5, 20, 3], [300, 0, 1000, 1])
+    ]
+
+    # reference: the float64 count matrix of the nan-padded kernel
+    t_min = min(st.min() for st in trains if len(st) > 0)
+    t_max = max(st.max() for st in trains if len(st) > 0)
+    ref = np.zeros((len(trains), int((t_max - t_min) / 0.5) + 1))
+    for n_id, st in enumerate(trains):
+        for t in st:
+            ref[n_id, int((t - st[0]) / 0.5)] += 1
+
+    counts = utl.binned_spike_count(trains, bin_size=0.5)
+    assert counts.dtype == np.uint8
+    assert np.array_equal(counts, ref)
+    assert counts[1].sum() == 0
+
+    # same from a filtered series, and from the ragged layout
+    series = pd.Series(trains, index=[10, 11, 12, 13], dtype=object)
+    assert np.array_equal(
+        utl.binned_spike_count(series.iloc[1:], 0.5),
+        utl.binned_spike_count(trains[1:], 0.5),
+    )
+    values, offsets = utl._spikes_to_ragged(trains)
+    assert np.array_equal(utl.binned_ragged_count(values, offsets, 0.5), ref)
+    assert np.array_equal(
+        utl.binned_ragged_count(values, offsets, 0.5, dtype=np.float64), ref
+    )
+
+    # more than 255 spikes in a bin need a larger dtype
+    counts = utl.binned_spike_count([np.linspace(0, 1, 1000), np.arange(3.0)], 10.0)
+    assert counts.dtype == np.uint16
+    assert counts[:, 0].tolist() == [1000, 3]
+
+    with pytest.raises(ValueError):
+        utl.binned_ragged_count(values[:10], offsets, 0.5)
+
+    # offsets may end before the values
+    assert np.array_equal(
+        utl.binned_ragged_count(values, offsets[:2], 0.5),
+        utl.binned_spike_count(trains[:1], 0.5),
+    )
+
+    # in float32, the difference rounds up into the bin past the last one
+    edge = np.array([0.522, 623.587], dtype=np.float32)
+    counts = utl.binned_spike_count(edge, 0.005)
+    assert counts.shape == (1, 124613)
+    assert counts[0, -1] == 1
+
+    # only empty trains
+    assert utl.binned_spike_count([np.zeros(0), np.zeros(0)], 0.5).shape == (2, 0)
+
+
+def test_cached_binning():
+    rng = np.random.default_rng(42)
+    # dense units go through the 1 ms base, sparse ones are binned directly
+    dense = [np.sort(rng.uniform(t0, t0 + 10, size=20000)) for t0 in [0, 100]]
+    sparse = [np.sort(rng.uniform(0, 60, size=200))]
+    utl.clear_binning_cache()
+
+    for unit_id, blocks in enumerate([dense, sparse]):
+        for bin_size in [0.005, 0.001, 0.02, 0.0075, 0.005]:
+            counts = utl.cached_binned_spike_count(blocks, bin_size, unit_id, "s")
+            assert np.array_equal(counts, utl.binned_spike_count(blocks, bin_size))
+            assert not counts.flags.writeable
+        assert utl.cached_binned_spike_count(blocks, 0.005, unit_id, "s") is counts
+    assert ((0, "s"), 0.001) in utl._binning_cache._arrays
+
+    # coarsening keeps the number of bins and promotes the dtype when needed
+    base = np.full((1, 7), 200, dtype=np.uint8)
+    coarse = utl._coarsen_counts(base, 3)
+    assert coarse.dtype == np.uint16
+    assert coarse.tolist() == [[600, 600, 200]]
+
+    # the budget evicts the least recently used
+    other = utl.cached_binned_spike_count(sparse, 0.005, 2, "s")
+    utl.set_binning_cache_size(other.nbytes)
+    assert utl.cached_binned_spike_count(sparse, 0.005, 2, "s") is other
+    assert utl.cached_binned_spike_count(sparse, 0.005, 1, "s") is not counts
+    utl.set_binning_cache_size(1024**3)
+    utl.clear_binning_cache()
+
+
+def test_coefficients_fft():
+    import mrestimator as mre
+
+    with h5.File(data_path, "r") as f:
+        spikes = [f[f"spike_times_{idx}"][:] for idx in [1, 2, 3]]
+
+    # single units of different lengths, and one with three trials
+    bin_size = 0.005
+    units = [utl.binned_spike_count(st, bin_size) for st in spikes]
+    units.append(utl.binned_spike_count(np.vstack(spikes), bin_size))
+    steps = (6, 400)
+
+    results = utl.coefficients_fft(units, steps, dt=bin_size, dtunit="s")
+    for counts, rk in zip(units, results):
+        ref = mre.coefficients(
+            counts, method="ts", steps=steps, dt=bin_size, dtunit="s", numboot=0
+        )
+        assert np.array_equal(rk.steps, ref.steps)
+        assert np.allclose(rk.coefficients, ref.coefficients, rtol=0, atol=1e-10)
+        assert np.allclose(rk.trialactivities, ref.trialactivities)
+        assert np.allclose(rk.trialvariances, ref.trialvariances)
+        assert rk.triallen == ref.triallen
+
+    # steps are capped at half the trial, and the results go into mre.fit
+    short = utl.coefficients_fft([units[0][:, :500]], (1, 1000))[0]
+    assert short.steps[-1] == 250
+    fit = mre.fit(results[0], fitfunc=mre.f_exponential_offset)
+    assert np.isfinite(fit.tau)
+
+
+def test_event_coefficients():
+    with h5.File(data_path, "r") as f:
+        spikes = [f[f"spike_times_{idx}"][:] for idx in [1, 2, 3]]
+
+    # nan-padded float32 units, one with three trials, and a sparse one
+    rng = np.random.default_rng(42)
+    units = spikes + [np.vstack(spikes), np.sort(rng.uniform(0, 840, size=20))]
+    bin_size = 0.005
+    steps = (6, 2000)
+
+    binned = [utl.binned_spike_count(st, bin_size) for st in units]
+    refs = utl.coefficients_fft(binned, steps, dt=bin_size, dtunit="s")
+    results = utl.event_coefficients(units, bin_size, steps)
+    for rk, ref in zip(results, refs):
+        assert np.array_equal(rk.steps, ref.steps)
+        assert np.allclose(rk.coefficients, ref.coefficients, rtol=0, atol=1e-10)
+        assert np.allclose(rk.trialactivities, ref.trialactivities)
+        assert np.allclose(rk.trialvariances, ref.trialvariances)
+        assert rk.triallen == ref.triallen
+
+    # chosen per unit by rate, same results either way
+    rates = [100.0, 0.1, 100.0, 0.1, 0.1]
+    results = utl.spike_coefficients(units, bin_size, steps, rates=rates)
+    for rk, ref in zip(results, refs):
+        assert np.allclose(rk.coefficients, ref.coefficients, rtol=0, atol=1e-10)
+    assert utl._trial_rate([np.arange(11.0)]) == 1.1
+
+
+def test_fit_coefficients():
+    import mrestimator as mre
+
+    with h5.File(data_path, "r") as f:
+        spikes = [f[f"spike_times_{idx}"][:] for idx in [1, 2, 3]]
+    bin_size = 0.005
+    units = spikes + [np.vstack(spikes)]
+    rks = utl.spike_coefficients(units, bin_size, (6, 2000))
+
+    # the legacy fits, `mre.fit` with the starting points of `mre_estimation.py`
+    fits = utl.fit_coefficients(rks, mre.f_exponential_offset)
+    for rk, fit in zip(rks, fits):
+        ref = mre.fit(
+            rk, fitfunc=mre.f_exponential_offset, fitpars=utl.fitpars_exponential_offset
+        )
+        assert fit.fitfunc is mre.f_exponential_offset
+        assert np.isclose(fit.tau, ref.tau, rtol=1e-3)
+        assert np.allclose(fit.popt, ref.popt, rtol=1e-2, atol=1e-4)
+        assert np.isclose(fit.ssres, ref.ssres, rtol=1e-6)
+        assert np.isclose(fit.mre, ref.mre, rtol=1e-3)
+
+    # two timescales have flat directions, some units end in another minimum
+    # of (nearly) the same quality.
+    fits = utl.fit_coefficients(rks, "f_two_timescales")
+    for idx, (rk, fit) in enumerate(zip(rks, fits)):
+        ref = mre.fit(
+            rk, fitfunc=mre.f_two_timescales, fitpars=utl.fitpars_two_timescales
+        )
+        assert np.isclose(fit.ssres, ref.ssres, rtol=1e-4)
+        if idx in [1, 2]:
+            assert np.isclose(fit.tau, ref.tau, rtol=1e-3)
+            assert np.isclose(fit.tau, utl.timescale_selection(ref.popt)[0], rtol=1e-3)
+
+    # the larger amplitude wins, the first one on ties, also for many fits
+    popt = np.array(
+        [(0.1, -0.5, 2.0, 0.2), (0.1, 0.2, 2.0, -0.3), (0.1, 0.2, 2.0, 0.2)]
+    )
+    tau, amp, tau_rej, amp_rej = utl.timescale_selection(popt)
+    assert tau.tolist() == [0.1, 2.0, 0.1]
+    assert amp.tolist() == [0.5, 0.3, 0.2]
+    assert tau_rej.tolist() == [2.0, 0.1, 2.0]
+    assert utl.timescale_selection(popt[0]) == (0.1, 0.5, 2.0, 0.2)
+
+    # no start converges
+    bad = mre.CoefficientResult(np.full(10, np.nan), steps=np.arange(1, 11))
+    assert np.isnan(utl.fit_coefficients([bad])[0].tau)
+
+
+# ------------------------------------------------------------------------------ #
+# synthetic session files, in the format written by `write_spike_times_hdf5.py`
+# ------------------------------------------------------------------------------ #
+
+_blocks = [
+    ("spontaneous", "null"),
+    ("natural_movie_one_more_repeats", "3.0"),
+    ("natural_movie_one_more_repeats", "8.0"),
+]
+
+
+def _write_session_file(directory, session_id, num_units=5, seed=42):
+    """
+    Write a small session file with nan-padded spike times and returns
+    a dict of the written spiketimes: (stimulus, block) -> list of arrays
+    """
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    filename = f"{directory}/session_{session_id}_spike_data.h5"
+    unit_ids = np.arange(num_units) + session_id * 100
+    written = dict()
+
+    for stimulus, block in _blocks:
+        prefix = f"session_{session_id}_stimulus_{stimulus}_stimulus_block_{block}"
+        # include an empty unit, and one unit with many spikes
+        num_spikes = rng.integers(1, 200, size=num_units)
+        num_spikes[0] = 0
+        num_spikes[-1] = 2000
+        trains = [
+            np.sort(rng.uniform(0, 910, size=n)).astype(np.float32) for n in num_spikes
+        ]
+        written[(stimulus, block)] = trains
+
+        padded = np.nan * np.ones((num_units, max(num_spikes)), dtype=np.float32)
+        for udx, train in enumerate(trains):
+            padded[udx, : len(train)] = train
+
+        with h5.File(filename, "a") as f:
+            f.create_dataset(
+                f"{prefix}_spiketimes", data=padded, compression="gzip"
+            )
+
+        metadata = pd.DataFrame(
+            dict(
+                unit_id=unit_ids,
+                ecephys_structure_acronym=rng.choice(["VISp", "VISl", "LGd"], num_units),
+                invalid_spiketimes_check=["SUCCESS"] * num_units,
+                recording_length=[t[-1] - t[0] if len(t) > 1 else 0.0 for t in trains],
+                firing_rate=num_spikes / 900.0,
+            )
+        )
+        metadata.to_hdf(filename, key=f"{prefix}_metadata")
+
+    return written
+
+
+def test_metadata_index(tmp_path, monkeypatch):
+    _write_session_file(tmp_path, 1)
+    _write_session_file(tmp_path, 2)
+
+    meta_df = utl.all_unit_metadata(tmp_path, reload=True)
+    assert os.path.isfile(f"{tmp_path}/unit_metadata_index.parquet")
+    assert len(meta_df) == 2 * 5 * len(_blocks)
+
+    # a second call is served from the index and gives the same frame
+    cached_df = utl.all_unit_metadata(tmp_path, reload=True)
+    pd.testing.assert_frame_equal(meta_df, cached_df)
+    no_index_df = utl.all_unit_metadata(tmp_path, reload=True, use_index=False)
+    pd.testing.assert_frame_equal(meta_df, no_index_df)
+
+    # new files are picked up, and only they are read
+    _write_session_file(tmp_path, 3)
+    read_files = []
+    load_session = utl.load_session
+    monkeypatch.setattr(
+        utl, "load_session", lambda fp, **kw: read_files.append(fp) or load_session(fp, **kw)
+    )
+    meta_df = utl.all_unit_metadata(tmp_path, reload=True)
+    assert [os.path.basename(fp) for fp in read_files] == ["session_3_spike_data.h5"]
+    assert sorted(meta_df["session"].unique()) == [1, 2, 3]
+
+    os.remove(f"{tmp_path}/session_2_spike_data.h5")
+    meta_df = utl.all_unit_metadata(tmp_path, reload=True)
+    assert sorted(meta_df["session"].unique()) == [1, 3]
+
+
+def test_metadata_index_read_only_dir(tmp_path, monkeypatch):
+    data_dir = tmp_path / "shared"
+    cache_dir = tmp_path / "cache"
+    data_dir.mkdir()
+    _write_session_file(data_dir, 1)
+    monkeypatch.setattr(utl, "meta_index_cache_dir", str(cache_dir))
+    monkeypatch.setattr(utl, "_dir_is_writable", lambda dir: False)
+
+    meta_df = utl.all_unit_metadata(data_dir, reload=True)
+    assert not os.path.isfile(data_dir / "unit_metadata_index.parquet")
+    index_files = os.listdir(cache_dir)
+    assert len(index_files) == 1 and index_files[0].endswith("unit_metadata_index.parquet")
+
+    # the next process uses the per-user index, without reading the session file
+    monkeypatch.setattr(utl, "load_session", None)
+    cached_df = utl.all_unit_metadata(data_dir, reload=True)
+    pd.testing.assert_frame_equal(meta_df, cached_df)
+
+
+def test_metadata_parallel_crawl(tmp_path):
+    for session_id in [4, 2, 3, 1]:
+        _write_session_file(tmp_path, session_id, seed=session_id)
+    # files without session data are skipped
+    with h5.File(f"{tmp_path}/not_a_session.h5", "w") as f:
+        f.create_dataset("foo", data=np.arange(3))
+
+    serial_df = utl.all_unit_metadata(tmp_path, reload=True, use_index=False)
+    parallel_df = utl.all_unit_metadata(
+        tmp_path, reload=True, use_index=False, workers=2
+    )
+    pd.testing.assert_frame_equal(serial_df, parallel_df)
+    assert list(parallel_df["session"].unique()) == [1, 2, 3, 4]
+
+
+def test_metadata_parallel_crawl_after_threads(tmp_path):
+    # the worker pool must not fork a process that runs numba's thread pool
+    from numba import njit, prange
+
+    @njit(parallel=True)
+    def parallel_sum(x):
+        total = 0.0
+        for idx in prange(len(x)):
+            total += x[idx]
+        return total
+
+    assert parallel_sum(np.ones(1000)) == 1000
+    for session_id in [1, 2]:
+        _write_session_file(tmp_path, session_id, seed=session_id)
+    meta_df = utl.all_unit_metadata(tmp_path, reload=True, use_index=False, workers=2)
+    assert list(meta_df["session"].unique()) == [1, 2]
+
+
+def test_read_hdf_frame(tmp_path):
+    _write_session_file(tmp_path, 1)
+    filename = f"{tmp_path}/session_1_spike_data.h5"
+    with h5.File(filename, "r") as f:
+        for key in f.keys():
+            if not key.endswith("_metadata"):
+                continue
+            pd.testing.assert_frame_equal(
+                utl._read_hdf_frame(f[key]), pd.read_hdf(filename, key=key)
+            )
+
+    # other dtypes are decoded as pandas does it
+    df = pd.DataFrame(
+        dict(
+            flag=[True, False],
+            count=np.array([1, 2], dtype=np.uint8),
+            time=pd.to_datetime(["2020-01-01", "2020-01-02"]),
+        )
+    )
+    df.to_hdf(f"{tmp_path}/other.h5", key="df")
+    with h5.File(f"{tmp_path}/other.h5", "r") as f:
+        decoded = utl._read_hdf_frame(f["df"])
+    pd.testing.assert_frame_equal(decoded, pd.read_hdf(f"{tmp_path}/other.h5", key="df"))
+    assert decoded["flag"].dtype == bool
+
+
+def test_load_spikes(tmp_path):
+    written = _write_session_file(tmp_path, 1)
+    meta_df = utl.all_unit_metadata(tmp_path, reload=True, use_index=False)
+    loaded_df = utl.load_spikes(meta_df)
+    assert len(loaded_df) == len(meta_df)
+
+    for _, row in loaded_df.iterrows():
+        udx = row["unit_id"] - 100
+        expected = written[(row["stimulus"], row["block"])][udx]
+        assert np.array_equal(row["spiketimes"], expected)
+        assert row["num_spikes"] == len(expected)
+
+
+def test_ragged_layout(tmp_path):
+    _write_session_file(tmp_path, 1)
+    padded_path = f"{tmp_path}/session_1_spike_data.h5"
+    ragged_path = f"{tmp_path}/ragged/session_1_spike_data.h5"
+    os.makedirs(os.path.dirname(ragged_path))
+    utl.convert_session_to_ragged(padded_path, target=ragged_path)
+    assert os.path.getsize(ragged_path) < os.path.getsize(padded_path)
+
+    padded_df = utl.load_spikes(utl.load_session(padded_path).reset_index(drop=True))
+    ragged_df = utl.load_spikes(utl.load_session(ragged_path).reset_index(drop=True))
+    for padded, ragged in zip(padded_df["spiketimes"], ragged_df["spiketimes"]):
+        assert np.array_equal(padded, ragged)
+
+    # xarray format stays nan-padded, in both layouts
+    padded_dict = utl.load_session(padded_path, as_dict=True)
+    ragged_dict = utl.load_session(ragged_path, as_dict=True)
+    for stimulus, block in _blocks:
+        assert padded_dict[1][stimulus][block]["data"].equals(
+            ragged_dict[1][stimulus][block]["data"]
+        )
+
+
+def test_repack_session_file(tmp_path):
+    _write_session_file(tmp_path, 1)
+    padded_path = f"{tmp_path}/session_1_spike_data.h5"
+    ragged_path = f"{tmp_path}/session_1_ragged.h5"
+    utl.convert_session_to_ragged(padded_path, target=ragged_path)
+    reference = utl.load_spikes(utl.load_session(padded_path).reset_index(drop=True))
+
+    for path in [padded_path, ragged_path]:
+        with h5.File(path, "r") as f:
+            keys = sorted(f.keys())
+        for codec in ["lzf", "gzip", "blosc"]:
+            report = utl.repack_session_file(path, codec=codec)
+            assert report["target"] == path
+            assert report["size_after"] == os.path.getsize(path)
+            assert report["unit_ms_after"] > 0
+            with h5.File(path, "r") as f:
+                assert sorted(f.keys()) == keys
+                for key in keys:
+                    if key.endswith("_spiketimes") and f[key].ndim == 2:
+                        assert f[key].chunks == (1, f[key].shape[1])
+            loaded = utl.load_spikes(utl.load_session(path).reset_index(drop=True))
+            for a, b in zip(reference["spiketimes"], loaded["spiketimes"]):
+                assert np.array_equal(a, b)
+
+
+def test_sample_encoding(tmp_path):
+    _write_session_file(tmp_path, 1)
+    float_path = f"{tmp_path}/session_1_spike_data.h5"
+    sample_path = f"{tmp_path}/samples/session_1_spike_data.h5"
+    os.makedirs(os.path.dirname(sample_path))
+    utl.convert_session_to_samples(float_path, target=sample_path)
+    assert os.path.getsize(sample_path) < os.path.getsize(float_path)
+
+    fs = utl.default_sampling_rate
+    float_df = utl.load_spikes(utl.load_session(float_path).reset_index(drop=True))
+    sample_df = utl.load_spikes(utl.load_session(sample_path).reset_index(drop=True))
+    for a, b in zip(float_df["spiketimes"], sample_df["spiketimes"]):
+        assert b.dtype == np.float64
+        assert len(a) == len(b)
+        assert np.allclose(a, b, rtol=0, atol=1 / fs)
+
+    # decoding is lossless, also when re-encoding and for single units
+    samples_df = utl.load_spikes(
+        utl.load_session(sample_path).reset_index(drop=True), format="samples"
+    )
+    assert np.all(samples_df["sampling_rate"] == fs)
+    assert np.allclose(samples_df["recording_length"], sample_df["recording_length"])
+    lazy_df = utl.load_spikes(
+        utl.load_session(sample_path).reset_index(drop=True), lazy=True
+    )
+    utl.convert_session_to_samples(sample_path)
+    resampled_df = utl.load_spikes(
+        utl.load_session(sample_path).reset_index(drop=True), format="samples"
+    )
+    for samples, resampled, handle in zip(
+        samples_df["spiketimes"], resampled_df["spiketimes"], lazy_df["spiketimes"]
+    ):
+        assert samples.dtype == np.int64
+        assert np.array_equal(samples, resampled)
+        assert np.array_equal(samples / fs, handle.resolve())
+
+    # binning from sample indices, aligned to the first spike of each unit
+    trains = [st for st in samples_df["spiketimes"] if len(st) > 0]
+    counts = utl.binned_spike_count(trains, 0.005, sampling_rate=fs)
+    for st, c in zip(trains, counts):
+        expected = np.bincount((st - st[0]) // 150, minlength=counts.shape[1])
+        assert np.array_equal(c, expected)
+
+
+def test_backfill_spike_stats(tmp_path):
+    written = _write_session_file(tmp_path, 1)
+    filepath = f"{tmp_path}/session_1_spike_data.h5"
+    utl.backfill_spike_stats(filepath)
+
+    meta_df = utl.load_session(filepath, meta_only=True).reset_index(drop=True)
+    for _, row in meta_df.iterrows():
+        train = written[(row["stimulus"], row["block"])][row["unit_id"] % 100]
+        train = train.astype(np.float64)
+        assert row["num_spikes"] == len(train)
+        if len(train) == 0:
+            assert np.isnan(row["t_first"]) and np.isnan(row["isi_mean"])
+            continue
+        assert row["t_first"] == train[0] and row["t_last"] == train[-1]
+        if len(train) > 1:
+            isis = np.diff(train)
+            assert np.isclose(row["isi_mean"], isis.mean())
+            assert np.isclose(row["isi_cv"], isis.std() / isis.mean())
+
+    # the duration checks on metadata alone agree with `prepare_spike_times`
+    filtered_df = utl.default_filter(meta_df, trim=False)
+    spikes_df = utl.load_spikes(meta_df)
+    for (_, row), spikes in zip(filtered_df.iterrows(), spikes_df["spiketimes"]):
+        prepared = utl.prepare_spike_times(spikes, row["stimulus"])
+        if row["invalid_spiketimes_check"] in ["ERR_EMPTY", "ERR_REC_LEN"]:
+            assert len(prepared) == 0
+        else:
+            assert len(prepared) > 0
+
+
+def test_grouped_layout(tmp_path):
+    _write_session_file(tmp_path, 1)
+    flat_path = f"{tmp_path}/session_1_spike_data.h5"
+    grouped_path = f"{tmp_path}/grouped/session_1_spike_data.h5"
+    os.makedirs(os.path.dirname(grouped_path))
+    utl.convert_session_to_groups(flat_path, target=grouped_path)
+    with h5.File(grouped_path, "r") as f:
+        assert list(f.keys()) == ["1"]
+        group = f["1/natural_movie_one_more_repeats/3.0"]
+        assert sorted(group.keys()) == ["metadata", "spiketimes"]
+        assert group.attrs["session"] == 1
+        assert group.attrs["stimulus"] == "natural_movie_one_more_repeats"
+        assert group.attrs["block"] == "3.0"
+
+    flat_df = utl.load_spikes(utl.load_session(flat_path).reset_index(drop=True))
+    grouped_df = utl.load_spikes(utl.load_session(grouped_path).reset_index(drop=True))
+    assert flat_df.drop(columns=["filepath", "spiketimes"]).equals(
+        grouped_df.drop(columns=["filepath", "spiketimes"])
+    )
+    for a, b in zip(flat_df["spiketimes"], grouped_df["spiketimes"]):
+        assert np.array_equal(a, b)
+
+    # only matching groups are visited
+    visited = []
+    with h5.File(grouped_path, "r") as f:
+        for parts, key in utl._iter_blocks(f, dict(stimulus=["spontaneous"])):
+            visited.append(key)
+    assert visited == ["/1/spontaneous/null/spiketimes"]
+
+    # the other maintenance tools keep the groups
+    utl.convert_session_to_ragged(grouped_path)
+    utl.convert_session_to_samples(grouped_path)
+    utl.backfill_spike_stats(grouped_path)
+    utl.repack_session_file(grouped_path, codec="lzf", benchmark=False)
+    with h5.File(grouped_path, "r") as f:
+        assert list(f.keys()) == ["1"]
+        assert sorted(f["1/spontaneous/null"].keys()) == [
+            "base",
+            "bits",
+            "metadata",
+            "offsets",
+            "spiketimes",
+        ]
+        assert f["1/spontaneous/null"].attrs["block"] == "null"
+    meta_df = utl.load_session(grouped_path, meta_only=True).reset_index(drop=True)
+    assert "isi_cv" in meta_df.columns
+    grouped_df = utl.load_spikes(meta_df, mmap_dir=f"{tmp_path}/mmap")
+    for a, b in zip(flat_df["spiketimes"], grouped_df["spiketimes"]):
+        assert np.allclose(a, b, rtol=0, atol=1 / utl.default_sampling_rate)
+
+
+def test_merge_blocks(tmp_path):
+    _write_session_file(tmp_path, 1, num_units=30, seed=1)
+    _write_session_file(tmp_path, 2, num_units=30, seed=2)
+    meta_df = utl.all_unit_metadata(tmp_path, reload=True, use_index=False)
+    df = utl.load_spikes(meta_df)
+    df["spiketimes"] = utl._object_array(
+        [utl.prepare_spike_times(st, stim) for st, stim in zip(df["spiketimes"], df["stimulus"])]
+    )
+
+    merged_df = utl.merge_blocks(df)
+    assert merged_df["stimulus"].unique().tolist() == ["natural_movie_one_more_repeats"]
+
+    # reference: unit by unit, keeping units with spikes in the first block
+    expected = []
+    for (session, stimulus, unit_id), group in df.groupby(["session", "stimulus", "unit_id"]):
+        if len(group) != 2 or len(group["spiketimes"].iloc[0]) == 0:
+            continue
+        spikes1, spikes2 = group["spiketimes"]
+        spikes = np.concatenate([spikes1, spikes2 + spikes1[-1]])
+        expected.append((unit_id, spikes))
+    assert merged_df["unit_id"].tolist() == [unit_id for unit_id, _ in expected]
+
+    for (_, row), (unit_id, spikes) in zip(merged_df.iterrows(), expected):
+        assert row["block"] == "merged_3.0_and_8.0"
+        assert np.array_equal(row["spiketimes"], spikes)
+        assert row["num_spikes"] == len(spikes)
+        assert row["recording_length"] == spikes[-1] - spikes[0]
+        assert row["firing_rate"] == np.float32(len(spikes)) / (spikes[-1] - spikes[0])
+
+    # nothing to merge
+    assert len(utl.merge_blocks(df.query("stimulus == 'spontaneous'"))) == 0
+
+
+def test_merge_blocks_spike_stats(tmp_path):
+    _write_session_file(tmp_path, 1, num_units=30, seed=1)
+    utl.backfill_spike_stats(f"{tmp_path}/session_1_spike_data.h5")
+    meta_df = utl.all_unit_metadata(tmp_path, reload=True, use_index=False)
+    df = utl.load_spikes(meta_df)
+    spikes = utl.prepare_spike_times_batch(df["spiketimes"], df["stimulus"])
+
+    # the stats describe the merged (and prepared) trains, not the first block
+    for merged_df in [
+        utl.merge_blocks(df, spikes=spikes),
+        utl.merge_blocks(df.assign(spiketimes=utl._ragged_to_object_array(*spikes))),
+    ]:
+        assert len(merged_df) > 0
+        for _, row in merged_df.iterrows():
+            st = row["spiketimes"].astype(np.float64)
+            isis = np.diff(st)
+            assert row["t_first"] == np.float32(st[0])
+            assert row["t_last"] == np.float32(st[-1])
+            assert np.isclose(row["isi_mean"], isis.mean(), rtol=1e-5)
+            assert np.isclose(row["isi_cv"], isis.std() / isis.mean(), rtol=1e-4)
+        assert merged_df["t_first"].dtype == meta_df["t_first"].dtype
+        assert np.allclose(
+            merged_df["t_last"] - merged_df["t_first"], merged_df["recording_length"]
+        )
+
+    # prepared, but not merged
+    for row, st in utl.iter_units(meta_df, merge=False):
+        if len(st) > 1:
+            assert row["t_first"] == np.float32(st[0])
+            assert row["num_spikes"] == len(st)
+
+
+def test_prepare_spike_times_batch(tmp_path):
+    _write_session_file(tmp_path, 1, num_units=30, seed=1)
+    df = utl.load_spikes(utl.all_unit_metadata(tmp_path, reload=True, use_index=False))
+
+    lengths = dict(utl.prepare_lengths)
+    lengths["spontaneous"] = (600, 300, 10)
+    for stimuli in [df["stimulus"], ["spontaneous_for_merged"] * len(df)]:
+        for lens in [None, lengths]:
+            values, offsets = utl.prepare_spike_times_batch(
+                df["spiketimes"], stimuli, lengths=lens
+            )
+            assert len(offsets) == len(df) + 1
+            for idx, (spikes, stim) in enumerate(zip(df["spiketimes"], stimuli)):
+                expected = utl.prepare_spike_times(spikes, stim, lengths=lens)
+                prepared = values[offsets[idx] : offsets[idx + 1]]
+                assert prepared.dtype == expected.dtype
+                assert np.array_equal(prepared, expected)
+
+    with pytest.raises(ValueError):
+        utl.prepare_spike_times_batch(df["spiketimes"], ["unknown"] * len(df))
+
+    # feeds into merging without a spiketimes column
+    spikes = utl.prepare_spike_times_batch(df["spiketimes"], df["stimulus"])
+    merged_df = utl.merge_blocks(df.drop(columns="spiketimes"), spikes=spikes)
+    df["spiketimes"] = utl._ragged_to_object_array(*spikes)
+    ref_df = utl.merge_blocks(df)
+    assert merged_df.drop(columns="spiketimes").equals(
+        ref_df.drop(columns="spiketimes")
+    )
+    for a, b in zip(merged_df["spiketimes"], ref_df["spiketimes"]):
+        assert np.array_equal(a, b)
+
+
+def test_compact_dtypes(tmp_path):
+    for session_id in [1, 2]:
+        _write_session_file(tmp_path, session_id, num_units=30, seed=session_id)
+    compact_df = utl.all_unit_metadata(tmp_path, reload=True)
+    plain_df = utl.all_unit_metadata(tmp_path, reload=True, compact=False)
+
+    assert isinstance(compact_df["stimulus"].dtype, pd.CategoricalDtype)
+    assert list(compact_df["stimulus"].cat.categories) == sorted(
+        utl.metadata_categories["stimulus"]
+    )
+    assert "ERR_REC_LEN" in compact_df["invalid_spiketimes_check"].cat.categories
+    assert compact_df["unit_id"].dtype == np.int32
+    assert compact_df["firing_rate"].dtype == np.float32
+    assert compact_df["recording_length"].dtype == np.float64
+    assert plain_df["unit_id"].dtype == np.int64
+    assert not isinstance(plain_df["stimulus"].dtype, pd.CategoricalDtype)
+    assert (
+        compact_df.memory_usage(deep=True).sum() < plain_df.memory_usage(deep=True).sum()
+    )
+    pd.testing.assert_frame_equal(
+        compact_df.astype(plain_df.dtypes.to_dict()), plain_df, check_dtype=False
+    )
+
+    # values outside the category sets are kept
+    other_df = plain_df.assign(stimulus="drifting_gratings")
+    assert (utl.compact_dtypes(other_df)["stimulus"] == "drifting_gratings").all()
+
+    # the pipeline gives the same results
+    results = []
+    for meta_df in [compact_df, plain_df]:
+        meta_df = utl.default_filter(meta_df, trim=False)
+        df = utl.load_spikes(meta_df)
+        spikes = utl.prepare_spike_times_batch(df["spiketimes"], df["stimulus"])
+        merged_df = utl.merge_blocks(df, spikes=spikes)
+        results.append((meta_df, merged_df))
+    for col in ["invalid_spiketimes_check", "stimulus"]:
+        assert (results[0][0][col].astype(str) == results[1][0][col]).all()
+    for col in ["unit_id", "block", "num_spikes", "recording_length", "firing_rate"]:
+        assert (results[0][1][col].to_numpy() == results[1][1][col].to_numpy()).all()
+
+
+def test_default_filter(tmp_path):
+    for session_id in [1, 2]:
+        _write_session_file(tmp_path, session_id, num_units=30, seed=session_id)
+    meta_df = utl.all_unit_metadata(tmp_path, reload=True, compact=False)
+
+    # reference: the sequential checks, with the stationarity loop
+    ref_df = meta_df.copy()
+    rec_len = ref_df["recording_length"]
+    min_len = ref_df["stimulus"].map(
+        {stim: lengths[0] for stim, lengths in utl.prepare_lengths.items()}
+    )
+    ref_df.loc[ref_df["firing_rate"] < 0.01, "invalid_spiketimes_check"] = "ERR_LO_FIR_RATE"
+    ref_df.loc[rec_len == 0, "invalid_spiketimes_check"] = "ERR_EMPTY"
+    for _, df in ref_df.groupby(["unit_id", "stimulus"]):
+        if len(df) < 2:
+            continue
+        fr1 = df.iloc[0]["firing_rate"]
+        fr2 = df.iloc[1]["firing_rate"]
+        if abs(fr1 - fr2) / np.mean([fr1, fr2]) > 0.5:
+            ref_df.loc[df.index, "invalid_spiketimes_check"] = "ERR_STATIONARITY"
+    ref_df.loc[rec_len < min_len, "invalid_spiketimes_check"] = "ERR_REC_LEN"
+
+    filtered_df = utl.default_filter(meta_df, trim=False)
+    assert (filtered_df["invalid_spiketimes_check"] == ref_df["invalid_spiketimes_check"]).all()
+    assert (filtered_df["invalid_spiketimes_check"] == "ERR_STATIONARITY").any()
+    assert (meta_df["invalid_spiketimes_check"] == "SUCCESS").all()
+
+    trimmed_df = utl.default_filter(meta_df)
+    assert (trimmed_df["invalid_spiketimes_check"] == "SUCCESS").all()
+    assert len(trimmed_df) == (ref_df["invalid_spiketimes_check"] == "SUCCESS").sum()
+
+    # a row can fail several rules, the masks keep all of them
+    masks = utl.quality_masks(meta_df)
+    assert list(masks.columns) == list(utl.qc_rules.keys())
+    assert (masks.any(axis=1) == (filtered_df["invalid_spiketimes_check"] != "SUCCESS")).all()
+    without_df = utl.default_filter(meta_df, trim=False, rules=["rate", "empty", "duration"])
+    assert not (without_df["invalid_spiketimes_check"] == "ERR_STATIONARITY").any()
+
+    # categorical status columns stay categorical
+    compact_df = utl.default_filter(utl.compact_dtypes(meta_df), trim=False)
+    assert isinstance(compact_df["invalid_spiketimes_check"].dtype, pd.CategoricalDtype)
+    assert (compact_df["invalid_spiketimes_check"].astype(str) == ref_df["invalid_spiketimes_check"]).all()
+
+    summary = utl.quality_summary(filtered_df)
+    assert set(summary.index) == set(meta_df["stimulus"])
+    assert (summary["num_total"] == meta_df.groupby("stimulus").size()).all()
+    for stim, df in ref_df.groupby("stimulus"):
+        for status, count in df["invalid_spiketimes_check"].value_counts().items():
+            col = "num_valid" if status == "SUCCESS" else status
+            assert summary.loc[stim, col] == count
+
+
+def test_load_metrics(tmp_path, caplog):
+    meta_df = pd.DataFrame(
+        dict(
+            unit_id=[1, 1, 2, 3, 4, 5],
+            stimulus=["a", "b", "a", "a", "a", "a"],
+        )
+    )
+    pd.DataFrame(
+        dict(
+            ecephys_unit_id=[1, 2, 3, 6],
+            g_dsi_dg=[0.1, 0.2, np.nan, 0.6],
+            on_screen_rf=[True, False, True, True],
+            unused=[1, 2, 3, 4],
+        )
+    ).to_csv(tmp_path / "bo.csv", index=False)
+    pd.DataFrame(
+        dict(
+            ecephys_unit_id=[1, 2, 3, 5],
+            g_dsi_dg=[0.1, 0.25, 0.3, np.nan],
+            mod_idx_dg=[1.0, 2.0, 3.0, 5.0],
+        )
+    ).to_csv(tmp_path / "fc.csv", index=False)
+
+    kwargs = dict(csvs=["bo.csv", "fc.csv"], cols=["g_dsi_dg", "mod_idx_dg", "on_screen_rf"])
+    with caplog.at_level(logging.WARNING, logger=utl.log.name):
+        df = utl.load_metrics(meta_df, tmp_path, **kwargs)
+
+    # later csvs take precedence, unless nan
+    assert np.allclose(df["g_dsi_dg"], [0.1, 0.1, 0.25, 0.3, np.nan, np.nan], equal_nan=True)
+    assert np.allclose(df["mod_idx_dg"], [1, 1, 2, 3, np.nan, 5], equal_nan=True)
+    assert df["on_screen_rf"].tolist()[:4] == [True, True, False, True]
+    assert df["on_screen_rf"].iloc[4:].isna().all()
+    assert "unused" not in df.columns
+    assert "g_dsi_dg" not in meta_df.columns
+
+    # unit 2 differs between the csvs. unit 3 was nan, so nothing to compare
+    warnings = [r.getMessage() for r in caplog.records if "Inconsistency" in r.getMessage()]
+    assert warnings == ["Inconsistency found in column g_dsi_dg for unit 2"]
+
+    # second load comes from the parquet caches, with the same result
+    assert os.path.isfile(tmp_path / "bo.csv.cache.parquet")
+    os.remove(tmp_path / "fc.csv")
+    pd.DataFrame(dict(ecephys_unit_id=[1], g_dsi_dg=[9.0], mod_idx_dg=[9.0])).to_csv(
+        tmp_path / "fc.csv", index=False
+    )
+    os.utime(tmp_path / "fc.csv", ns=(0, 0))
+    with caplog.at_level(logging.DEBUG, logger=utl.log.name):
+        cached_df = utl.load_metrics(meta_df, tmp_path, csvs=["bo.csv"], cols=["g_dsi_dg"])
+    assert any("Loaded metrics cache" in r.getMessage() for r in caplog.records)
+    assert np.allclose(cached_df["g_dsi_dg"], [0.1, 0.1, 0.2, np.nan, np.nan, np.nan], equal_nan=True)
+    # a changed csv invalidates its cache
+    changed_df = utl.load_metrics(meta_df, tmp_path, **kwargs)
+    assert np.allclose(changed_df["mod_idx_dg"], [9, 9, np.nan, np.nan, np.nan, np.nan], equal_nan=True)
+
+    with pytest.raises(ValueError):
+        utl.load_metrics(df, tmp_path, **kwargs)
+
+
+def test_save_dataframe(tmp_path):
+    _write_session_file(tmp_path, 1, num_units=10)
+    meta_df = utl.default_filter(utl.all_unit_metadata(tmp_path, reload=True), trim=False)
+    df = utl.load_spikes(meta_df).set_index(["unit_id", "stimulus", "block"])
+
+    rng = np.random.default_rng(42)
+    df["tau_single"] = rng.uniform(0, 1, len(df))
+    details = [
+        dict(
+            tau=np.float64(t),
+            fitfunc="f_exponential_offset",
+            popt=rng.normal(size=3),
+            pcov=rng.normal(size=(3, 3)),
+            taustderr=None,
+            dt=0.005,
+        )
+        for t in df["tau_single"]
+    ]
+    details[2] = None
+    # failed fits: nan values, empty dicts, and nan instead of a dict
+    details[3]["tau"] = np.nan
+    details[4] = dict()
+    details[5] = np.nan
+    df["tau_single_details"] = utl._object_array(details)
+
+    path = f"{tmp_path}/results.parquet"
+    utl.save_dataframe(df, path, cols_to_skip=["filepath"])
+    loaded_df = utl.load_dataframe(path)
+
+    assert list(loaded_df.columns) == [c for c in df.columns if c != "filepath"]
+    assert loaded_df.index.equals(df.index)
+    assert isinstance(loaded_df["invalid_spiketimes_check"].dtype, pd.CategoricalDtype)
+    for col in ["firing_rate", "tau_single", "num_spikes"]:
+        assert (loaded_df[col] == df[col]).all()
+        assert loaded_df[col].dtype == df[col].dtype
+    for a, b in zip(loaded_df["spiketimes"], df["spiketimes"]):
+        assert a.dtype == b.dtype and np.array_equal(a, b)
+    for a, b in zip(loaded_df["tau_single_details"], df["tau_single_details"]):
+        if not isinstance(b, dict):
+            assert (a is None and b is None) or (np.isnan(a) and np.isnan(b))
+            continue
+        assert a.keys() == b.keys()
+        if len(b) == 0:
+            continue
+        assert a["fitfunc"] == b["fitfunc"] and a["taustderr"] is None
+        assert a["tau"] == b["tau"] or (np.isnan(a["tau"]) and np.isnan(b["tau"]))
+        assert np.array_equal(a["popt"], b["popt"])
+        assert a["pcov"].shape == (3, 3) and np.array_equal(a["pcov"], b["pcov"])
+
+    # scalar columns without reading the spikes or details
+    scalar_df = utl.load_dataframe(path, columns=["tau_single"])
+    assert list(scalar_df.columns) == ["tau_single"]
+    assert scalar_df.index.equals(df.index)
+
+    # we only write parquet, but still read what `to_hdf` wrote
+    with pytest.raises(ValueError):
+        utl.save_dataframe(df, f"{tmp_path}/results.h5")
+    hdf_df = df[["tau_single", "num_spikes"]].reset_index(drop=True)
+    hdf_df.to_hdf(f"{tmp_path}/results.h5", key="meta_df")
+    pd.testing.assert_frame_equal(
+        utl.load_dataframe(f"{tmp_path}/results.h5", columns=["tau_single"]),
+        hdf_df[["tau_single"]],
+    )
+
+
+def test_load_selected_units(tmp_path):
+    written = _write_session_file(tmp_path, 1)
+    padded_path = f"{tmp_path}/session_1_spike_data.h5"
+    ragged_path = f"{tmp_path}/ragged_session_1_spike_data.h5"
+    utl.convert_session_to_ragged(padded_path, target=ragged_path)
+
+    for path in [padded_path, ragged_path]:
+        session_dict = utl.load_session(
+            path, filter=dict(unit_id=[101, 102, 104]), as_dict=True
+        )
+        for stimulus, block in _blocks:
+            values, offsets = session_dict[1][stimulus][block]["ragged"]
+            assert len(offsets) == 4
+            for udx, unit in enumerate([1, 2, 4]):
+                assert np.array_equal(
+                    values[offsets[udx] : offsets[udx + 1]],
+                    written[(stimulus, block)][unit],
+                )
+
+        # predicates on metadata columns
+        meta_df = utl.load_session(
+            path, meta_only=True, filter=dict(firing_rate=lambda fr: fr > 1.0)
+        )
+        assert np.all(meta_df["firing_rate"] > 1.0)
+
+    # load_spikes only reads the rows it needs
+    meta_df = utl.all_unit_metadata(tmp_path, reload=True, use_index=False)
+    meta_df = meta_df.query("filepath == @ragged_path & unit_id in [100, 103]")
+    loaded_df = utl.load_spikes(meta_df)
+    for _, row in loaded_df.iterrows():
+        expected = written[(row["stimulus"], row["block"])][row["unit_id"] - 100]
+        assert np.array_equal(row["spiketimes"], expected)
+
+
+def test_spike_count_bookkeeping(tmp_path):
+    written = _write_session_file(tmp_path, 1)
+    meta_df = utl.all_unit_metadata(tmp_path, reload=True, use_index=False)
+    loaded_df = utl.load_spikes(meta_df)
+    for _, row in loaded_df.iterrows():
+        expected = written[(row["stimulus"], row["block"])][row["unit_id"] - 100]
+        assert row["num_spikes"] == len(expected)
+        if len(expected) > 1:
+            assert row["recording_length"] == float(expected[-1] - expected[0])
+        else:
+            assert row["recording_length"] == 0.0
+
+
+def test_load_spikes_xarray(tmp_path):
+    written = _write_session_file(tmp_path, 1)
+    meta_df = utl.all_unit_metadata(tmp_path, reload=True, use_index=False)
+    meta_df = meta_df.sample(frac=0.5, random_state=1)
+    numpy_df = utl.load_spikes(meta_df, format="numpy")
+    xarray_df = utl.load_spikes(meta_df, format="xarray")
+    pd.testing.assert_frame_equal(
+        numpy_df.drop(columns="spiketimes"), xarray_df.drop(columns="spiketimes")
+    )
+    for _, row in xarray_df.iterrows():
+        da = row["spiketimes"]
+        assert da.dims == ("session", "stimulus", "block", "spiketimes")
+        assert da["unit_id"].item() == row["unit_id"]
+        spikes = da.values.flatten()
+        expected = written[(row["stimulus"], row["block"])][row["unit_id"] - 100]
+        assert np.array_equal(spikes[np.isfinite(spikes)], expected)
+
+
+def test_lazy_spikes(tmp_path):
+    written = _write_session_file(tmp_path, 1)
+    utl.convert_session_to_ragged(
+        f"{tmp_path}/session_1_spike_data.h5",
+        target=f"{tmp_path}/ragged_session_1_spike_data.h5",
+    )
+    meta_df = utl.all_unit_metadata(tmp_path, reload=True, use_index=False)
+    eager_df = utl.load_spikes(meta_df)
+    lazy_df = utl.load_spikes(meta_df, lazy=True)
+    assert np.all([isinstance(h, utl.SpikeHandle) for h in lazy_df["spiketimes"]])
+
+    utl.clear_spike_cache()
+    utl.set_spike_cache_size(10_000)
+    for eager, lazy in zip(eager_df["spiketimes"], lazy_df["spiketimes"]):
+        assert np.array_equal(eager, np.asarray(lazy))
+    assert utl._spike_cache._num_bytes <= 10_000
+    utl.set_spike_cache_size(2 * 1024**3)
+
+    # downstream functions take handles
+    for eager, lazy in zip(eager_df["spiketimes"], lazy_df["spiketimes"]):
+        assert np.array_equal(
+            utl.prepare_spike_times(eager, "spontaneous"),
+            utl.prepare_spike_times(lazy, "spontaneous"),
+        )
+    assert np.array_equal(
+        utl.binned_spike_count(eager_df["spiketimes"][1], 0.1),
+        utl.binned_spike_count(lazy_df["spiketimes"][1], 0.1),
+    )
+    # both files hold the same session, merge them separately
+    for fp in meta_df["filepath"].unique():
+        merged_eager = utl.merge_blocks(eager_df.query("filepath == @fp"))
+        merged_lazy = utl.merge_blocks(lazy_df.query("filepath == @fp"))
+        for eager, lazy in zip(merged_eager["spiketimes"], merged_lazy["spiketimes"]):
+            assert np.array_equal(eager, lazy)
+
+
+def test_mmap_cache(tmp_path):
+    _write_session_file(tmp_path, 1)
+    meta_df = utl.all_unit_metadata(tmp_path, reload=True, use_index=False)
+    meta_df = meta_df.sample(frac=0.7, random_state=2)
+    mmap_dir = f"{tmp_path}/mmap"
+
+    loaded_df = utl.load_spikes(meta_df)
+    mmap_df = utl.load_spikes(meta_df, mmap_dir=mmap_dir)
+    assert len([d for d in os.listdir(mmap_dir) if not d.endswith(".lock")]) == 1
+    pd.testing.assert_frame_equal(
+        loaded_df.drop(columns="spiketimes"), mmap_df.drop(columns="spiketimes")
+    )
+    for loaded, mapped in zip(loaded_df["spiketimes"], mmap_df["spiketimes"]):
+        assert np.array_equal(loaded, mapped)
+        assert not mapped.flags.writeable
+        # (numpy gives plain arrays for empty slices)
+        assert isinstance(mapped, np.memmap) or len(mapped) == 0
+
+    # second load uses the existing mapping, also when set module-wide
+    utl.set_mmap_cache_dir(mmap_dir)
+    try:
+        mmap_df = utl.load_spikes(meta_df)
+    finally:
+        utl.set_mmap_cache_dir(None)
+    assert np.any([isinstance(st, np.memmap) for st in mmap_df["spiketimes"]])
+
+
+def test_mmap_cache_concurrent(tmp_path, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    _write_session_file(tmp_path, 1)
+    filepath = f"{tmp_path}/session_1_spike_data.h5"
+    mmap_dir = f"{tmp_path}/mmap"
+
+    builds = []
+    build = utl._build_mmap_cache
+    monkeypatch.setattr(
+        utl, "_build_mmap_cache", lambda *args: builds.append(args) or build(*args)
+    )
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: utl._mmap_session(filepath, mmap_dir), range(8)))
+
+    # built once, everyone sees the same complete cache
+    assert len(builds) == 1
+    assert all(res.keys() == results[0].keys() for res in results)
+    assert not [d for d in os.listdir(mmap_dir) if d.endswith(".tmp")]
+
+    # a changed session file is rebuilt once
+    os.utime(filepath, ns=(0, 0))
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda _: utl._mmap_session(filepath, mmap_dir), range(8)))
+    assert len(builds) == 2
+
+
+def test_iter_units(tmp_path):
+    for session_id in [1, 2, 3]:
+        _write_session_file(tmp_path, session_id, seed=session_id)
+    meta_df = utl.all_unit_metadata(tmp_path, reload=True, use_index=False)
+
+    # reference: everything at once, as in the analysis notebook
+    ref_df = utl.load_spikes(meta_df)
+    ref_df["spiketimes"] = ref_df.apply(
+        lambda row: utl.prepare_spike_times(row["spiketimes"], row["stimulus"]),
+        axis=1,
+    )
+    ref_df = utl.merge_blocks(ref_df)
+
+    for read_ahead in [0, 2]:
+        units = list(utl.iter_units(meta_df, read_ahead=read_ahead))
+        assert len(units) == len(ref_df)
+        for (row, spikes), (_, ref_row) in zip(units, ref_df.iterrows()):
+            assert row["unit_id"] == ref_row["unit_id"]
+            assert row["block"] == ref_row["block"]
+            assert np.array_equal(spikes, ref_row["spiketimes"])